@@ -0,0 +1,299 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+import typer
+
+from spy_collage import collage, render
+from spy_collage.cli import format_error, format_info
+from spy_collage.cli.params import AlbumSource, CollageSize, CollageSizeParam
+from spy_collage.color_problem import (
+    ColorMatrix,
+    ColorSpace,
+    Solver,
+    convert_space,
+    solve_colors,
+)
+from spy_collage.main import THUMBNAIL_CACHE_PATH, collect_features
+from spy_collage.models import AlbumCoverResolution, FeatureExtractor
+from spy_collage.presets import CompiledPreset, load_compiled_preset
+
+app = typer.Typer()
+
+
+@dataclass
+class Job:
+    preset: str
+    dimensions: CollageSize
+    output: Path
+    distance_space: ColorSpace = ColorSpace.CIELAB
+
+    def __str__(self) -> str:
+        return f"{self.output} ({self.preset}, {self.dimensions.width}x{self.dimensions.height})"
+
+
+def read_jobs(path: Path) -> list[Job]:
+    """
+    Reads a jobs file, with one collage per line given as its preset, dimensions and output
+    file, optionally followed by the color space to compare colors in (CIELAB by default), e.g.
+
+        horizontal_spectrum 40x20 rainbow.png
+        red_vs_blue 20x20 red_vs_blue.png rgb
+
+    Blank lines and lines starting with # are ignored.
+    """
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) not in (3, 4):
+                typer.echo(
+                    format_error(
+                        f"could not parse job on line {line_number} of {path}: expected a preset,"
+                        " dimensions, output file and optionally a color space"
+                    )
+                )
+                raise typer.Abort()
+            preset, dimensions, output, *space = fields
+            try:
+                size = CollageSizeParam().convert(dimensions)
+                distance_space = ColorSpace(space[0]) if space else ColorSpace.CIELAB
+            except click.BadParameter as e:
+                typer.echo(format_error(f"could not parse job on line {line_number}: {e.message}"))
+                raise typer.Abort()
+            except ValueError:
+                typer.echo(
+                    format_error(
+                        f"could not parse job on line {line_number}: color space must be one of"
+                        f" {[space.value for space in ColorSpace]}"
+                    )
+                )
+                raise typer.Abort()
+            if not render.supports_output(Path(output)):
+                typer.echo(
+                    format_error(
+                        f"could not parse job on line {line_number}: cannot save collages as"
+                        f" {Path(output).suffix or 'files without an extension'}"
+                    )
+                )
+                raise typer.Abort()
+            job = Job(preset, size, Path(output), distance_space)
+            jobs.append(job)
+    return jobs
+
+
+# album colors and covers shared by every job of a batch, set once per worker process
+_shared: dict = {}
+
+
+def _init_worker(colors: dict[ColorSpace, ColorMatrix], cover_paths: list[Path]):
+    _shared["colors"] = colors
+    _shared["cover_paths"] = cover_paths
+
+
+def run_job(
+    job: Job,
+    preset: CompiledPreset,
+    solver: Solver = Solver.hungarian,
+    candidate_factor: Optional[float] = None,
+    cell_size: Optional[int] = None,
+) -> tuple[float, float]:
+    """Solves and renders one collage in a worker process, returning its cost and run time."""
+    start = time.perf_counter()
+    shape = (job.dimensions.width, job.dimensions.height)
+    assignment = solve_colors(
+        shape,
+        _shared["colors"][job.distance_space],
+        job.distance_space,
+        preset.key_objects(*shape),
+        solver=solver,
+        candidate_factor=candidate_factor,
+        space_distances=preset.distance_fields(*shape),
+    )
+    cover_paths = [_shared["cover_paths"][i] for i in assignment.colors]
+    thumbnails = render.ThumbnailCache(THUMBNAIL_CACHE_PATH) if cell_size is not None else None
+    collage.render_collage(cover_paths, shape, job.output, cell_size, thumbnails)
+    return assignment.cost, time.perf_counter() - start
+
+
+@app.command()
+def batch(
+    source: AlbumSource = typer.Argument(
+        ...,
+        help=(
+            "Albums to generate the collages with, in any of the forms accepted by spy-collage"
+            " (a playlist URI, or a file of playlist URIs, album URIs or albums as JSON)"
+        ),
+    ),
+    jobs_file: Path = typer.Argument(
+        ...,
+        exists=True,
+        dir_okay=False,
+        help=(
+            "File listing the collages to generate, one per line as: preset dimensions output"
+            " [color space], e.g. 'horizontal_spectrum 40x20 rainbow.png'"
+        ),
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="Number of collages to arrange and render at once (defaults to all CPU cores)",
+    ),
+    discover: bool = typer.Option(
+        False, help="Enable/disable automatic album discovery for singles"
+    ),
+    market: str = typer.Option(
+        "US", help="When discovering albums, only consider those available in this market"
+    ),
+    dedupe: bool = typer.Option(
+        False,
+        help=(
+            "Experimental: When fetching album art, skip albums whose art is identical to an"
+            " already-fetched album"
+        ),
+    ),
+    dedupe_threshold: int = typer.Option(
+        0,
+        min=0,
+        help=(
+            "When deduplicating, also treat album art as identical if the hamming distance between"
+            " their perceptual hashes is at most this"
+        ),
+    ),
+    album_cover_resolution: AlbumCoverResolution = typer.Option(
+        "medium", "--album-cover-resolution", "-r", help="Resolution to download album covers at"
+    ),
+    solver: Solver = typer.Option(
+        "hungarian", help="Assignment solver to arrange album covers with, see spy-collage --help"
+    ),
+    candidate_factor: Optional[float] = typer.Option(
+        None,
+        help=(
+            "Only consider roughly this many times as many albums as there are spaces in each"
+            " collage, see spy-collage --help"
+        ),
+    ),
+    spotify_workers: int = typer.Option(
+        8,
+        min=1,
+        help="Maximum number of concurrent requests to the Spotify API when collecting albums",
+    ),
+    download_workers: int = typer.Option(
+        8, min=1, help="Number of album covers to download concurrently"
+    ),
+    jobs: Optional[int] = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        min=1,
+        help="Number of processes to extract album art features with (defaults to all CPU cores)",
+    ),
+    extractor: FeatureExtractor = typer.Option(
+        "colorgram", help="Algorithm to find the dominant color of album art with"
+    ),
+    feature_cache: bool = typer.Option(
+        True, help="Enable/disable caching album art features across runs"
+    ),
+    spotify_cache: bool = typer.Option(
+        True, help="Enable/disable caching Spotify API responses across runs"
+    ),
+    spotify_cache_size: int = typer.Option(
+        256,
+        min=1,
+        help="Maximum size of the Spotify API response cache in MB, least recently used first",
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help=(
+            "Run entirely from cached Spotify API responses and previously downloaded album"
+            " covers"
+        ),
+    ),
+    cell_size: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="Size in pixels to resize each album cover to (defaults to the size of the covers)",
+    ),
+):
+    """
+    Generates several collages of the same albums, collecting the albums and extracting the
+    features of their covers only once.
+    """
+    job_list = read_jobs(jobs_file)
+    if not job_list:
+        typer.echo(format_error(f"no jobs found in {jobs_file}"))
+        raise typer.Abort()
+    presets = {job.preset: load_compiled_preset(job.preset) for job in job_list}
+
+    _, features = collect_features(
+        source,
+        discover=discover,
+        market=market,
+        dedupe=dedupe,
+        dedupe_threshold=dedupe_threshold,
+        album_cover_resolution=album_cover_resolution,
+        spotify_workers=spotify_workers,
+        download_workers=download_workers,
+        jobs=jobs,
+        extractor=extractor,
+        feature_cache=feature_cache,
+        spotify_cache=spotify_cache,
+        spotify_cache_size=spotify_cache_size,
+        offline=offline,
+    )
+    for job in job_list:
+        cells = job.dimensions.width * job.dimensions.height
+        if len(features) < cells:
+            typer.echo(
+                format_error(
+                    f"{job}: product of width and height dimensions ({job.dimensions.width} x"
+                    f" {job.dimensions.height} = {cells}) must be less than or equal to the number"
+                    f" of album covers ({len(features)})"
+                )
+            )
+            raise typer.Abort()
+
+    # colors only need converting once for every job that compares them in the same space
+    colors = ColorMatrix(np.asarray([f.features for f in features]), ColorSpace.CIELAB)
+    converted = {
+        space: convert_space(colors.matrix, colors.space, space)
+        for space in {job.distance_space for job in job_list}
+    }
+    cover_paths = [f.image_path for f in features]
+
+    workers = min(workers or os.cpu_count() or 1, len(job_list))
+    typer.echo(format_info(f"generating {len(job_list)} collages with {workers} processes"))
+    failed = 0
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(converted, cover_paths)
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_job, job, presets[job.preset], solver, candidate_factor, cell_size
+            ): job
+            for job in job_list
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                cost, seconds = future.result()
+            except Exception as e:  # report the other jobs before failing
+                typer.echo(format_error(f"{job}: {e!r}"))
+                failed += 1
+                continue
+            print(f"Saved {job} in {seconds:.2f}s, cost {cost:.6g}")
+    if failed:
+        typer.echo(format_error(f"{failed} of {len(job_list)} collages failed"))
+        raise typer.Abort()
+
+
+if __name__ == "__main__":
+    app()
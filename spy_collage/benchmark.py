@@ -0,0 +1,625 @@
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, List, Optional, TypeVar
+
+import numpy as np
+import typer
+from scipy.optimize import linear_sum_assignment
+from skimage import color as spaces
+
+from spy_collage import collage, discovery
+from spy_collage.cli import format_error, format_info
+from spy_collage.cli.params import AlbumSource, AlbumSourceParam, CollageSizeParam
+from spy_collage.cli.typer_patches import patch_typer_support_custom_types, register_type
+from spy_collage.color_problem import (
+    ColorMatrix,
+    ColorSpace,
+    create_color_distance_matrix,
+    create_coordinate_distance_matrix,
+    create_cost_matrix,
+)
+from spy_collage.models import AlbumCoverResolution, FeatureExtractor
+from spy_collage.presets import load_preset, preset_names
+from spy_collage.spotify import collect_albums, iter_covers
+
+ALBUM_DOWNLOAD_PATH = Path("albums")
+
+COLOR_PROBLEM_BASELINE = Path("benchmarks") / "color_problem.json"
+DEFAULT_COLOR_PROBLEM_SIZES = ["10x10", "25x25", "50x50", "100x100", "200x200"]
+# a dense 200x200 cost matrix takes 12.8GB, and linear_sum_assignment takes about half a minute
+# for a 50x50 collage already
+DEFAULT_MAX_DENSE_BYTES = 1 << 30
+DEFAULT_MAX_SOLVE_CELLS = 50 * 50
+
+COLOR_PROBLEM_STEPS = [
+    "create_coordinate_distance_matrix",
+    "create_color_distance_matrix",
+    "create_cost_matrix",
+    "linear_sum_assignment",
+]
+
+# the module imported by every run of spy-collage, including --help and shell completion
+IMPORT_TIME_MODULE = "spy_collage.main"
+DEFAULT_IMPORT_TIME_BUDGET_MS = 400.0
+# slow to import, so spy-collage only imports them once a phase that needs them runs
+LAZY_IMPORTS = [
+    "colorgram",
+    "dateparser",
+    "einops",
+    "imagehash",
+    "PIL",
+    "requests",
+    "scipy",
+    "skimage",
+    "spotipy",
+]
+
+T = TypeVar("T")
+
+patch_typer_support_custom_types()
+register_type(AlbumSource, lambda v: AlbumSourceParam().convert(v))
+app = typer.Typer()
+
+
+@app.callback()
+def benchmark():
+    """Benchmarks for spy-collage performance work."""
+
+
+@dataclass
+class ExtractorComparison:
+    covers: int
+    baseline_seconds: float
+    candidate_seconds: float
+    # per-cover maximum absolute RGB channel difference between the two dominant colors
+    errors: np.ndarray
+
+    @property
+    def speedup(self) -> float:
+        return self.baseline_seconds / self.candidate_seconds
+
+    def agreement(self, tolerance: int = 16) -> float:
+        """Fraction of covers whose dominant colors agree to within tolerance on every channel."""
+        return float(np.mean(self.errors <= tolerance))
+
+
+def compare_extractors(
+    image_paths: list[Path],
+    baseline: FeatureExtractor = FeatureExtractor.colorgram,
+    candidate: FeatureExtractor = FeatureExtractor.numpy,
+) -> ExtractorComparison:
+    """Times two dominant color extractors over the same covers and compares their results."""
+    baseline_extract = collage.DOMINANT_COLOR_EXTRACTORS[baseline]
+    candidate_extract = collage.DOMINANT_COLOR_EXTRACTORS[candidate]
+
+    start = time.perf_counter()
+    baseline_colors = [baseline_extract(p) for p in image_paths]
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    candidate_colors = [candidate_extract(p) for p in image_paths]
+    candidate_seconds = time.perf_counter() - start
+
+    errors = np.abs(np.asarray(baseline_colors) - np.asarray(candidate_colors)).max(axis=1)
+    return ExtractorComparison(len(image_paths), baseline_seconds, candidate_seconds, errors)
+
+
+def collect_covers(
+    source: Optional[AlbumSource], covers: Optional[Path], resolution: AlbumCoverResolution
+) -> list[Path]:
+    if covers is not None:
+        return sorted(p for p in covers.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+    if source is None:
+        typer.echo(format_error("either a source or --covers must be provided"))
+        raise typer.Abort()
+
+    albums = source.json_albums or collect_albums(source.uris, discovery_enabled=False)
+    ALBUM_DOWNLOAD_PATH.mkdir(exist_ok=True)
+    paths = {
+        ALBUM_DOWNLOAD_PATH / f"{album['id']}_{resolution.value}.jpg": album for album in albums
+    }
+    return list(iter_covers([(album, path) for path, album in paths.items()], resolution))
+
+
+@app.command()
+def extractors(
+    source: AlbumSource = typer.Argument(
+        default=None,
+        help="Albums to benchmark with, in any format accepted by spy-collage (e.g. one of the"
+        " example source lists)",
+    ),
+    covers: Optional[Path] = typer.Option(
+        None,
+        file_okay=False,
+        exists=True,
+        help="Benchmark with the images in this directory instead of downloading covers",
+    ),
+    album_cover_resolution: AlbumCoverResolution = typer.Option(
+        "medium", "--album-cover-resolution", "-r", help="Resolution to download album covers at"
+    ),
+    tolerance: int = typer.Option(
+        16, help="Maximum RGB channel difference for two dominant colors to count as matching"
+    ),
+):
+    """Compare the speed and accuracy of the numpy feature extractor against colorgram."""
+    image_paths = collect_covers(source, covers, album_cover_resolution)
+    result = compare_extractors(image_paths)
+    typer.echo(f"covers:            {result.covers}")
+    typer.echo(f"colorgram:         {result.baseline_seconds / result.covers * 1000:.2f} ms/cover")
+    typer.echo(f"numpy:             {result.candidate_seconds / result.covers * 1000:.2f} ms/cover")
+    typer.echo(f"speedup:           {result.speedup:.1f}x")
+    typer.echo(f"matching:          {result.agreement(tolerance):.1%} (within {tolerance})")
+    typer.echo(f"median difference: {np.median(result.errors):.1f}")
+
+
+def synthetic_catalog(
+    artists: int, albums: int, tracks: int, singles: int, seed: int = 0
+) -> tuple[dict[str, list[dict]], dict[str, list[dict]], list[dict]]:
+    """
+    Generates random artist catalogs, album tracklists and single tracks to discover albums for,
+    returning albums by artist URI, tracks by album URI and the singles.
+    """
+    rng = random.Random(seed)
+
+    def release_date() -> str:
+        date = f"{rng.randint(1990, 2022)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+        return date[: rng.choice((4, 7, 10, 10))]  # some releases only have a year or month
+
+    artist_albums: dict[str, list[dict]] = {}
+    album_tracks: dict[str, list[dict]] = {}
+    for a in range(artists):
+        artist = {"uri": f"spotify:artist:{a}", "name": f"Artist {a}"}
+        artist_albums[artist["uri"]] = []
+        for b in range(albums):
+            album: dict[str, Any] = {
+                "uri": f"spotify:album:{a}-{b}",
+                "name": f"Album {b}",
+                "album_type": "album",
+                "release_date": release_date(),
+                "available_markets": ["US"] if rng.random() < 0.9 else ["GB"],
+                "artists": (
+                    [artist] if rng.random() < 0.95 else [artist, {"uri": "spotify:artist:x"}]
+                ),
+            }
+            artist_albums[artist["uri"]].append(album)
+            album_tracks[album["uri"]] = [
+                {
+                    "name": f"Song {rng.randrange(4 * tracks)}",
+                    "artists": [artist],
+                    "duration_ms": rng.randint(120_000, 300_000),
+                }
+                for _ in range(tracks)
+            ]
+
+    single_tracks = []
+    for s in range(singles):
+        artist_uri = f"spotify:artist:{rng.randrange(artists)}"
+        source = rng.choice(album_tracks[rng.choice(artist_albums[artist_uri])["uri"]])
+        single_tracks.append(
+            {
+                "name": source["name"],
+                "artists": source["artists"],
+                "duration_ms": source["duration_ms"] + rng.randint(-3000, 3000),
+                "album": {
+                    "uri": f"spotify:album:single-{s}",
+                    "album_type": "single",
+                    "release_date": release_date(),
+                    "artists": source["artists"],
+                },
+            }
+        )
+    return artist_albums, album_tracks, single_tracks
+
+
+@app.command("discovery")
+def discovery_benchmark(
+    artists: int = typer.Option(200, min=1, help="Number of artists in the synthetic catalog"),
+    albums: int = typer.Option(20, min=1, help="Number of albums per artist"),
+    tracks: int = typer.Option(12, min=1, help="Number of tracks per album"),
+    singles: int = typer.Option(1000, min=1, help="Number of singles to discover albums for"),
+    seed: int = typer.Option(0, help="Random seed for generating the catalog"),
+):
+    """Time album discovery over a synthetic catalog of artists, albums and singles."""
+    artist_albums, album_tracks, single_tracks = synthetic_catalog(
+        artists, albums, tracks, singles, seed
+    )
+    fetches = {"artist albums": 0, "album tracks": 0}
+
+    def fetch_artist_albums(artist_uri: str) -> list[dict]:
+        fetches["artist albums"] += 1
+        return artist_albums[artist_uri]
+
+    def fetch_album_tracks(album_uri: str) -> list[dict]:
+        fetches["album tracks"] += 1
+        return album_tracks[album_uri]
+
+    start = time.perf_counter()
+    index = discovery.DiscoveryIndex(fetch_artist_albums, fetch_album_tracks, "US")
+    indexed = [index.discover(t) for t in single_tracks]
+    indexed_seconds = time.perf_counter() - start
+
+    typer.echo(f"singles:     {singles} ({sum(d for _, d in indexed)} discovered)")
+    typer.echo(
+        f"fetched:     {fetches['artist albums']} catalogs, {fetches['album tracks']} tracklists"
+    )
+    typer.echo(f"index:       {indexed_seconds / singles * 1000:.3f} ms/single")
+
+
+@dataclass
+class StepResult:
+    seconds: float
+    # peak memory allocated through Python and numpy while running the step, if measured
+    peak_bytes: Optional[int]
+
+
+@dataclass
+class ColorProblemResult:
+    preset: str
+    width: int
+    height: int
+    colors: int
+    # steps that were skipped for being too large are missing
+    steps: dict[str, StepResult]
+    cost: Optional[float]
+
+    @property
+    def key(self) -> str:
+        return f"{self.preset} {self.width}x{self.height} ({self.colors} colors)"
+
+    def to_dict(self) -> dict:
+        return {
+            "preset": self.preset,
+            "width": self.width,
+            "height": self.height,
+            "colors": self.colors,
+            "steps": {name: vars(step) for name, step in self.steps.items()},
+            "cost": self.cost,
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> "ColorProblemResult":
+        steps = {name: StepResult(**step) for name, step in d["steps"].items()}
+        return ColorProblemResult(
+            d["preset"], d["width"], d["height"], d["colors"], steps, d["cost"]
+        )
+
+
+def measure(
+    fn: Callable[[], T], repeat: int = 1, trace_memory: bool = True
+) -> tuple[T, StepResult]:
+    """
+    Returns the result of fn along with the fastest of repeat timed runs and, if trace_memory is
+    set, the peak memory traced by tracemalloc over one more run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    peak_bytes = None
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, StepResult(min(times), peak_bytes)
+
+
+def synthetic_lab_colors(n: int, seed: int = 0) -> np.ndarray:
+    """Generates n random CIELAB colors, uniformly distributed over the sRGB gamut."""
+    rgb = np.random.default_rng(seed).random((n, 3))
+    return spaces.rgb2lab(rgb)
+
+
+def benchmark_color_problem(
+    preset: str,
+    width: int,
+    height: int,
+    colors_factor: float = 1.0,
+    seed: int = 0,
+    repeat: int = 1,
+    max_dense_bytes: int = DEFAULT_MAX_DENSE_BYTES,
+    max_solve_cells: int = DEFAULT_MAX_SOLVE_CELLS,
+) -> ColorProblemResult:
+    """
+    Times each step of solving a synthetic color problem: the coordinate and color distance
+    matrices, the dense cost matrix and linear_sum_assignment.
+
+    The cost matrix is skipped if it would take more than max_dense_bytes, and solving is skipped
+    for grids of more than max_solve_cells cells.
+    """
+    key_objects = load_preset(preset, width, height)
+    n_colors = max(width * height, round(width * height * colors_factor))
+    color_matrix = ColorMatrix(synthetic_lab_colors(n_colors, seed), ColorSpace.CIELAB)
+    steps = {}
+
+    space_dists, steps["create_coordinate_distance_matrix"] = measure(
+        lambda: create_coordinate_distance_matrix(width, height, key_objects), repeat
+    )
+    color_dists, steps["create_color_distance_matrix"] = measure(
+        lambda: create_color_distance_matrix(color_matrix, ColorSpace.CIELAB, key_objects), repeat
+    )
+
+    cost = None
+    if width * height * n_colors * np.dtype(np.float64).itemsize <= max_dense_bytes:
+        cost_matrix, steps["create_cost_matrix"] = measure(
+            lambda: create_cost_matrix(color_dists, space_dists), repeat
+        )
+        if width * height <= max_solve_cells:
+            # the solver's working memory is allocated in C++, out of sight of tracemalloc
+            (rows, cols), steps["linear_sum_assignment"] = measure(
+                lambda: linear_sum_assignment(cost_matrix), repeat, trace_memory=False
+            )
+            cost = float(cost_matrix[rows, cols].sum())
+        del cost_matrix
+
+    return ColorProblemResult(preset, width, height, n_colors, steps, cost)
+
+
+def write_results(path: Path, results: list[ColorProblemResult]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    document = {
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": [r.to_dict() for r in results],
+    }
+    path.write_text(json.dumps(document, indent=2) + "\n", encoding="utf-8")
+
+
+def read_results(path: Path) -> list[ColorProblemResult]:
+    document = json.loads(path.read_text(encoding="utf-8"))
+    return [ColorProblemResult.from_dict(r) for r in document["results"]]
+
+
+def compare_results(
+    baseline: list[ColorProblemResult],
+    current: list[ColorProblemResult],
+    time_tolerance: float = 0.25,
+    memory_tolerance: float = 0.1,
+    min_seconds: float = 0.005,
+) -> list[str]:
+    """
+    Returns a description of every regression of current against baseline: steps that got slower
+    by more than time_tolerance (and min_seconds), traced memory that grew by more than
+    memory_tolerance and assignments whose cost went up.
+    """
+    baseline_by_key = {r.key: r for r in baseline}
+    regressions = []
+    for result in current:
+        base = baseline_by_key.get(result.key)
+        if base is None:
+            continue
+        for name, step in result.steps.items():
+            base_step = base.steps.get(name)
+            if base_step is None:
+                continue
+            if (
+                step.seconds > base_step.seconds * (1 + time_tolerance)
+                and step.seconds - base_step.seconds > min_seconds
+            ):
+                regressions.append(
+                    f"{result.key} {name}: {base_step.seconds:.4f}s -> {step.seconds:.4f}s"
+                )
+            if (
+                step.peak_bytes is not None
+                and base_step.peak_bytes is not None
+                and step.peak_bytes > base_step.peak_bytes * (1 + memory_tolerance)
+            ):
+                regressions.append(
+                    f"{result.key} {name}: {base_step.peak_bytes / 2**20:.1f}MiB ->"
+                    f" {step.peak_bytes / 2**20:.1f}MiB"
+                )
+        if result.cost is not None and base.cost is not None:
+            if result.cost > base.cost + 1e-9 * max(1.0, abs(base.cost)):
+                regressions.append(f"{result.key} cost: {base.cost:.6g} -> {result.cost:.6g}")
+    return regressions
+
+
+def format_result(result: ColorProblemResult) -> str:
+    lines = [result.key]
+    for name in COLOR_PROBLEM_STEPS:
+        step = result.steps.get(name)
+        if step is None:
+            lines.append(f"  {name + ':':36} skipped")
+            continue
+        memory = "" if step.peak_bytes is None else f", {step.peak_bytes / 2**20:.1f}MiB"
+        lines.append(f"  {name + ':':36} {step.seconds:.4f}s{memory}")
+    if result.cost is not None:
+        lines.append(f"  {'cost:':36} {result.cost:.6g}")
+    return "\n".join(lines)
+
+
+def report_regressions(regressions: list[str]):
+    if not regressions:
+        typer.echo(format_info("no regressions"))
+        return
+    for regression in regressions:
+        typer.echo(format_error(f"regression: {regression}"))
+    raise typer.Exit(code=1)
+
+
+@app.command("color-problem")
+def color_problem_benchmark(
+    size: List[str] = typer.Option(
+        DEFAULT_COLOR_PROBLEM_SIZES,
+        "--size",
+        "-s",
+        help="Collage dimensions to benchmark, specified as nxm (repeatable)",
+    ),
+    preset: List[str] = typer.Option(
+        [], "--preset", "-p", help="Presets to benchmark (repeatable, defaults to every preset)"
+    ),
+    colors_factor: float = typer.Option(
+        1.0, min=1.0, help="Number of synthetic colors, as a multiple of the number of cells"
+    ),
+    seed: int = typer.Option(0, help="Random seed for generating colors"),
+    repeat: int = typer.Option(1, min=1, help="Time each step this many times, keeping the best"),
+    max_dense_mb: int = typer.Option(
+        DEFAULT_MAX_DENSE_BYTES // 2**20,
+        help="Skip building dense cost matrices larger than this many MiB",
+    ),
+    max_solve_cells: int = typer.Option(
+        DEFAULT_MAX_SOLVE_CELLS, help="Skip linear_sum_assignment for grids with more cells"
+    ),
+    output: Optional[Path] = typer.Option(
+        None, "--output", "-o", dir_okay=False, help="Write the results to this file as JSON"
+    ),
+    save_baseline: bool = typer.Option(
+        False,
+        "--save-baseline",
+        help=f"Store the results as the baseline ({COLOR_PROBLEM_BASELINE})",
+    ),
+    check: bool = typer.Option(
+        False, "--check", help="Compare the results against the stored baseline"
+    ),
+):
+    """Time the steps of the color assignment problem over synthetic colors, offline."""
+    if check and not save_baseline and not COLOR_PROBLEM_BASELINE.exists():
+        typer.echo(
+            format_error(
+                f"no baseline at {COLOR_PROBLEM_BASELINE}, run with --save-baseline first (e.g."
+                " before making changes) to store one"
+            )
+        )
+        raise typer.Exit(code=1)
+    shapes = []
+    for s in size:
+        collage_size = CollageSizeParam().convert(s)
+        shapes.append((collage_size.width, collage_size.height))
+
+    results = []
+    for preset_name in preset or preset_names():
+        for width, height in shapes:
+            result = benchmark_color_problem(
+                preset_name,
+                width,
+                height,
+                colors_factor=colors_factor,
+                seed=seed,
+                repeat=repeat,
+                max_dense_bytes=max_dense_mb * 2**20,
+                max_solve_cells=max_solve_cells,
+            )
+            typer.echo(format_result(result))
+            results.append(result)
+
+    if output is not None:
+        write_results(output, results)
+    if save_baseline:
+        write_results(COLOR_PROBLEM_BASELINE, results)
+    if check:
+        report_regressions(compare_results(read_results(COLOR_PROBLEM_BASELINE), results))
+
+
+@dataclass
+class ImportTime:
+    module: str
+    # cumulative import time of module, including everything it imports
+    seconds: float
+    # self import time of every module imported along with it
+    modules: dict[str, float]
+
+    def imported(self, package: str) -> bool:
+        return any(name == package or name.startswith(f"{package}.") for name in self.modules)
+
+
+def measure_import_time(module: str) -> ImportTime:
+    """Imports module in a fresh interpreter, timing it with python -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    seconds = 0.0
+    # lines look like "import time:  <self us> | <cumulative us> | <indented name>"
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        modules[name] = int(fields[0]) / 1e6
+        if name == module:
+            seconds = int(fields[1]) / 1e6
+    return ImportTime(module, seconds, modules)
+
+
+@app.command("import-time")
+def import_time_benchmark(
+    module: str = typer.Option(IMPORT_TIME_MODULE, help="Module to time the import of"),
+    repeat: int = typer.Option(
+        5, min=1, help="Import the module this many times in fresh interpreters, keeping the best"
+    ),
+    budget_ms: float = typer.Option(
+        DEFAULT_IMPORT_TIME_BUDGET_MS, help="Flag imports slower than this many milliseconds"
+    ),
+    top: int = typer.Option(10, min=0, help="Show this many of the slowest modules imported"),
+    check: bool = typer.Option(
+        False,
+        "--check",
+        help=(
+            "Exit with an error if the import is over budget or imports a dependency that should"
+            " only be imported when needed (e.g. for CI)"
+        ),
+    ),
+):
+    """Time how long the CLI takes to import, and check that heavy dependencies load lazily."""
+    result = min((measure_import_time(module) for _ in range(repeat)), key=lambda r: r.seconds)
+    typer.echo(
+        f"{module} imported in {result.seconds * 1000:.1f}ms (budget {budget_ms:.0f}ms),"
+        f" {len(result.modules)} modules"
+    )
+    for name, seconds in sorted(result.modules.items(), key=lambda m: -m[1])[:top]:
+        typer.echo(f"  {name + ':':48} {seconds * 1000:.1f}ms")
+
+    regressions = [
+        f"{module} imports {package}, which should only be imported when needed"
+        for package in LAZY_IMPORTS
+        if result.imported(package)
+    ]
+    if result.seconds * 1000 > budget_ms:
+        regressions.append(
+            f"{module} import: {result.seconds * 1000:.1f}ms, over budget of {budget_ms:.0f}ms"
+        )
+    if check:
+        report_regressions(regressions)
+    else:
+        for regression in regressions:
+            typer.echo(format_error(regression))
+
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., exists=True, dir_okay=False, help="Baseline results"),
+    results: Path = typer.Argument(..., exists=True, dir_okay=False, help="Results to check"),
+    time_tolerance: float = typer.Option(
+        0.25, help="Flag steps that got slower by more than this fraction"
+    ),
+    memory_tolerance: float = typer.Option(
+        0.1, help="Flag steps whose peak memory grew by more than this fraction"
+    ),
+):
+    """Compare two sets of color-problem benchmark results and flag regressions."""
+    report_regressions(
+        compare_results(
+            read_results(baseline),
+            read_results(results),
+            time_tolerance=time_tolerance,
+            memory_tolerance=memory_tolerance,
+        )
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -1,16 +1,40 @@
 from __future__ import annotations
 
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, Optional, Sequence, Union
 
-import colorgram
-import imagehash  # type: ignore
 import numpy as np
-from PIL import Image
-from skimage import color as spaces
 
-from spy_collage.color_problem import ColorMatrix, ColorSpace, KeyObject, solve_colors
+from spy_collage import metrics, render
+from spy_collage.color_problem import ColorMatrix, ColorSpace, KeyObject, Solver, solve_colors
+from spy_collage.feature_store import FeatureStore
+from spy_collage.incremental import solve_colors_incremental
+from spy_collage.models import FeatureExtractor
+from spy_collage.pipeline import chunked, completed, ordered
+
+if TYPE_CHECKING:
+    # the imaging libraries are slow to import, so they are imported where covers are read
+    import imagehash  # type: ignore
+    from PIL import Image
+
+# identifies each feature extraction algorithm in the feature store, bump when one changes
+EXTRACTOR_VERSIONS = {
+    FeatureExtractor.colorgram: "colorgram-1",
+    FeatureExtractor.numpy: "numpy-1",
+}
+
+# the numpy extractor samples covers at roughly this many pixels per side
+SAMPLE_SIZE = 64
+
+# number of images handed to a feature extraction process at once when reading from a stream
+STREAM_BATCH_SIZE = 8
+
+RGB = tuple[int, int, int]
 
 
 @dataclass
@@ -20,18 +44,24 @@ class ImageFeatures:
     __image: Optional[Image.Image]
     __image_phash: Optional[imagehash.ImageHash]
 
-    def is_likely_duplicate(self, f: ImageFeatures) -> bool:
-        return np.array_equal(self.features, f.features) and (self.image_phash == f.image_phash)
+    def is_likely_duplicate(self, f: ImageFeatures, hamming_threshold: int = 0) -> bool:
+        return np.array_equal(self.features, f.features) and (
+            self.image_phash - f.image_phash <= hamming_threshold
+        )
 
     @property
     def image(self):
         if self.__image is None:
+            from PIL import Image
+
             self.__image = Image.open(self.image_path)
         return self.__image
 
     @property
     def image_phash(self):
         if self.__image_phash is None:
+            import imagehash  # type: ignore
+
             self.__image_phash = imagehash.phash(self.image)
         return self.__image_phash
 
@@ -43,27 +73,348 @@ class ImageFeatures:
         return ImageFeatures(np.asarray(d["features"]), Path(d["image_path"]), None, None)
 
 
-def get_features(image_path) -> ImageFeatures:
-    colors: list[colorgram.Color] = colorgram.extract(image_path, 1)
-    features = []
-    for c in colors:
-        rgb = list(c.rgb)
-        lab = spaces.rgb2lab(rgb)
-        features.extend(lab)
-    return ImageFeatures(np.asarray(features), image_path, None, None)
+class BKTree:
+    """
+    A Burkhard-Keller tree of image perceptual hashes, supporting lookups of all hashes within a
+    given hamming distance without comparing against every hash in the tree.
+    """
+
+    def __init__(self) -> None:
+        self.__root: Optional[tuple[ImageFeatures, dict[int, Any]]] = None
+
+    def add(self, feature: ImageFeatures):
+        node: tuple[ImageFeatures, dict[int, Any]] = (feature, {})
+        if self.__root is None:
+            self.__root = node
+            return
+        current = self.__root
+        while True:
+            distance = current[0].image_phash - feature.image_phash
+            if distance not in current[1]:
+                current[1][distance] = node
+                return
+            current = current[1][distance]
+
+    def any_within(self, feature: ImageFeatures, max_distance: int) -> bool:
+        if self.__root is None:
+            return False
+        stack = [self.__root]
+        while stack:
+            candidate, children = stack.pop()
+            distance = candidate.image_phash - feature.image_phash
+            if distance <= max_distance:
+                return True
+            # by the triangle inequality, matches can only be below children at these distances
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return False
+
+
+class DuplicateIndex:
+    """
+    Finds likely duplicate album covers (see ImageFeatures.is_likely_duplicate) without comparing
+    every new cover against every cover already added.
+
+    Duplicates must have identical color features, so covers are bucketed by their features and a
+    new cover is only compared against its own bucket, through a BK-tree of perceptual hashes.
+    Like the pairwise comparison, a cover's image is only loaded and hashed once another cover
+    with the same features turns up.
+    """
+
+    def __init__(self, hamming_threshold: int = 0) -> None:
+        self.hamming_threshold = hamming_threshold
+        # bucket key -> lone unhashed feature, or a tree once a bucket has been compared against
+        self.__buckets: dict[tuple, Union[ImageFeatures, BKTree]] = {}
+
+    @staticmethod
+    def __bucket_key(feature: ImageFeatures) -> tuple:
+        # adding 0.0 normalizes -0.0 to 0.0, which np.array_equal treats as equal
+        return tuple((np.asarray(feature.features, dtype=np.float64) + 0.0).tolist())
+
+    def add(self, feature: ImageFeatures) -> bool:
+        """Adds feature to the index unless it is a likely duplicate, returning whether it was."""
+        key = self.__bucket_key(feature)
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            self.__buckets[key] = feature
+            return True
+        if isinstance(bucket, ImageFeatures):
+            tree = BKTree()
+            tree.add(bucket)
+            self.__buckets[key] = bucket = tree
+        if bucket.any_within(feature, self.hamming_threshold):
+            return False
+        bucket.add(feature)
+        return True
+
+
+def dominant_color_colorgram(image_path: Path) -> RGB:
+    import colorgram
+
+    color: colorgram.Color = colorgram.extract(image_path, 1)[0]
+    return color.rgb
+
+
+def dominant_color_numpy(image_path: Path, sample_size: Optional[int] = SAMPLE_SIZE) -> RGB:
+    """
+    Returns the dominant color of an image using the same algorithm as colorgram, vectorized with
+    numpy.
+
+    Unless sample_size is None, the image is first downsampled to roughly sample_size pixels per
+    side. For JPEGs this happens while decoding (draft mode), so the full image is never decoded.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as cover:
+        if sample_size is not None:
+            cover.draft("RGB", (sample_size, sample_size))
+        image: Image.Image = cover
+        # convert before reducing, since reduce doesn't support palette or bilevel images
+        if image.mode not in ("RGB", "RGBA", "RGBa"):
+            image = image.convert("RGB")
+        if sample_size is not None:
+            factor = min(image.size) // sample_size
+            if factor > 1:
+                image = image.reduce(factor)
+        pixels = np.asarray(image)[..., :3].reshape(-1, 3).astype(np.int64)
+
+    r, g, b = pixels.T
+    most = pixels.max(axis=1)
+    least = pixels.min(axis=1)
+    diff = most - least
+    divisor = np.maximum(diff, 1)
+    hue = np.where(
+        most == r,
+        (g - b) * 255 // divisor + np.where(g < b, 1530, 0),
+        np.where(most == g, (b - r) * 255 // divisor + 510, (r - g) * 255 // divisor + 1020),
+    )
+    hue = np.where(diff == 0, 0, hue // 6)
+    lightness = (most + least) >> 1
+    luminance = (r * 0.2126 + g * 0.7152 + b * 0.0722).astype(np.int64)
+
+    # bucket pixels by the top two bits of luminance, hue and lightness, like colorgram does
+    top_two_bits = 0b11000000
+    packed = (
+        ((luminance & top_two_bits) << 4) | ((hue & top_two_bits) << 2) | (lightness & top_two_bits)
+    )
+    counts = np.bincount(packed)
+    # colorgram stable-sorts buckets by descending count, so ties go to the lowest bucket, which is
+    # also the one argmax picks
+    dominant = int(np.argmax(counts))
+    in_bucket = packed == dominant
+    return tuple(int(c) for c in pixels[in_bucket].sum(axis=0) // counts[dominant])  # type: ignore
+
+
+DOMINANT_COLOR_EXTRACTORS: dict[FeatureExtractor, Callable[[Path], RGB]] = {
+    FeatureExtractor.colorgram: dominant_color_colorgram,
+    FeatureExtractor.numpy: dominant_color_numpy,
+}
+
+
+def get_features(
+    image_path, extractor: FeatureExtractor = FeatureExtractor.colorgram
+) -> ImageFeatures:
+    return get_features_batch([image_path], extractor)[0]
+
+
+def get_features_batch(
+    image_paths: Sequence[Path], extractor: FeatureExtractor = FeatureExtractor.colorgram
+) -> list[ImageFeatures]:
+    """Extracts the features of several images, converting their colors to CIELAB in one call."""
+    from skimage import color as spaces
+
+    extract = DOMINANT_COLOR_EXTRACTORS[extractor]
+    rgb = [list(extract(p)) for p in image_paths]
+    lab = spaces.rgb2lab(np.asarray(rgb))
+    return [ImageFeatures(features, p, None, None) for p, features in zip(image_paths, lab)]
+
+
+def complete_features_batch(
+    batch: Sequence[tuple[Path, Optional[np.ndarray]]],
+    extractor: FeatureExtractor = FeatureExtractor.colorgram,
+) -> list[ImageFeatures]:
+    """Returns the features of (image path, known features) pairs, extracting any unknown ones."""
+    missing = [p for p, features in batch if features is None]
+    extracted = iter(get_features_batch(missing, extractor) if missing else [])
+    return [
+        next(extracted) if features is None else ImageFeatures(features, p, None, None)
+        for p, features in batch
+    ]
+
+
+def _worker_context() -> multiprocessing.context.BaseContext:
+    # the workers are started while other pipeline stages are running in threads, whose locks a
+    # forked process could inherit held, so they are started from a clean process instead
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _iter_completed_features(
+    batches: Iterable[list[tuple[Path, Optional[np.ndarray]]]],
+    workers: int,
+    extractor: FeatureExtractor,
+) -> Iterator[ImageFeatures]:
+    if workers == 1:
+        for batch in batches:
+            missing = sum(features is None for _, features in batch)
+            metrics.count("covers_decoded", missing)
+            metrics.count("features_extracted", missing)
+            yield from complete_features_batch(batch, extractor)
+        return
+
+    # the worker processes are only started once a batch needs features extracted
+    executor: Optional[ProcessPoolExecutor] = None
+
+    def submit(batch: list[tuple[Path, Optional[np.ndarray]]]) -> Future:
+        nonlocal executor
+        missing = sum(features is None for _, features in batch)
+        # covers are decoded in the worker processes, so they are counted here
+        metrics.count("covers_decoded", missing)
+        metrics.count("features_extracted", missing)
+        if not missing:
+            return completed(complete_features_batch(batch, extractor))
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=_worker_context())
+        return executor.submit(complete_features_batch, batch, extractor)
+
+    try:
+        for features in ordered(map(submit, batches), window=4 * workers):
+            yield from features
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def iter_features(
+    image_paths: Iterable[Path],
+    jobs: Optional[int] = None,
+    extractor: FeatureExtractor = FeatureExtractor.colorgram,
+) -> Iterator[ImageFeatures]:
+    """
+    Yields the features of each image in order, extracting them in up to jobs worker processes
+    (by default, one per CPU core).
+
+    image_paths may be a stream, in which case images are handed to the workers in small batches
+    as they arrive.
+    """
+    workers = jobs or os.cpu_count() or 1
+    batch_size = STREAM_BATCH_SIZE
+    if isinstance(image_paths, Sequence):
+        workers = max(1, min(workers, len(image_paths)))
+        # hand out small batches to amortize inter-process overhead while keeping results flowing
+        batch_size = max(1, min(16, len(image_paths) // (4 * workers)))
+    uncached: Iterator[tuple[Path, Optional[np.ndarray]]] = ((p, None) for p in image_paths)
+    yield from _iter_completed_features(chunked(uncached, batch_size), workers, extractor)
+
+
+def iter_cached_features(
+    image_paths: Iterable[Path],
+    store: FeatureStore,
+    jobs: Optional[int] = None,
+    extractor: FeatureExtractor = FeatureExtractor.colorgram,
+) -> Iterator[ImageFeatures]:
+    """
+    Yields the features of each image in order like iter_features, but reads them from store
+    where possible and only extracts (and stores) those that are missing.
+    """
+    missing: deque[bool] = deque()
+
+    def look_up() -> Iterator[tuple[Path, Optional[np.ndarray]]]:
+        for image_path in image_paths:
+            features = store.get(image_path)
+            missing.append(features is None)
+            yield image_path, features
+
+    workers = jobs or os.cpu_count() or 1
+    batches = chunked(look_up(), STREAM_BATCH_SIZE)
+    for features in _iter_completed_features(batches, workers, extractor):
+        if missing.popleft():
+            store.put(features.image_path, features.features)
+        else:
+            metrics.count("feature_cache_hits")
+        yield features
+    store.commit()
 
 
 def lap_collage(
-    features: list[ImageFeatures], shape: tuple[int, int], key_objects: list[KeyObject]
+    features: list[ImageFeatures],
+    shape: tuple[int, int],
+    key_objects: list[KeyObject],
+    solver: Solver = Solver.hungarian,
+    compare_exact: bool = False,
+    candidate_factor: Optional[float] = None,
+    output: Optional[Path] = None,
+    cell_size: Optional[int] = None,
+    thumbnails: Optional[render.ThumbnailCache] = None,
+    incremental_state: Optional[Path] = None,
+    space_distances: Optional[np.ndarray] = None,
 ):
-    width, height = shape
+    """
+    Arranges the album covers of features into a collage of the given shape around key_objects.
+
+    If incremental_state is given, the arrangement is solved exactly by repairing the one saved
+    there by the last run (see solve_colors_incremental), and the new arrangement is saved there.
+    space_distances may hold the distances from each cell to each key object if already known.
+
+    Every cover is resized to cell_size pixels square, which defaults to the width of the first
+    cover. The collage is saved to output if given, otherwise it is shown. Outputs ending in .dzi
+    are written as a Deep Zoom tile pyramid (see render.write_deep_zoom), any other output is saved
+    as a single image (see render.save_bands).
+    """
     color_matrix = ColorMatrix(np.asarray([f.features for f in features]), ColorSpace.CIELAB)
-    _, positions = solve_colors(shape, color_matrix, ColorSpace.CIELAB, key_objects)
+    if incremental_state is not None:
+        result = solve_colors_incremental(
+            shape,
+            color_matrix,
+            [str(f.image_path) for f in features],
+            ColorSpace.CIELAB,
+            key_objects,
+            incremental_state,
+            space_distances=space_distances,
+        )
+        print(result)
+        assignment = result.assignment
+    else:
+        assignment = solve_colors(
+            shape,
+            color_matrix,
+            ColorSpace.CIELAB,
+            key_objects,
+            solver=solver,
+            compare_exact=compare_exact,
+            candidate_factor=candidate_factor,
+            space_distances=space_distances,
+        )
+    if assignment.gap is not None and solver != Solver.hungarian:
+        print(
+            f"Solved with {solver.value} solver, cost {assignment.cost:.6g} (exact"
+            f" {assignment.exact_cost:.6g}, gap {assignment.gap:.4%})"
+        )
+    cover_paths = [features[i].image_path for i in assignment.colors]
+    with metrics.phase("render"):
+        render_collage(cover_paths, shape, output, cell_size, thumbnails)
 
-    cover_res = features[0].image.width
-    collage = Image.new("RGB", (width * cover_res, height * cover_res), "white")
-    for i in range(height):
-        for j in range(width):
-            collage.paste(features[positions[j * height + i]].image, (j * cover_res, i * cover_res))
 
-    collage.show()
+def render_collage(
+    cover_paths: list[Path],
+    shape: tuple[int, int],
+    output: Optional[Path] = None,
+    cell_size: Optional[int] = None,
+    thumbnails: Optional[render.ThumbnailCache] = None,
+):
+    """Renders the covers of a solved collage, see lap_collage."""
+    width, height = shape
+    if cell_size is None:
+        cell_size = render.cover_size(cover_paths[0])
+    if output is not None and output.suffix.lower() == ".dzi":
+        render.render_deep_zoom(output, cover_paths, shape, cell_size, thumbnails=thumbnails)
+        return
+
+    size = (width * cell_size, height * cell_size)
+    bands = render.iter_bands(cover_paths, shape, cell_size, thumbnails=thumbnails)
+    if output is not None:
+        render.save_bands(output, size, bands)
+    else:
+        render.assemble(bands, size).show()
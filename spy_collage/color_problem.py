@@ -1,14 +1,17 @@
+from __future__ import annotations
+
 import math
 from abc import ABC, abstractmethod
 from colorsys import hsv_to_rgb
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Sequence
+from typing import Any, Callable, Iterator, Optional, Sequence, Union
 
 import numpy as np
-from einops import rearrange
-from scipy.optimize import linear_sum_assignment
-from skimage import color as spaces
+
+from spy_collage import metrics
+
+# skimage, scipy and einops are slow to import, so the functions that use them import them
 
 
 class ColorSpace(Enum):
@@ -29,6 +32,8 @@ class ColorMatrix:
 def convert_space(color: np.ndarray, from_space: ColorSpace, to_space: ColorSpace) -> ColorMatrix:
     if from_space == to_space:
         return ColorMatrix(color, to_space)
+    from skimage import color as spaces
+
     out = None
     if from_space == ColorSpace.CIELAB:
         out = spaces.lab2rgb(
@@ -44,6 +49,11 @@ def convert_space(color: np.ndarray, from_space: ColorSpace, to_space: ColorSpac
     return ColorMatrix(out, to_space)
 
 
+def _grid(width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns broadcastable (width, 1) and (1, height) integer coordinate arrays."""
+    return np.arange(width).reshape(width, 1), np.arange(height).reshape(1, height)
+
+
 class KeyObject(ABC):
     def __init__(self, color: np.ndarray, color_space: ColorSpace) -> None:
         # @todo shape checks
@@ -74,6 +84,20 @@ class KeyObject(ABC):
     def distanceFrom(self, x: int, y: int) -> Any:
         pass
 
+    def distance_field(self, width: int, height: int) -> np.ndarray:
+        """
+        Returns a (width, height) array holding the distance from every grid cell to this key
+        object.
+
+        Subclasses should override this with a vectorized implementation; the default falls back
+        to calling distanceFrom once per cell.
+        """
+        field = np.empty([width, height])
+        for i in range(width):
+            for j in range(height):
+                field[i][j] = self.distanceFrom(i, j)
+        return field
+
 
 class KeyPoint(KeyObject):
     def __init__(
@@ -88,6 +112,12 @@ class KeyPoint(KeyObject):
     def distanceFrom(self, x: int, y: int) -> Any:
         return math.dist([x, y], [self.x, self.y])
 
+    def distance_field(self, width: int, height: int) -> np.ndarray:
+        xs, ys = _grid(width, height)
+        dx = xs - self.x
+        dy = ys - self.y
+        return np.sqrt(dx * dx + dy * dy)
+
     def __repr__(self) -> str:
         return f"KeyPoint({self.x}, {self.y}, {self.__original_color}, {self.__original_space})"
 
@@ -128,6 +158,25 @@ class KeyLine(KeyObject):
 
         return dist
 
+    def distance_field(self, width: int, height: int) -> np.ndarray:
+        # mirrors distanceFrom operation for operation so that results are bit-identical
+        xs, ys = _grid(width, height)
+        px = self.x2 - self.x1
+        py = self.y2 - self.y1
+
+        norm = px * px + py * py
+
+        u = ((xs - self.x1) * px + (ys - self.y1) * py) / float(norm)
+        u = np.clip(u, 0, 1)
+
+        x3 = self.x1 + u * px
+        y3 = self.y1 + u * py
+
+        dx = x3 - xs
+        dy = y3 - ys
+
+        return (dx * dx + dy * dy) ** 0.5
+
 
 def mkline(x1, y1, x2, y2, r, g, b, *, width, height):
     return KeyLine(
@@ -143,53 +192,319 @@ def mkpoint(x, y, r, g, b, *, width, height):
     return KeyPoint(int(x * width), int(y * height), np.array([r, g, b]))
 
 
-def mkspectrum(x1, y1, x2, y2, h1, h2, n, *, width, height) -> list[KeyPoint]:
+def spectrum_points(x1, y1, x2, y2, h1, h2, n) -> list[tuple[float, float, list[int]]]:
+    """
+    Returns the (x, y, RGB color) of n points evenly spaced from (x1, y1) to (x2, y2), with hues
+    evenly spaced from h1 to h2.
+    """
+
     def rgb_norm(c):
         return [int(v * 255) for v in c]
 
     if n < 2:
         raise ValueError("n must be > 1")
-    kp: list[KeyPoint] = [
-        mkpoint(x1, y1, *rgb_norm(hsv_to_rgb(h1, 1, 1)), width=width, height=height)
-    ]
+    points = [(x1, y1, rgb_norm(hsv_to_rgb(h1, 1, 1)))]
     x, y, h = x1, y1, h1
     dx = (x2 - x1) / (n - 1)
     dy = (y2 - y1) / (n - 1)
     dh = (h2 - h1) / (n - 1)
     for _ in range(n - 1):
         x, y, h = x + dx, y + dy, h + dh
-        kp.append(mkpoint(x, y, *rgb_norm(hsv_to_rgb(h, 1, 1)), width=width, height=height))
-    return kp
+        points.append((x, y, rgb_norm(hsv_to_rgb(h, 1, 1))))
+    return points
+
+
+def mkspectrum(x1, y1, x2, y2, h1, h2, n, *, width, height) -> list[KeyPoint]:
+    return [
+        mkpoint(x, y, *rgb, width=width, height=height)
+        for x, y, rgb in spectrum_points(x1, y1, x2, y2, h1, h2, n)
+    ]
+
+
+def point_distance_fields(points: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    Returns the (p, width, height) distance fields of p key points at the integer (x, y) rows of
+    points, identical to those of KeyPoint.distance_field.
+    """
+    xs, ys = _grid(width, height)
+    dx = xs - points[:, 0, np.newaxis, np.newaxis]
+    dy = ys - points[:, 1, np.newaxis, np.newaxis]
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def line_distance_fields(lines: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    Returns the (l, width, height) distance fields of l key lines at the integer (x1, y1, x2, y2)
+    rows of lines, identical to those of KeyLine.distance_field.
+    """
+    xs, ys = _grid(width, height)
+    x1, y1, x2, y2 = (lines[:, i, np.newaxis, np.newaxis] for i in range(4))
+    px = x2 - x1
+    py = y2 - y1
+
+    norm = px * px + py * py
+
+    u = ((xs - x1) * px + (ys - y1) * py) / norm.astype(float)
+    u = np.clip(u, 0, 1)
+
+    x3 = x1 + u * px
+    y3 = y1 + u * py
+
+    dx = x3 - xs
+    dy = y3 - ys
+
+    return (dx * dx + dy * dy) ** 0.5
 
 
 def create_coordinate_distance_matrix(
     width: int, height: int, key_points: list[KeyObject]
 ) -> np.ndarray:
-    distances = np.empty([width, height, len(key_points)])
-    for i in range(width):
-        for j in range(height):
-            for k in range(len(key_points)):
-                distances[i][j][k] = key_points[k].distanceFrom(i, j)
+    from einops import rearrange
+
+    distances = np.stack([kp.distance_field(width, height) for kp in key_points], axis=-1)
     new_distances = rearrange(distances, "w h k -> (w h) k")
     return new_distances
 
 
+def pairwise_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns the (n, k) matrix of euclidean distances between the rows of a (n, 3) and b (k, 3).
+
+    Each distance is computed as a stacked dot product so results agree with calling
+    np.linalg.norm on every pair individually up to floating point rounding.
+    """
+    diffs = a[:, np.newaxis, :] - b[np.newaxis, :, :]
+    return np.sqrt(np.matmul(diffs[..., np.newaxis, :], diffs[..., :, np.newaxis])[..., 0, 0])
+
+
+def stack_key_colors(key_points: Sequence[KeyObject], color_space: ColorSpace) -> np.ndarray:
+    """Returns the colors of the given key objects in color_space as a (k, 3) matrix."""
+    return np.stack([np.asarray(kp.getColor(color_space).matrix) for kp in key_points])
+
+
 def create_color_distance_matrix(
     colors: ColorMatrix, distance_space: ColorSpace, key_points: list[KeyObject]
 ) -> np.ndarray:
-    distances = np.empty([len(colors), len(key_points)])
-    for i in range(len(colors)):
-        for j in range(len(key_points)):
-            distances[i][j] = key_points[j].color_distance_from(
-                colors.matrix[i], colors.space, distance_space
-            )
-    return distances
+    # convert every color in one batch rather than once per (color, key object) pair
+    converted = convert_space(colors.matrix, colors.space, distance_space)
+    return pairwise_distances(converted.matrix, stack_key_colors(key_points, distance_space))
+
+
+class FactoredCostMatrix:
+    """
+    A (positions x colors) cost matrix stored as the two rank-k factors it is the product of,
+    where k is the number of key objects.
+
+    cost[i, j] is the sum over key objects of the reciprocal distance from position i to the key
+    object times the squared color distance from color j to the key object. Rows, columns,
+    elements and tiles are computed on demand with numpy-style indexing, so the full matrix never
+    needs to be materialized unless a solver requires it (see to_dense).
+    """
+
+    # maximum number of elements to materialize at once when reducing over whole rows
+    block_elements = 1 << 22
+
+    def __init__(
+        self,
+        color_distances: np.ndarray,
+        space_distances: np.ndarray,
+        dtype: Union[type, np.dtype] = np.float64,
+    ) -> None:
+        self.color_factor = np.asarray(color_distances**2, dtype=dtype)
+        self.space_factor = np.asarray(np.reciprocal(np.maximum(space_distances, 1)), dtype=dtype)
 
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.space_factor), len(self.color_factor)
 
-def create_cost_matrix(color_distances: np.ndarray, space_distances: np.ndarray):
-    color_distances_squared = color_distances**2
-    space_reciprocals = np.reciprocal(np.maximum(space_distances, 1))
-    return np.transpose(np.dot(color_distances_squared, np.transpose(space_reciprocals)))
+    @property
+    def dtype(self) -> np.dtype:
+        return self.color_factor.dtype
+
+    def __getitem__(self, key) -> Any:
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, cols = key + (slice(None),) * (2 - len(key))
+        space, color = self.space_factor[rows], self.color_factor[cols]
+        if not isinstance(rows, slice) and not isinstance(cols, slice) and space.ndim == 2:
+            # two index arrays select individual elements, as with numpy fancy indexing
+            return np.einsum("ik,ik->i", space, color)
+        return np.inner(space, color)
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def to_dense(self) -> np.ndarray:
+        return np.transpose(np.dot(self.color_factor, np.transpose(self.space_factor)))
+
+    def select_columns(self, columns: np.ndarray) -> FactoredCostMatrix:
+        selected = FactoredCostMatrix.__new__(FactoredCostMatrix)
+        selected.color_factor = self.color_factor[columns]
+        selected.space_factor = self.space_factor
+        return selected
+
+    def row_blocks(self) -> Iterator[tuple[slice, np.ndarray]]:
+        """Yields (row slice, dense block) pairs covering the matrix a few rows at a time."""
+        n, m = self.shape
+        block_rows = max(1, self.block_elements // max(m, 1))
+        for start in range(0, n, block_rows):
+            rows = slice(start, min(start + block_rows, n))
+            yield rows, self[rows]
+
+    def min(self, axis: int) -> np.ndarray:
+        if axis != 1:
+            raise ValueError("FactoredCostMatrix only supports reducing over rows (axis=1)")
+        return np.concatenate([block.min(axis=1) for _, block in self.row_blocks()])
+
+
+CostMatrix = Union[np.ndarray, FactoredCostMatrix]
+
+
+def create_cost_matrix(color_distances: np.ndarray, space_distances: np.ndarray) -> np.ndarray:
+    return FactoredCostMatrix(color_distances, space_distances).to_dense()
+
+
+class Solver(Enum):
+    hungarian = "hungarian"
+    greedy = "greedy"
+
+
+@dataclass
+class Assignment:
+    """
+    The result of solving a collage assignment problem.
+
+    Cell positions[i] is assigned the color at index colors[i]. If exact_cost is set, it is the
+    cost of the optimal assignment found by the exact (Hungarian) solver.
+    """
+
+    positions: np.ndarray
+    colors: np.ndarray
+    cost: float
+    exact_cost: Optional[float] = None
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        # allow unpacking as `positions, colors = solve_colors(...)`
+        return iter((self.positions, self.colors))
+
+    @property
+    def gap(self) -> Optional[float]:
+        """Relative cost gap against the exact solver, if it was run."""
+        if self.exact_cost is None:
+            return None
+        if self.exact_cost == 0:
+            return 0.0 if self.cost == 0 else math.inf
+        return (self.cost - self.exact_cost) / self.exact_cost
+
+
+def assignment_cost(cost: CostMatrix, positions: np.ndarray, colors: np.ndarray) -> float:
+    return float(cost[positions, colors].sum())
+
+
+def solve_hungarian(cost: CostMatrix) -> tuple[np.ndarray, np.ndarray]:
+    from scipy.optimize import linear_sum_assignment
+
+    # the Hungarian solver needs the full matrix
+    return linear_sum_assignment(np.asarray(cost))
+
+
+def solve_greedy(cost: CostMatrix, max_passes: int = 10) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Approximately solves the assignment problem by greedy seeding followed by 2-opt refinement.
+
+    Rows are seeded in order of their cheapest column, each taking its cheapest unused column. The
+    assignment is then improved by moving rows to a cheaper unused column or swapping the columns
+    of two rows, until a pass makes no improvement or max_passes is reached. Each pass takes
+    O(n * (n + m)) time and no more than O(n + m) additional memory, and a FactoredCostMatrix is
+    never materialized.
+    """
+    n, m = cost.shape
+    assigned = np.empty(n, dtype=np.intp)
+    used = np.zeros(m, dtype=bool)
+    for i in np.argsort(cost.min(axis=1), kind="stable"):
+        row = np.where(used, np.inf, cost[i])
+        assigned[i] = np.argmin(row)
+        used[assigned[i]] = True
+
+    positions = np.arange(n)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n):
+            current = cost[i, assigned[i]]
+
+            # move to a cheaper unused column
+            if n < m:
+                row = np.where(used, np.inf, cost[i])
+                j = np.argmin(row)
+                if row[j] < current:
+                    used[assigned[i]] = False
+                    used[j] = True
+                    assigned[i] = j
+                    current = row[j]
+                    improved = True
+
+            # swap columns with the row that gives the largest improvement
+            deltas = cost[i, assigned] + cost[:, assigned[i]] - current - cost[positions, assigned]
+            k = np.argmin(deltas)
+            if deltas[k] < 0:
+                assigned[i], assigned[k] = assigned[k], assigned[i]
+                improved = True
+        if not improved:
+            break
+
+    return positions, assigned
+
+
+SOLVERS: dict[Solver, Callable[[CostMatrix], tuple[np.ndarray, np.ndarray]]] = {
+    Solver.hungarian: solve_hungarian,
+    Solver.greedy: solve_greedy,
+}
+
+
+def solve_assignment(
+    cost: CostMatrix, solver: Solver = Solver.hungarian, compare_exact: bool = False
+) -> Assignment:
+    """
+    Assigns each row (grid cell) of cost to a distinct column (color) using the given solver.
+
+    If compare_exact is set and the solver is approximate, the exact solver is also run so that
+    the result can report its cost gap.
+    """
+    positions, colors = SOLVERS[solver](cost)
+    total = assignment_cost(cost, positions, colors)
+    if solver == Solver.hungarian:
+        return Assignment(positions, colors, total, exact_cost=total)
+
+    exact_cost = None
+    if compare_exact:
+        exact_cost = assignment_cost(cost, *solve_hungarian(cost))
+    return Assignment(positions, colors, total, exact_cost=exact_cost)
+
+
+def select_candidates(
+    color_distances: np.ndarray, n_positions: int, factor: float = 4
+) -> np.ndarray:
+    """
+    Returns the sorted indices of a subset of colors that are likely to appear in the optimal
+    assignment of n_positions grid cells.
+
+    Costs grow with the squared color distance to each key object, so colors far from every key
+    object are dominated by closer ones. The subset is the union of per-key-object shortlists of
+    the nearest colors, grown until it holds at least factor * n_positions colors (or every
+    color). Since it always holds at least n_positions colors, solving over the subset still
+    gives a feasible assignment.
+    """
+    n_colors, n_key_objects = color_distances.shape
+    target = min(n_colors, max(n_positions, math.ceil(factor * n_positions)))
+    per_key_object = math.ceil(target / n_key_objects)
+    while per_key_object < n_colors:
+        shortlists = np.argpartition(color_distances, per_key_object - 1, axis=0)
+        candidates = np.unique(shortlists[:per_key_object])
+        if len(candidates) >= target:
+            return candidates
+        per_key_object *= 2
+    return np.arange(n_colors)
 
 
 def solve_colors(
@@ -197,7 +512,26 @@ def solve_colors(
     colors: ColorMatrix,
     distance_space: ColorSpace,
     key_points: Sequence[KeyObject],
-):
+    solver: Solver = Solver.hungarian,
+    compare_exact: bool = False,
+    candidate_factor: Optional[float] = None,
+    cost_dtype: Union[type, np.dtype] = np.float64,
+    space_distances: Optional[np.ndarray] = None,
+) -> Assignment:
+    """
+    Assigns a color to each cell of a grid of the given shape so that colors end up close to the
+    key objects of similar color.
+
+    If candidate_factor is set, colors are first pruned with select_candidates to roughly
+    candidate_factor times the number of cells before solving. Pruning is a heuristic, so any
+    reported gap against the exact solver is relative to the pruned problem.
+
+    The cost matrix is kept factored and is only materialized by solvers that need it. Passing
+    cost_dtype=np.float32 halves its memory use at the cost of precision.
+
+    space_distances are the distances from each cell to each key object, which are computed from
+    key_points unless given (e.g. cached by presets.CompiledPreset.distance_fields).
+    """
     key_points = list(key_points)
     if colors.matrix.shape[0] < shape[0] * shape[1]:
         raise ValueError(
@@ -207,7 +541,21 @@ def solve_colors(
         )
     if len(key_points) < 1:
         raise ValueError("Expected at least one key object to base colors around")
-    color_dists = create_color_distance_matrix(colors, distance_space, key_points)
-    space_dists = create_coordinate_distance_matrix(shape[0], shape[1], key_points)
-    position, color = linear_sum_assignment(create_cost_matrix(color_dists, space_dists))
-    return position, color
+    with metrics.phase("distance matrices"):
+        color_dists = create_color_distance_matrix(colors, distance_space, key_points)
+        space_dists = space_distances
+        if space_dists is None:
+            space_dists = create_coordinate_distance_matrix(shape[0], shape[1], key_points)
+
+        cost = FactoredCostMatrix(color_dists, space_dists, dtype=cost_dtype)
+
+        candidates = None
+        if candidate_factor is not None:
+            candidates = select_candidates(color_dists, shape[0] * shape[1], candidate_factor)
+            cost = cost.select_columns(candidates)
+
+    with metrics.phase("solve"):
+        assignment = solve_assignment(cost, solver=solver, compare_exact=compare_exact)
+    if candidates is not None:
+        assignment.colors = candidates[assignment.colors]
+    return assignment
@@ -0,0 +1,181 @@
+import calendar
+import re
+from bisect import insort
+from datetime import datetime
+from typing import Callable, Optional
+
+ISO_DATE = re.compile(r"(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?")
+
+# tracks only count as the same recording if their durations differ by less than this
+DURATION_WINDOW_MS = 2000
+
+TrackKey = tuple[str, tuple[str, ...]]
+
+
+def parse_release_date(release_date: str, now: Optional[datetime] = None) -> datetime:
+    """
+    Parses a Spotify release date, which is a year, year-month or full ISO date, exactly like
+    dateparser.parse but without its overhead.
+
+    Like dateparser, a missing month or day is filled in from the current date.
+    """
+    match = ISO_DATE.fullmatch(release_date)
+    if match is not None:
+        year, month, day = match.groups()
+        now = now or datetime.now()
+        try:
+            year = int(year)
+            month = int(month) if month else now.month
+            if day:
+                return datetime(year, month, int(day))
+            return datetime(year, month, min(now.day, calendar.monthrange(year, month)[1]))
+        except ValueError:
+            pass  # not a valid date after all (e.g. year 0000), leave it to dateparser
+    # dateparser takes a while to import, and is rarely needed
+    import dateparser
+
+    parsed = dateparser.parse(release_date)
+    assert parsed is not None
+    return parsed
+
+
+def normalize_name(name: str) -> str:
+    return " ".join(name.casefold().split())
+
+
+def track_key(track: dict) -> TrackKey:
+    return normalize_name(track["name"]), tuple(a["uri"] for a in track["artists"])
+
+
+def is_duplicate_track(t1: dict, t2: dict) -> bool:
+    matching_name = t1["name"] == t2["name"]
+    matching_artists = len(t1["artists"]) == len(t2["artists"])
+    for a1, a2 in zip(t1["artists"], t2["artists"]):
+        if a1["uri"] != a2["uri"]:
+            matching_artists = False
+    matching_duration = abs(t1["duration_ms"] - t2["duration_ms"]) < DURATION_WINDOW_MS
+
+    return matching_name and matching_artists and matching_duration
+
+
+def needs_discovery(track: dict) -> bool:
+    return not (
+        track["album"]["album_type"] == "album"
+        and ("album_group" not in track["album"] or track["album"]["album_group"] == "album")
+    )
+
+
+class ArtistIndex:
+    """
+    The full album releases of one artist that a single could be discovered on, in catalog order.
+
+    Albums not available in the market or with more than one artist are dropped up front and
+    release dates are parsed once. An album's tracks are only fetched the first time a lookup
+    needs them, and are then indexed by track_key so later lookups don't scan tracklists.
+    """
+
+    def __init__(
+        self,
+        albums: list[dict],
+        fetch_album_tracks: Callable[[str], list[dict]],
+        user_market: Optional[str],
+    ) -> None:
+        self.albums = [
+            album
+            for album in albums
+            if (not user_market or user_market in album["available_markets"])
+            and len(album["artists"]) <= 1
+        ]
+        self.release_dates = [parse_release_date(album["release_date"]) for album in self.albums]
+        self.fetch_album_tracks = fetch_album_tracks
+        self.fetched = [False] * len(self.albums)
+        # every album before this position has been fetched
+        self.first_unfetched = 0
+        # track key -> ascending positions of fetched albums with a track of that key, and tracks
+        self.tracks: dict[TrackKey, list[tuple[int, int, dict]]] = {}
+
+    def __index_album(self, position: int, album_tracks: list[dict]):
+        for i, album_track in enumerate(album_tracks):
+            insort(self.tracks.setdefault(track_key(album_track), []), (position, i, album_track))
+        self.fetched[position] = True
+        while self.first_unfetched < len(self.albums) and self.fetched[self.first_unfetched]:
+            self.first_unfetched += 1
+
+    def find(self, track: dict, release_date: datetime) -> Optional[dict]:
+        """
+        Returns the first album in catalog order released no earlier than release_date that
+        contains a duplicate of track (see is_duplicate_track), if any.
+        """
+        key = track_key(track)
+
+        def matches(position: int, album_track: dict) -> bool:
+            return self.release_dates[position] >= release_date and is_duplicate_track(
+                track, album_track
+            )
+
+        # every album before the first match among fetched albums only needs checking if it
+        # hasn't been fetched yet, in which case it is fetched in catalog order
+        found = next((p for p, _, t in self.tracks.get(key, ()) if matches(p, t)), None)
+        end = len(self.albums) if found is None else found
+        for position in range(self.first_unfetched, end):
+            if self.fetched[position] or self.release_dates[position] < release_date:
+                continue
+            album_tracks = self.fetch_album_tracks(self.albums[position]["uri"])
+            self.__index_album(position, album_tracks)
+            if any(track_key(t) == key and is_duplicate_track(track, t) for t in album_tracks):
+                return self.albums[position]
+        return None if found is None else self.albums[found]
+
+
+class DiscoveryIndex:
+    """
+    Finds full album releases of singles, through a lazily built ArtistIndex for each artist.
+
+    Results are identical to scanning each artist's albums and their tracklists in order, but
+    each artist's catalog and each album's tracklist is fetched and processed at most once.
+    """
+
+    def __init__(
+        self,
+        fetch_artist_albums: Callable[[str], list[dict]],
+        fetch_album_tracks: Callable[[str], list[dict]],
+        user_market: Optional[str],
+    ) -> None:
+        self.fetch_artist_albums = fetch_artist_albums
+        self.fetch_album_tracks = fetch_album_tracks
+        self.user_market = user_market
+        self.artists: dict[str, ArtistIndex] = {}
+        # albums can appear in the catalogs of several artists, so tracklists are shared
+        self.album_tracks: dict[str, list[dict]] = {}
+
+    def artist(self, artist_uri: str) -> ArtistIndex:
+        if artist_uri not in self.artists:
+            self.artists[artist_uri] = ArtistIndex(
+                self.fetch_artist_albums(artist_uri), self.get_album_tracks, self.user_market
+            )
+        return self.artists[artist_uri]
+
+    def add_artist_albums(self, artist_uri: str, albums: list[dict]):
+        """Adds an artist's catalog that was fetched ahead of time."""
+        if artist_uri not in self.artists:
+            self.artists[artist_uri] = ArtistIndex(albums, self.get_album_tracks, self.user_market)
+
+    def get_album_tracks(self, album_uri: str) -> list[dict]:
+        if album_uri not in self.album_tracks:
+            self.album_tracks[album_uri] = self.fetch_album_tracks(album_uri)
+        return self.album_tracks[album_uri]
+
+    def discover(self, track: dict) -> tuple[dict, bool]:
+        """
+        If the supplied track is a single release, attempts to locate a full album release that
+        contains the track.
+
+        If one cannot be found, returns the album of the given track as-is.
+        """
+        if not needs_discovery(track):
+            return track["album"], False
+        release_date = parse_release_date(track["album"]["release_date"])
+        album = self.artist(track["album"]["artists"][0]["uri"]).find(track, release_date)
+        if album is None:
+            return track["album"], False
+        return album, True
@@ -0,0 +1,126 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+SCHEMA = """
+DROP TABLE IF EXISTS features;
+CREATE TABLE IF NOT EXISTS cover_paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cover_paths_hash ON cover_paths (content_hash);
+CREATE TABLE IF NOT EXISTS cover_features (
+    content_hash TEXT NOT NULL,
+    extractor TEXT NOT NULL,
+    features BLOB NOT NULL,
+    PRIMARY KEY (content_hash, extractor)
+);
+"""
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    """
+    A persistent SQLite store of image features, keyed by the content hash of the image file and
+    the version of the extractor that produced them.
+
+    The content hash of each image path is recorded alongside its size and modification time, so
+    unchanged files are not re-hashed, while renamed, re-downloaded or duplicated covers still
+    share their features.
+    """
+
+    commit_interval = 256
+
+    def __init__(self, path: Path, extractor: str) -> None:
+        self.extractor = extractor
+        # the store may be used from a pipeline stage's thread, though only one at a time
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.executescript(SCHEMA)
+        self.__pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, image_path: Path) -> Optional[np.ndarray]:
+        row = self.__conn.execute(
+            "SELECT features FROM cover_features WHERE content_hash = ? AND extractor = ?",
+            (self.__content_hash(image_path), self.extractor),
+        ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float64).copy()
+
+    def put(self, image_path: Path, features: np.ndarray):
+        self.__conn.execute(
+            "INSERT OR REPLACE INTO cover_features VALUES (?, ?, ?)",
+            (
+                self.__content_hash(image_path),
+                self.extractor,
+                np.asarray(features, dtype=np.float64).tobytes(),
+            ),
+        )
+        self.__written()
+
+    def __content_hash(self, image_path: Path) -> str:
+        """
+        Returns the content hash of an image, only hashing the file if it is not already recorded
+        at its path with the same size and modification time.
+        """
+        stat = image_path.stat()
+        resolved = str(image_path.resolve())
+        row = self.__conn.execute(
+            "SELECT content_hash FROM cover_paths WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (resolved, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        content_hash = hash_file(image_path)
+        self.__conn.execute(
+            "INSERT OR REPLACE INTO cover_paths VALUES (?, ?, ?, ?)",
+            (resolved, stat.st_size, stat.st_mtime_ns, content_hash),
+        )
+        self.__written()
+        return content_hash
+
+    def __written(self):
+        self.__pending += 1
+        if self.__pending >= self.commit_interval:
+            self.commit()
+
+    def evict_missing(self) -> int:
+        """
+        Removes paths whose image files no longer exist, and the features of covers no longer at
+        any path, returning how many paths were removed.
+        """
+        paths = [row[0] for row in self.__conn.execute("SELECT path FROM cover_paths")]
+        missing = [(p,) for p in paths if not Path(p).exists()]
+        self.__conn.executemany("DELETE FROM cover_paths WHERE path = ?", missing)
+        self.__conn.execute(
+            "DELETE FROM cover_features WHERE content_hash NOT IN"
+            " (SELECT content_hash FROM cover_paths)"
+        )
+        self.commit()
+        return len(missing)
+
+    def commit(self):
+        self.__conn.commit()
+        self.__pending = 0
+
+    def close(self):
+        self.commit()
+        self.__conn.close()
@@ -0,0 +1,17 @@
+import os
+from pathlib import Path
+from typing import Union
+
+# the umask can only be read by setting it, which races with other threads creating files, so it
+# is read once at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def move_into_place(tmp_path: Union[str, Path], path: Union[str, Path]):
+    """
+    Moves a temporary file created by tempfile.mkstemp to path, first giving it the permissions a
+    file created with open would have rather than mkstemp's owner-only ones.
+    """
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    os.replace(tmp_path, path)
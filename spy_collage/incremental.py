@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+
+from spy_collage import metrics
+from spy_collage.color_problem import (
+    Assignment,
+    ColorMatrix,
+    ColorSpace,
+    FactoredCostMatrix,
+    KeyObject,
+    assignment_cost,
+    create_color_distance_matrix,
+    create_coordinate_distance_matrix,
+    solve_hungarian,
+    stack_key_colors,
+)
+
+# col4row entry of a row without a column, and row4col entry of a column without a row
+UNASSIGNED = -1
+# an extra row with zero costs that augmenting paths can start from, see AugmentingSolver.augment
+DUMMY = -2
+
+
+class AugmentingSolver:
+    """
+    An exact solver for the (positions x colors) assignment problem that keeps the dual variables
+    of its solution, so the solution can be repaired after colors are added or removed.
+
+    Rows are assigned one at a time along shortest augmenting paths, like scipy's
+    linear_sum_assignment, while maintaining row duals u and column duals v such that
+    cost[i, j] >= u[i] + v[j] with equality for assigned pairs, v <= 0, and v = 0 for unassigned
+    columns. Any assignment of every row that satisfies these conditions is optimal.
+
+    Removing a column only frees the row that was assigned to it, and a new column only needs a
+    repair if some row would rather have it (i.e. it would get a negative dual), so each changed
+    column costs at most one augmenting path rather than a solve from scratch.
+    """
+
+    def __init__(
+        self,
+        cost: FactoredCostMatrix,
+        col4row: Optional[np.ndarray] = None,
+        u: Optional[np.ndarray] = None,
+        v: Optional[np.ndarray] = None,
+    ) -> None:
+        n, m = cost.shape
+        self.cost = cost
+        self.col4row = np.full(n, UNASSIGNED, dtype=np.intp) if col4row is None else col4row
+        self.u = np.zeros(n) if u is None else u
+        self.v = np.zeros(m) if v is None else v
+        self.row4col = np.full(m, UNASSIGNED, dtype=np.intp)
+        assigned = self.col4row != UNASSIGNED
+        self.row4col[self.col4row[assigned]] = np.flatnonzero(assigned)
+        self.augmentations = 0
+
+    def solve(self, new_columns: np.ndarray = np.empty(0, dtype=np.intp)):
+        """
+        Assigns every unassigned row. new_columns are unassigned columns whose duals are not set
+        yet, which are brought into the assignment first if any assigned row would rather have
+        them.
+        """
+        rows = np.flatnonzero(self.col4row != UNASSIGNED)
+        if len(rows) and len(new_columns):
+            cost = np.inner(self.cost.space_factor[rows], self.cost.color_factor[new_columns])
+            duals = np.minimum((cost - self.u[rows, np.newaxis]).min(axis=0), 0)
+            self.v[new_columns] = duals
+            for j in new_columns[duals < 0]:
+                self.augment(DUMMY, target=int(j))
+        for i in np.flatnonzero(self.col4row == UNASSIGNED):
+            self.u[i] = (self.cost[i] - self.v).min()
+            self.augment(int(i))
+
+    def augment(self, start: int, target: int = UNASSIGNED):
+        """
+        Assigns row start along a shortest augmenting path ending at an unassigned column.
+
+        If start is DUMMY, the path instead starts from an extra row with zero costs and must end
+        at column target. Whichever column the extra row ends up with is left unassigned, so this
+        brings a column with a negative dual into the assignment at the least cost.
+        """
+        m = len(self.v)
+        remaining = np.full(m, np.inf)
+        dist = np.empty(m)
+        pred = np.full(m, UNASSIGNED, dtype=np.intp)
+        scanned = np.zeros(m, dtype=bool)
+        order = []
+        row, shortest = start, 0.0
+        while True:
+            if row != UNASSIGNED:
+                if row == DUMMY:
+                    reduced = -self.v
+                else:
+                    reduced = self.cost[row] - self.u[row] - self.v
+                candidate = shortest + reduced
+                better = (candidate < remaining) & ~scanned
+                remaining[better] = candidate[better]
+                pred[better] = row
+
+            j = int(np.argmin(remaining))
+            shortest = remaining[j]
+            if shortest == np.inf:
+                raise ValueError("Expected at least as many colors as positions")
+            dist[j] = shortest
+            remaining[j] = np.inf
+            scanned[j] = True
+            order.append(j)
+            # unassigned columns other than the target are dead ends for paths from DUMMY,
+            # since the extra row that holds them has the same (zero) costs as the start
+            row = self.row4col[j]
+            if row == UNASSIGNED and (start != DUMMY or j == target):
+                break
+
+        # update the duals so that the path is tight and every other pair stays feasible
+        columns = np.asarray(order)
+        delta = shortest - dist[columns]
+        owners = self.row4col[columns]
+        self.u[owners[owners >= 0]] += delta[owners >= 0]
+        self.v[columns] -= delta
+        if start != DUMMY:
+            self.u[start] += shortest
+
+        # flip the assignments along the path
+        j = order[-1]
+        while True:
+            i = pred[j]
+            if i == DUMMY:
+                self.row4col[j] = UNASSIGNED
+                break
+            self.row4col[j] = i
+            j, self.col4row[i] = self.col4row[i], j
+            if i == start:
+                break
+
+        if start == DUMMY:
+            # the extra row's column is unassigned again, so shift its dual back to zero
+            shift = self.v[self.row4col == UNASSIGNED].max()
+            self.v -= shift
+            self.u += shift
+        self.augmentations += 1
+
+    def recover_duals(self):
+        """
+        Sets the duals of a complete, optimal assignment found by another solver, e.g.
+        linear_sum_assignment, which is faster than assigning every row with augment.
+
+        -v[j] is the length of the shortest alternating path from an unassigned column to column
+        j, which is found by relaxing every row at once until nothing changes (Bellman-Ford).
+        """
+        n, m = self.cost.shape
+        # the assignment came from a solver that needed the dense matrix anyway
+        cost = np.asarray(self.cost)
+        assigned_cost = cost[np.arange(n), self.col4row]
+        # improvements smaller than this are rounding errors around cycles of zero length
+        tolerance = 1e-9 * float(np.abs(assigned_cost).max())
+        lengths = np.zeros(m)
+        if n < m:
+            lengths[self.col4row] = np.inf
+        for _ in range(n + 1):
+            relaxed = (cost + lengths).min(axis=1) - assigned_cost
+            improved = relaxed < lengths[self.col4row] - tolerance
+            if not improved.any():
+                break
+            lengths[self.col4row[improved]] = relaxed[improved]
+        # with no unassigned columns the lengths are only relative, and v must be <= 0
+        lengths -= min(lengths.min(), 0)
+        self.v = -lengths
+        self.u = assigned_cost - self.v[self.col4row]
+
+    def cost_of_assignment(self) -> float:
+        return assignment_cost(self.cost, np.arange(len(self.col4row)), self.col4row)
+
+    def lower_bound(self) -> float:
+        """
+        Returns a lower bound on the cost of any assignment, which equals the cost of the
+        solution when it is optimal.
+
+        The bound is the dual objective after tightening each row dual to the cheapest reduced
+        cost of its row, so it holds even if rounding errors have accumulated in the duals.
+        """
+        v = np.minimum(self.v, 0)
+        u = np.concatenate([(block - v).min(axis=1) for _, block in self.cost.row_blocks()])
+        return float(u.sum() + v.sum())
+
+
+@dataclass
+class SolverState:
+    """
+    An AugmentingSolver solution persisted between runs, with the inputs it was solved for.
+
+    Columns are identified by column_ids (e.g. album cover paths) so that a later problem can be
+    matched against them, and the color factors of the cost matrix are kept so that only new
+    colors need their distances computed.
+    """
+
+    column_ids: np.ndarray
+    colors: np.ndarray
+    color_factor: np.ndarray
+    space_factor: np.ndarray
+    key_colors: np.ndarray
+    distance_space: str
+    col4row: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+
+    def save(self, path: Path):
+        with open(path, "wb") as f:
+            np.savez(f, **vars(self))
+
+    @classmethod
+    def load(cls, path: Path) -> SolverState:
+        with np.load(path, allow_pickle=False) as data:
+            fields = {name: data[name] for name in data.files}
+        fields["distance_space"] = str(fields["distance_space"])
+        return cls(**fields)
+
+    def matches(self, state: SolverState) -> bool:
+        """Whether state is for the same grid, key objects and color space."""
+        return (
+            self.distance_space == state.distance_space
+            and np.array_equal(self.space_factor, state.space_factor)
+            and np.array_equal(self.key_colors, state.key_colors)
+        )
+
+
+@dataclass
+class IncrementalResult:
+    assignment: Assignment
+    # whether a previous solution was repaired, rather than solving from scratch
+    warm: bool
+    added: int
+    removed: int
+    augmentations: int
+
+    def __str__(self) -> str:
+        assignment = self.assignment
+        how = "Solved from scratch"
+        if self.warm:
+            how = (
+                f"Repaired previous solution ({self.added} added, {self.removed} removed) with"
+                f" {self.augmentations} augmenting paths"
+            )
+        gap = assignment.gap
+        if gap is None:
+            return f"{how}, cost {assignment.cost:.6g}"
+        return (
+            f"{how}, cost {assignment.cost:.6g}"
+            f" (lower bound {assignment.exact_cost:.6g}, gap {max(gap, 0):.4%})"
+        )
+
+
+def _unique_ids(column_ids: Sequence[str]) -> list[str]:
+    """Makes repeated column ids unique by numbering their later occurrences."""
+    seen: dict[str, int] = {}
+    unique = []
+    for column_id in column_ids:
+        count = seen.get(column_id, 0)
+        seen[column_id] = count + 1
+        unique.append(column_id if count == 0 else f"{column_id}#{count}")
+    return unique
+
+
+def solve_colors_incremental(
+    shape: tuple[int, int],
+    colors: ColorMatrix,
+    column_ids: Sequence[str],
+    distance_space: ColorSpace,
+    key_points: Sequence[KeyObject],
+    state_path: Path,
+    space_distances: Optional[np.ndarray] = None,
+) -> IncrementalResult:
+    """
+    Exactly solves the same problem as solve_colors, warm-starting from the solution saved at
+    state_path by the last call (if any) and saving the new solution there.
+
+    column_ids identify the colors across calls. If the grid, key objects and color space are
+    unchanged, the previous solution is repaired for the colors that were added, removed or
+    changed since, so the time taken scales with the size of the change. Otherwise the problem
+    is solved from scratch. space_distances are as for solve_colors. The result reports a lower
+    bound on the optimal cost as its exact_cost, so its gap shows how far from optimal it can be
+    (zero up to rounding).
+    """
+    key_points = list(key_points)
+    column_ids = _unique_ids(column_ids)
+    if len(colors) < shape[0] * shape[1]:
+        raise ValueError(
+            f"Expected at least as many colors ({len(colors)}) as positions in the grid"
+            f" ({shape[0]} x {shape[1]} = {shape[0] * shape[1]})"
+        )
+
+    with metrics.phase("distance matrices"):
+        space_dists = space_distances
+        if space_dists is None:
+            space_dists = create_coordinate_distance_matrix(shape[0], shape[1], key_points)
+        # an empty cost matrix, for the space factor of the grid
+        grid = FactoredCostMatrix(np.empty((0, len(key_points))), space_dists)
+        state = SolverState(
+            column_ids=np.asarray(column_ids, dtype=str),
+            colors=np.asarray(colors.matrix, dtype=np.float64),
+            color_factor=grid.color_factor,
+            space_factor=grid.space_factor,
+            key_colors=stack_key_colors(key_points, distance_space),
+            distance_space=distance_space.value,
+            col4row=np.full(len(space_dists), UNASSIGNED, dtype=np.intp),
+            u=np.zeros(len(space_dists)),
+            v=np.zeros(len(column_ids)),
+        )
+
+        previous = SolverState.load(state_path) if state_path.exists() else None
+        if previous is not None and not previous.matches(state):
+            previous = None
+
+        # previous columns whose color is unchanged, by id
+        kept = []
+        if previous is not None:
+            old_index = {column_id: j for j, column_id in enumerate(previous.column_ids.tolist())}
+            kept = [
+                (j, k)
+                for j, k in (
+                    (j, old_index.get(column_id)) for j, column_id in enumerate(column_ids)
+                )
+                if k is not None and np.array_equal(previous.colors[k], state.colors[j])
+            ]
+        kept_new, kept_old = np.asarray(kept, dtype=np.intp).reshape(-1, 2).T
+        added = np.setdiff1d(np.arange(len(column_ids)), kept_new)
+
+        state.color_factor = np.empty((len(column_ids), len(key_points)))
+        if len(added):
+            added_colors = ColorMatrix(colors.matrix[added], colors.space)
+            state.color_factor[added] = FactoredCostMatrix(
+                create_color_distance_matrix(added_colors, distance_space, key_points), space_dists
+            ).color_factor
+        if previous is not None:
+            state.color_factor[kept_new] = previous.color_factor[kept_old]
+
+            # carry the previous solution over to the new column order
+            new_index = np.full(len(previous.column_ids), UNASSIGNED, dtype=np.intp)
+            new_index[kept_old] = kept_new
+            assigned = previous.col4row != UNASSIGNED
+            state.col4row[assigned] = new_index[previous.col4row[assigned]]
+            state.u = previous.u.copy()
+            state.v[kept_new] = previous.v[kept_old]
+
+        cost = FactoredCostMatrix.__new__(FactoredCostMatrix)
+        cost.color_factor, cost.space_factor = state.color_factor, state.space_factor
+
+    with metrics.phase("solve"):
+        solver = AugmentingSolver(cost, state.col4row, state.u, state.v)
+        if previous is None:
+            # solving from scratch is faster with scipy, and only needs duals for next time
+            solver.col4row = solve_hungarian(cost)[1]
+            solver.recover_duals()
+        else:
+            solver.solve(added)
+        state.col4row, state.u, state.v = solver.col4row, solver.u, solver.v
+        total = solver.cost_of_assignment()
+        bound = solver.lower_bound()
+    metrics.count("augmenting_paths", solver.augmentations)
+
+    state.save(state_path)
+    removed = 0 if previous is None else len(previous.column_ids) - len(kept_old)
+    return IncrementalResult(
+        Assignment(np.arange(len(state.col4row)), state.col4row, total, exact_cost=bound),
+        warm=previous is not None,
+        added=len(added) if previous is not None else 0,
+        removed=removed,
+        augmentations=solver.augmentations,
+    )
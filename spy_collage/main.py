@@ -1,19 +1,25 @@
-import json
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional
 
 import typer
 
-from spy_collage import collage
+from spy_collage import collage, metrics, render
 from spy_collage.cli import format_error, format_info
 from spy_collage.cli.params import AlbumSource, AlbumSourceParam, CollageSize, CollageSizeParam
 from spy_collage.cli.typer_patches import patch_typer_support_custom_types, register_type
-from spy_collage.models import AlbumCoverResolution
-from spy_collage.presets import load_preset
-from spy_collage.spotify import collect_albums, download_cover
+from spy_collage.color_problem import Solver
+from spy_collage.feature_store import FeatureStore
+from spy_collage.models import AlbumCoverResolution, FeatureExtractor
+from spy_collage.pipeline import Pipeline
+from spy_collage.presets import load_compiled_preset
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
 
 ALBUM_DOWNLOAD_PATH = Path("albums")
-FEATURES_CACHE_PATH = Path(".features_cache")
+THUMBNAIL_CACHE_PATH = Path(".thumbnails")
+FEATURES_CACHE_PATH = Path(".features_cache.db")
+SPOTIFY_CACHE_PATH = Path(".spotify_cache.db")
 
 
 patch_typer_support_custom_types()
@@ -22,6 +28,134 @@ register_type(CollageSize, lambda v: CollageSizeParam().convert(v))
 app = typer.Typer()
 
 
+def collect_features(
+    source: AlbumSource,
+    *,
+    discover: bool = False,
+    market: str = "US",
+    dedupe: bool = False,
+    dedupe_threshold: int = 0,
+    album_cover_resolution: AlbumCoverResolution = AlbumCoverResolution.medium,
+    spotify_workers: int = 8,
+    download_workers: int = 8,
+    jobs: Optional[int] = None,
+    extractor: FeatureExtractor = FeatureExtractor.colorgram,
+    feature_cache: bool = True,
+    spotify_cache: bool = True,
+    spotify_cache_size: int = 256,
+    offline: bool = False,
+    sp: Optional["Spotify"] = None,
+    store: Optional[FeatureStore] = None,
+    check_albums: Optional[Callable[[list[dict]], None]] = None,
+) -> tuple[list[dict], list[collage.ImageFeatures]]:
+    """
+    Collects the albums of source, downloads their covers and extracts the features of the
+    covers, skipping duplicate covers if dedupe is set. See main for the options.
+
+    Albums are collected with sp and features cached in store if given (e.g. kept open across
+    collages by a service), otherwise a client and store are created for the call. If
+    check_albums is given, it is called with every album as soon as they are all collected, while
+    their covers are being downloaded, and can raise to stop.
+    """
+    # the Spotify and HTTP clients are slow to import, so they are only imported once albums are
+    # collected rather than for every run of the CLI (e.g. --help)
+    from spy_collage.response_cache import OfflineCacheMiss, ResponseCache
+    from spy_collage.spotify import get_sp, iter_albums, iter_covers
+
+    # albums are collected, their covers downloaded and their features extracted as a pipeline of
+    # concurrent stages, so the network, disk and CPU are kept busy at the same time
+    response_cache = None
+    if sp is None and not source.json_albums and (spotify_cache or offline):
+        response_cache = ResponseCache(
+            SPOTIFY_CACHE_PATH, max_bytes=spotify_cache_size * 1024 * 1024, offline=offline
+        )
+    albums: list[dict] = []
+
+    def collect() -> Iterator[dict]:
+        for album in source.json_albums or iter_albums(
+            source.uris,
+            discovery_enabled=discover,
+            user_market=market,
+            sp=sp or get_sp(response_cache=response_cache),
+            max_workers=spotify_workers,
+        ):
+            albums.append(album)
+            yield album
+        if check_albums is not None:
+            check_albums(albums)
+
+    def cover_path(album: dict) -> Path:
+        return ALBUM_DOWNLOAD_PATH / Path(f"{album['id']}_{album_cover_resolution.value}.jpg")
+
+    ALBUM_DOWNLOAD_PATH.mkdir(exist_ok=True)
+    pipeline = Pipeline()
+    features: List[collage.ImageFeatures] = []
+
+    # many remix albums are simple art recolors that might get missed by the luminance-based phash
+    # algorithm alone, so duplicates must also have matching colors
+    dedupe_index = collage.DuplicateIndex(dedupe_threshold) if dedupe else None
+
+    owned_store = None
+    try:
+        collected = pipeline.stage("collect", collect())
+        album_cover_paths = pipeline.stage(
+            "download",
+            iter_covers(
+                ((album, cover_path(album)) for album in collected),
+                album_cover_resolution,
+                workers=download_workers,
+                download=not offline,
+            ),
+        )
+
+        if store is None and feature_cache:
+            store = owned_store = FeatureStore(
+                FEATURES_CACHE_PATH, collage.EXTRACTOR_VERSIONS[extractor]
+            )
+            store.evict_missing()
+        if store is not None:
+            new_features_iter = collage.iter_cached_features(
+                album_cover_paths, store, jobs=jobs, extractor=extractor
+            )
+        else:
+            new_features_iter = collage.iter_features(
+                album_cover_paths, jobs=jobs, extractor=extractor
+            )
+        new_features_iter = pipeline.stage("extract", new_features_iter)
+
+        for i, new_feature in enumerate(new_features_iter):
+            print(
+                f"Collected {pipeline.stats['collect'].items} albums, saved"
+                f" {pipeline.stats['download'].items} covers, got features for {i+1} covers",
+                end="\r",
+            )
+
+            if dedupe_index is None:
+                features.append(new_feature)
+                continue
+            with metrics.phase("dedupe"):
+                if dedupe_index.add(new_feature):
+                    features.append(new_feature)
+    except OfflineCacheMiss as e:
+        typer.echo(format_error(f"{e}, run once without --offline to cache it"))
+        raise typer.Abort()
+    except FileNotFoundError as e:
+        if not offline:
+            raise
+        typer.echo(format_error(f"{e}, run once without --offline to download it"))
+        raise typer.Abort()
+    finally:
+        print()
+        # the stages use the response cache and feature store from their threads
+        pipeline.close()
+        if response_cache is not None:
+            response_cache.close()
+        if owned_store is not None:
+            owned_store.close()
+    print(pipeline.summary())
+    return albums, features
+
+
 @app.command()
 def main(
     source: AlbumSource = typer.Argument(
@@ -54,84 +188,185 @@ def main(
         False,
         help="Experimental: When fetching album art, skip albums whose art is identical to an already-fetched album",
     ),
+    dedupe_threshold: int = typer.Option(
+        0,
+        min=0,
+        help=(
+            "When deduplicating, also treat album art as identical if the hamming distance between"
+            " their perceptual hashes is at most this"
+        ),
+    ),
     save_albums: bool = typer.Option(
         False, "--save-album-uris", help="Save processed album URIs to albums.txt"
     ),
     album_cover_resolution: AlbumCoverResolution = typer.Option(
         "medium", "--album-cover-resolution", "-r", help="Resolution to download album covers at"
     ),
+    solver: Solver = typer.Option(
+        "hungarian",
+        help=(
+            "Assignment solver to arrange album covers with. hungarian is exact, greedy is an"
+            " approximate solver that scales to much larger collages"
+        ),
+    ),
+    compare_exact: bool = typer.Option(
+        False,
+        "--compare-exact",
+        help="When using an approximate solver, also run the exact solver and report the cost gap",
+    ),
+    candidate_factor: Optional[float] = typer.Option(
+        None,
+        help=(
+            "When more albums are provided than spaces in the collage, only consider roughly this"
+            " many times as many albums as there are spaces (those closest to the requested"
+            " colors) when arranging the collage. Speeds up collages of very large libraries"
+        ),
+    ),
+    incremental: Optional[Path] = typer.Option(
+        None,
+        dir_okay=False,
+        help=(
+            "Save the arrangement of the collage to this file, and on later runs with the same"
+            " preset and dimensions repair it for the albums that were added or removed rather"
+            " than arranging the collage from scratch. The arrangement is still exact"
+        ),
+    ),
+    spotify_workers: int = typer.Option(
+        8,
+        min=1,
+        help="Maximum number of concurrent requests to the Spotify API when collecting albums",
+    ),
+    download_workers: int = typer.Option(
+        8, min=1, help="Number of album covers to download concurrently"
+    ),
+    jobs: Optional[int] = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        min=1,
+        help="Number of processes to extract album art features with (defaults to all CPU cores)",
+    ),
+    extractor: FeatureExtractor = typer.Option(
+        "colorgram",
+        help=(
+            "Algorithm to find the dominant color of album art with. numpy is much faster and"
+            " samples a downscaled copy of each cover"
+        ),
+    ),
+    feature_cache: bool = typer.Option(
+        True, help="Enable/disable caching album art features across runs"
+    ),
+    output: Optional[Path] = typer.Option(
+        None,
+        "--output",
+        "-o",
+        dir_okay=False,
+        help=(
+            "Save the collage to this file instead of showing it. PNG files are written a row at"
+            " a time, so collages of any size can be saved. A .dzi file saves a Deep Zoom tile"
+            " pyramid for viewing huge collages"
+        ),
+    ),
+    spotify_cache: bool = typer.Option(
+        True, help="Enable/disable caching Spotify API responses across runs"
+    ),
+    spotify_cache_size: int = typer.Option(
+        256,
+        min=1,
+        help="Maximum size of the Spotify API response cache in MB, least recently used first",
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help=(
+            "Run entirely from cached Spotify API responses and previously downloaded album"
+            " covers, without making any network requests"
+        ),
+    ),
+    cell_size: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help=(
+            "Size in pixels to resize each album cover to in the collage (defaults to the size of"
+            " the downloaded covers). Resized covers are cached for faster repeat renders"
+        ),
+    ),
+    metrics_out: Optional[Path] = typer.Option(
+        None,
+        dir_okay=False,
+        help=(
+            "Write timings of each phase of the run, counters and peak memory use to this file"
+            " as JSON"
+        ),
+    ),
+    profile: Optional[Path] = typer.Option(
+        None,
+        dir_okay=False,
+        help="Profile the run with cProfile and save the stats to this file (e.g. for snakeviz)",
+    ),
 ):
     """A configurable album art collage generator for Spotify, featuring album discovery and
     color clustering."""
-    albums = source.json_albums
-    if not albums:
-        albums = collect_albums(source.uris, discovery_enabled=discover, user_market=market)
-
-    if len(albums) < dimensions.width * dimensions.height:
+    if incremental is not None and (solver != Solver.hungarian or candidate_factor is not None):
         typer.echo(
             format_error(
-                f"product of width and height dimensions ({dimensions.width} x"
-                f" {dimensions.height} = {dimensions.width * dimensions.height}) must be less than or equal to"
-                f" the number of albums provided ({len(albums)})"
+                "--incremental cannot be combined with --solver greedy or --candidate-factor"
             )
         )
         raise typer.Abort()
-    if len(albums) > dimensions.width * dimensions.height:
+    if output is not None and not render.supports_output(output):
         typer.echo(
-            format_info(
-                f"more albums were provided ({len(albums)}) than spaces in collage"
-                f" ({dimensions.width} x {dimensions.height} ="
-                f" {dimensions.width * dimensions.height}). Will use the"
-                f" {dimensions.width * dimensions.height} albums that best match the requested"
-                " colors."
-            )
+            format_error(f"cannot save collages as {output.suffix or 'files without an extension'}")
         )
+        raise typer.Abort()
 
-    key_objects = load_preset(preset, dimensions.width, dimensions.height)
+    with metrics.instrument(metrics_out, profile):
+        compiled_preset = load_compiled_preset(preset)
+        key_objects = compiled_preset.key_objects(dimensions.width, dimensions.height)
 
-    if save_albums:
-        with open("albums.txt", "w", encoding="utf-8") as of:
-            of.writelines([a["uri"] + "\n" for a in albums])
+        def check_albums(albums: list[dict]):
+            if len(albums) < dimensions.width * dimensions.height:
+                typer.echo(
+                    format_error(
+                        f"product of width and height dimensions ({dimensions.width} x"
+                        f" {dimensions.height} = {dimensions.width * dimensions.height}) must be less than or equal to"
+                        f" the number of albums provided ({len(albums)})"
+                    )
+                )
+                raise typer.Abort()
+            if len(albums) > dimensions.width * dimensions.height:
+                typer.echo(
+                    format_info(
+                        f"more albums were provided ({len(albums)}) than spaces in collage"
+                        f" ({dimensions.width} x {dimensions.height} ="
+                        f" {dimensions.width * dimensions.height}). Will use the"
+                        f" {dimensions.width * dimensions.height} albums that best match the"
+                        " requested colors."
+                    )
+                )
 
-    ALBUM_DOWNLOAD_PATH.mkdir(exist_ok=True)
-    album_cover_paths = []
-    for i, album in enumerate(albums):
-        cover_path = ALBUM_DOWNLOAD_PATH / Path(f"{album['id']}_{album_cover_resolution.value}.jpg")
-        album_cover_paths.append(cover_path)
-        print(f"Saving cover {i+1}/{len(albums)}", end="\r")
-        if not cover_path.exists():
-            download_cover(album, cover_path, album_cover_resolution)
-    print()
+            if save_albums:
+                with open("albums.txt", "w", encoding="utf-8") as of:
+                    of.writelines([a["uri"] + "\n" for a in albums])
 
-    features: List[collage.ImageFeatures] = []
+        _, features = collect_features(
+            source,
+            discover=discover,
+            market=market,
+            dedupe=dedupe,
+            dedupe_threshold=dedupe_threshold,
+            album_cover_resolution=album_cover_resolution,
+            spotify_workers=spotify_workers,
+            download_workers=download_workers,
+            jobs=jobs,
+            extractor=extractor,
+            feature_cache=feature_cache,
+            spotify_cache=spotify_cache,
+            spotify_cache_size=spotify_cache_size,
+            offline=offline,
+            check_albums=check_albums,
+        )
 
-    # this feature does not work properly right now with changing sources across multiple runs
-    # disable for now
-    if False:  # pylint: disable=using-constant-test
-        # if FEATURES_CACHE_PATH.exists():
-        print("Using cached features")
-        features_json = json.load(FEATURES_CACHE_PATH.open(encoding="utf-8"))
-        for f in features_json:
-            features.append(collage.ImageFeatures.from_dict(f))
-    else:
-        for i, a in enumerate(album_cover_paths):
-            print(f"Getting features for art {i+1}/{len(album_cover_paths)}", end="\r")
-            new_feature = collage.get_features(a)
-
-            # could save minimal runtime by keeping a set of phashes rather than pairwise comparisons,
-            # but many remix albums are simple art recolors that might get missed by the luminance-based
-            # phash algorithm, so we still need to do pairwise color comparisons.
-            if dedupe:
-                present = False
-                for feature in features:
-                    if new_feature.is_likely_duplicate(feature):
-                        present = True
-                        break
-                if not present:
-                    features.append(new_feature)
-            else:
-                features.append(new_feature)
-        print()
         if dedupe:
             print(f"Found {len(features)} unique album covers", end="\n")
             if len(features) < dimensions.width * dimensions.height:
@@ -143,7 +378,18 @@ def main(
                     )
                 )
 
-    # with open(".features_cache", "w", encoding="utf-8") as of:
-    #     json.dump([f.to_dict() for f in features], of)
-
-    collage.lap_collage(features, (dimensions.width, dimensions.height), key_objects)
+        collage.lap_collage(
+            features,
+            (dimensions.width, dimensions.height),
+            key_objects,
+            solver=solver,
+            compare_exact=compare_exact,
+            candidate_factor=candidate_factor,
+            output=output,
+            cell_size=cell_size,
+            thumbnails=(
+                render.ThumbnailCache(THUMBNAIL_CACHE_PATH) if cell_size is not None else None
+            ),
+            incremental_state=incremental,
+            space_distances=compiled_preset.distance_fields(dimensions.width, dimensions.height),
+        )
@@ -0,0 +1,165 @@
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+
+@dataclass
+class PhaseTiming:
+    wall_seconds: float = 0.0
+    # CPU time of the thread that ran the phase, so concurrent phases don't count each other
+    cpu_seconds: float = 0.0
+    calls: int = 0
+
+
+class Metrics:
+    """
+    Wall and CPU time per phase of a run, along with counters of the work done.
+
+    Phases may overlap (e.g. pipeline stages) or be entered many times, in which case their
+    timings add up. Time spent in worker processes is only included in the children totals.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.phases: dict[str, PhaseTiming] = {}
+        self.counters: dict[str, int] = {}
+        self.stages: list[dict] = []
+        self.started = time.perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        # profiles threads that call profile_thread, if the run is being profiled
+        self.profiler: Optional["Profiler"] = None
+
+    def reset(self, profiler: Optional["Profiler"] = None):
+        """Starts collecting metrics afresh, profiling with profiler if given."""
+        with self.__lock:
+            self.phases = {}
+            self.counters = {}
+            self.stages = []
+            self.started = time.perf_counter()
+            self.started_at = datetime.now(timezone.utc)
+            self.profiler = profiler
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def add_phase(self, name: str, wall_seconds: float, cpu_seconds: float):
+        with self.__lock:
+            timing = self.phases.setdefault(name, PhaseTiming())
+            timing.wall_seconds += wall_seconds
+            timing.cpu_seconds += cpu_seconds
+            timing.calls += 1
+
+    def add_stage(self, stage: dict):
+        """Records the statistics of a finished pipeline stage (see pipeline.StageStats)."""
+        with self.__lock:
+            self.stages.append(stage)
+
+    def count(self, name: str, n: int = 1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self) -> dict:
+        try:
+            import resource
+        except ImportError:  # not available on Windows, where only the CPU time is reported
+            children_cpu_seconds = peak_rss_bytes = children_peak_rss_bytes = None
+        else:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+            rss_unit = 1 if sys.platform == "darwin" else 1024
+            children_cpu_seconds = children.ru_utime + children.ru_stime
+            peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+            children_peak_rss_bytes = children.ru_maxrss * rss_unit
+        return {
+            "started_at": self.started_at.isoformat(),
+            "wall_seconds": time.perf_counter() - self.started,
+            "cpu_seconds": time.process_time(),
+            "children_cpu_seconds": children_cpu_seconds,
+            "peak_rss_bytes": peak_rss_bytes,
+            "children_peak_rss_bytes": children_peak_rss_bytes,
+            "phases": {name: vars(timing) for name, timing in self.phases.items()},
+            "counters": dict(self.counters),
+            "pipeline": list(self.stages),
+        }
+
+    def write(self, path: Path):
+        path.write_text(json.dumps(self.to_dict(), indent=2) + "\n", encoding="utf-8")
+
+
+class Profiler:
+    """Collects cProfile profiles from every thread that opts in, see profile_thread."""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.profiles: list[cProfile.Profile] = []
+
+    @contextmanager
+    def profile_thread(self) -> Iterator[None]:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.__lock:
+                self.profiles.append(profile)
+
+    def dump(self, path: Path):
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(path)
+
+
+# the metrics of the current run, reset by instrument
+metrics = Metrics()
+
+
+def phase(name: str):
+    return metrics.phase(name)
+
+
+def count(name: str, n: int = 1):
+    metrics.count(name, n)
+
+
+@contextmanager
+def profile_thread() -> Iterator[None]:
+    """Profiles the calling thread for the duration of the block, if a run is being profiled."""
+    profiler = metrics.profiler
+    if profiler is None:
+        yield
+        return
+    with profiler.profile_thread():
+        yield
+
+
+@contextmanager
+def instrument(metrics_out: Optional[Path] = None, profile_out: Optional[Path] = None):
+    """
+    Collects fresh metrics for the block, writing them as JSON to metrics_out if given. If
+    profile_out is given, the block (and any thread that calls profile_thread) is profiled with
+    cProfile and the combined stats are dumped there, for viewing with pstats or snakeviz.
+    """
+    profiler = Profiler() if profile_out is not None else None
+    metrics.reset(profiler)
+    try:
+        with profile_thread():
+            yield metrics
+    finally:
+        metrics.profiler = None
+        if metrics_out is not None:
+            metrics.write(metrics_out)
+        if profiler is not None and profile_out is not None:
+            profiler.dump(profile_out)
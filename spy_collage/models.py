@@ -5,3 +5,8 @@ class AlbumCoverResolution(Enum):
     small = "small"
     medium = "medium"
     large = "large"
+
+
+class FeatureExtractor(Enum):
+    colorgram = "colorgram"
+    numpy = "numpy"
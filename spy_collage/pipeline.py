@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, Optional, TypeVar
+
+from spy_collage import metrics
+
+T = TypeVar("T")
+
+# default number of items buffered between two pipeline stages
+BUFFER_SIZE = 64
+
+
+def completed(value: T) -> "Future[T]":
+    """Returns a future that already holds value."""
+    future: Future[T] = Future()
+    future.set_result(value)
+    return future
+
+
+def ordered(futures: Iterable["Future[T]"], window: int) -> Iterator[T]:
+    """
+    Yields the results of futures in order, reading at most window futures ahead of the one being
+    waited on. Unlike Executor.map, work can therefore be submitted lazily from an unbounded
+    stream, with at most window tasks in flight.
+    """
+    pending: deque[Future[T]] = deque()
+    try:
+        for future in futures:
+            pending.append(future)
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    chunk: list[T] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    # time the stage spent unable to hand items on because the buffer after it was full
+    blocked_seconds: float = 0.0
+    # time the consumer of the stage spent waiting for it to produce items
+    starved_seconds: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Items produced per second since the stage started."""
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "items": self.items,
+            "elapsed_seconds": self.elapsed,
+            "throughput": self.throughput,
+            "blocked_seconds": self.blocked_seconds,
+            "starved_seconds": self.starved_seconds,
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.items} in {self.elapsed:.2f}s ({self.throughput:.1f}/s),"
+            f" blocked {self.blocked_seconds:.2f}s, waited on {self.starved_seconds:.2f}s"
+        )
+
+
+class _End:
+    pass
+
+
+class _Error:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class Pipeline:
+    """
+    Runs chains of generators as concurrent stages, each in its own thread with a bounded buffer
+    to the next, so that e.g. covers are downloaded while earlier covers are being processed.
+
+    Every stage records StageStats. A stage that is often waited on is a bottleneck, while one
+    that is often blocked is producing faster than the stages after it can keep up with.
+    """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE) -> None:
+        self.buffer_size = buffer_size
+        # the stats of each stage by name, in the order the stages were added
+        self.stats: dict[str, StageStats] = {}
+        self.__threads: list[threading.Thread] = []
+        self.__stopped: list[threading.Event] = []
+
+    def stage(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """Runs items in a background thread, returning an iterator over what it produces."""
+        stats = StageStats(name)
+        self.stats[name] = stats
+        buffer: queue.Queue = queue.Queue(maxsize=self.buffer_size)
+        stopped = threading.Event()
+
+        def put(item) -> bool:
+            start = time.perf_counter()
+            while not stopped.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    stats.blocked_seconds += time.perf_counter() - start
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get() -> Any:
+            while not stopped.is_set():
+                try:
+                    return buffer.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _End()
+
+        def run():
+            stats.started = time.perf_counter()
+            cpu_start = time.thread_time()
+            end: object = _End()
+            try:
+                with metrics.profile_thread():
+                    for item in items:
+                        stats.items += 1
+                        if not put(item):
+                            return
+            except BaseException as e:  # handed over to the consumer to raise
+                end = _Error(e)
+            # record the stage before the consumer can see it has finished
+            stats.finished = time.perf_counter()
+            metrics.metrics.add_phase(name, stats.elapsed, time.thread_time() - cpu_start)
+            metrics.metrics.add_stage(stats.to_dict())
+            put(end)
+
+        thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+        self.__stopped.append(stopped)
+
+        def consume() -> Iterator[T]:
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = get()
+                    stats.starved_seconds += time.perf_counter() - start
+                    if isinstance(item, _End):
+                        return
+                    if isinstance(item, _Error):
+                        raise item.error
+                    yield item
+            finally:
+                stopped.set()
+
+        return consume()
+
+    def close(self):
+        """
+        Stops every stage and waits for their threads to exit, so that anything the stages use can
+        then be closed safely.
+        """
+        for stopped in self.__stopped:
+            stopped.set()
+        for thread in self.__threads:
+            thread.join()
+
+    def summary(self) -> str:
+        return "\n".join(str(stats) for stats in self.stats.values())
@@ -2,75 +2,227 @@ import json
 import re
 from ast import literal_eval
 from configparser import ConfigParser, ParsingError
+from functools import lru_cache
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Union
+from typing import Any, Optional, Sequence
 
+import numpy as np
 import typer
 
 from spy_collage.cli import format_error
-from spy_collage.color_problem import KeyObject, mkline, mkpoint, mkspectrum
+from spy_collage.color_problem import (
+    ColorMatrix,
+    ColorSpace,
+    KeyLine,
+    KeyObject,
+    KeyPoint,
+    convert_space,
+    line_distance_fields,
+    point_distance_fields,
+    spectrum_points,
+)
 
 PRESETS_PATH = Path("presets.ini")
 
+# number of compiled presets and of (preset, width, height) distance fields kept in memory
+PRESET_CACHE_SIZE = 32
+DISTANCE_FIELD_CACHE_SIZE = 16
 
-def load_preset(preset_name: str, width: int, height: int) -> list[KeyObject]:
+# number of arguments of each directive
+DIRECTIVE_ARGUMENTS = {"point": 5, "line": 7, "spectrum": 7}
+
+
+class PresetError(ValueError):
+    """Raised when a preset cannot be found or parsed."""
+
+
+def preset_names() -> list[str]:
     config = ConfigParser()
+    config.read(PRESETS_PATH, encoding="utf-8")
+    return config.sections()
+
+
+def load_preset(preset_name: str, width: int, height: int) -> list[KeyObject]:
+    return load_compiled_preset(preset_name).key_objects(width, height)
+
+
+def load_compiled_preset(preset_name: str) -> "CompiledPreset":
+    """Compiles a preset from presets.ini, exiting with an error message if that fails."""
     try:
-        config.read(PRESETS_PATH, encoding="utf-8")
-    except ParsingError:
-        typer.echo(format_error("could not parse presets.ini file"))
+        return compile_preset(preset_name)
+    except PresetError as e:
+        typer.echo(format_error(str(e)))
         raise typer.Abort()
 
+
+def compile_preset(preset_name: str, path: Path = PRESETS_PATH) -> "CompiledPreset":
+    """
+    Compiles a preset from the presets file at path. Compiled presets are cached until the file
+    changes.
+    """
+    stat = path.stat() if path.exists() else None
+    stamp = None if stat is None else (stat.st_mtime_ns, stat.st_size)
+    return _compile_preset(path, stamp, preset_name)
+
+
+@lru_cache(maxsize=PRESET_CACHE_SIZE)
+def _compile_preset(
+    path: Path, _stamp: Optional[tuple[int, int]], preset_name: str
+) -> "CompiledPreset":
+    # _stamp is only part of the cache key, so that presets are compiled again once path changes
+    config = ConfigParser()
+    try:
+        config.read(path, encoding="utf-8")
+    except ParsingError as e:
+        raise PresetError("could not parse presets.ini file") from e
+
     try:
         preset = config[preset_name]
     except KeyError:
-        typer.echo(
-            format_error(f"preset {preset_name} not found. available presets: {config.sections()}")
-        )
-        raise typer.Abort()
+        raise PresetError(
+            f"preset {preset_name} not found. available presets: {config.sections()}"
+        ) from None
 
     try:
         key_object_directives = json.loads(preset["key_objects"])
     except KeyError:
-        typer.echo(format_error(f"preset {preset_name} does not contain a key_objects field!"))
-        raise typer.Abort()
+        raise PresetError(f"preset {preset_name} does not contain a key_objects field!") from None
     except JSONDecodeError:
-        typer.echo(format_error("could not parse key_objects: value must be a list"))
-        raise typer.Abort()
+        raise PresetError("could not parse key_objects: value must be a list") from None
 
     if not isinstance(key_object_directives, list) or any(
         not isinstance(v, str) for v in key_object_directives
     ):
-        typer.echo(format_error("could not parse key_objects: value must be a list of strings"))
-        raise typer.Abort()
+        raise PresetError("could not parse key_objects: value must be a list of strings")
+    return CompiledPreset(preset_name, key_object_directives)
+
 
-    key_objects: list[KeyObject] = []
-    for directive in key_object_directives:
-        try:
-            parsed = parse_directive(directive, width, height)
-        except ValueError as e:
-            typer.echo(format_error(f"could not parse directive: {str(e)}"))
-            raise typer.Abort()
-        if isinstance(parsed, list):
-            key_objects.extend(parsed)
-        else:
-            key_objects.append(parsed)
-    return key_objects
-
-
-def parse_directive(directive: str, width: int, height: int) -> Union[KeyObject, list[KeyObject]]:
+def parse_directive(directive: str) -> list[tuple[str, tuple, np.ndarray]]:
+    """
+    Parses a key object directive into (kind, coordinates, RGB color) triples, where kind is
+    "point" or "line" and coordinates are (x, y) or (x1, y1, x2, y2) as fractions of the grid.
+    """
     m = re.match(r"([a-zA-Z]+)\(([^\)]*)\)", directive)
     if m is None:
         raise ValueError("invalid directive format")
     directive_name, raw_args = m.group(1, 2)
-    args = [literal_eval(arg.strip()) for arg in raw_args.split(",")]
+    if directive_name not in DIRECTIVE_ARGUMENTS:
+        raise ValueError(f"invalid directive {directive_name}")
+    try:
+        args: list[Any] = [literal_eval(arg.strip()) for arg in raw_args.split(",")]
+    except SyntaxError as e:
+        raise ValueError(f"invalid argument in {directive}") from e
+    if len(args) != DIRECTIVE_ARGUMENTS[directive_name]:
+        raise ValueError(
+            f"{directive_name} takes {DIRECTIVE_ARGUMENTS[directive_name]} arguments"
+            f" ({len(args)} given)"
+        )
 
     if directive_name == "point":
-        return mkpoint(*args, width=width, height=height)
-    elif directive_name == "line":
-        return mkline(*args, width=width, height=height)
-    elif directive_name == "spectrum":
-        return mkspectrum(*args, width=width, height=height)  # type: ignore
-    else:
-        raise ValueError(f"invalid directive {directive_name}")
+        return [("point", tuple(args[:2]), np.array(args[2:]))]
+    if directive_name == "line":
+        return [("line", tuple(args[:4]), np.array(args[4:]))]
+    return [("point", (x, y), np.array(rgb)) for x, y, rgb in spectrum_points(*args)]
+
+
+class CompiledPreset:
+    """
+    A preset whose directives have been parsed and validated once, for generating collages of any
+    size without parsing it again.
+
+    The geometry of its key objects is held as arrays of points and lines in grid-relative
+    coordinates, and their colors as one array per color space, converted in a single batch.
+    Distance fields are cached by (preset, width, height), see distance_fields.
+    """
+
+    def __init__(self, name: str, directives: Sequence[str]) -> None:
+        self.name = name
+        self.directives = tuple(directives)
+        kinds: list[str] = []
+        points: list[tuple] = []
+        lines: list[tuple] = []
+        self.rgb: list[np.ndarray] = []
+        for directive in self.directives:
+            try:
+                parsed = parse_directive(directive)
+            except ValueError as e:
+                raise PresetError(f"could not parse directive: {str(e)}") from e
+            for kind, coordinates, rgb in parsed:
+                kinds.append(kind)
+                (points if kind == "point" else lines).append(coordinates)
+                self.rgb.append(rgb)
+
+        self.kinds = np.asarray(kinds)
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.lines = np.asarray(lines, dtype=np.float64).reshape(-1, 4)
+        self.colors = {ColorSpace.RGB: np.array(self.rgb).reshape(-1, 3)}
+        for space in ColorSpace:
+            if space != ColorSpace.RGB:
+                self.colors[space] = self.__convert(space)
+
+    def __convert(self, space: ColorSpace) -> np.ndarray:
+        # colors are converted as they were given, so integer and float colors are batched
+        # separately (skimage scales integer images by the range of their type)
+        converted = np.empty((len(self.rgb), 3))
+        dtypes = [rgb.dtype for rgb in self.rgb]
+        for dtype in set(dtypes):
+            group = [i for i, d in enumerate(dtypes) if d == dtype]
+            batch = np.stack([self.rgb[i] for i in group])
+            converted[group] = convert_space(batch, ColorSpace.RGB, space).matrix
+        return converted
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, CompiledPreset) and (self.name, self.directives) == (
+            other.name,
+            other.directives,
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.directives))
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def key_objects(self, width: int, height: int) -> list[KeyObject]:
+        """Returns the key objects of the preset on a grid of the given size."""
+        scale = np.array([width, height])
+        points = iter((self.points * scale).astype(int).tolist())
+        lines = iter((self.lines * np.tile(scale, 2)).astype(int).tolist())
+        key_objects: list[KeyObject] = []
+        for i, kind in enumerate(self.kinds):
+            key_object: KeyObject
+            if kind == "point":
+                x, y = next(points)
+                key_object = KeyPoint(x, y, self.rgb[i])
+            else:
+                x1, y1, x2, y2 = next(lines)
+                key_object = KeyLine(x1, y1, x2, y2, self.rgb[i])
+            # colors in other spaces were already converted along with the rest of the preset
+            for space, colors in self.colors.items():
+                if space != ColorSpace.RGB:
+                    key_object.color[space] = ColorMatrix(colors[i], space)
+            key_objects.append(key_object)
+        return key_objects
+
+    def distance_fields(self, width: int, height: int) -> np.ndarray:
+        """
+        Returns the (width * height, k) distances from every cell of a grid of the given size to
+        every key object, as computed by create_coordinate_distance_matrix. The result is
+        cached and must not be modified.
+        """
+        return _distance_fields(self, width, height)
+
+
+@lru_cache(maxsize=DISTANCE_FIELD_CACHE_SIZE)
+def _distance_fields(preset: CompiledPreset, width: int, height: int) -> np.ndarray:
+    scale = np.array([width, height])
+    fields = np.empty((len(preset), width, height))
+    is_point = preset.kinds == "point"
+    fields[is_point] = point_distance_fields((preset.points * scale).astype(int), width, height)
+    fields[~is_point] = line_distance_fields(
+        (preset.lines * np.tile(scale, 2)).astype(int), width, height
+    )
+    distances = np.ascontiguousarray(fields.reshape(len(preset), width * height).T)
+    distances.flags.writeable = False
+    return distances
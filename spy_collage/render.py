@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+
+from spy_collage import metrics
+from spy_collage.files import move_into_place
+
+if TYPE_CHECKING:
+    # Pillow is only imported once a collage is rendered
+    from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# flush compressed image data to the file in chunks of roughly this size
+PNG_IDAT_SIZE = 1 << 20
+
+DEEP_ZOOM_TILE_SIZE = 256
+DEEP_ZOOM_DESCRIPTOR = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" \
+Format="{tile_format}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def cover_size(cover_path: Path) -> int:
+    from PIL import Image
+
+    with Image.open(cover_path) as cover:
+        return cover.width
+
+
+def load_cell(cover_path: Path, cell_size: int) -> Image.Image:
+    """
+    Loads a cover as a cell_size x cell_size RGB image, center-cropping covers that are not square.
+
+    JPEG covers larger than the cell are decoded at a reduced scale (draft mode) before resizing.
+    """
+    from PIL import Image, ImageOps
+
+    metrics.count("covers_decoded")
+    with Image.open(cover_path) as cover:
+        if cover.size == (cell_size, cell_size) and cover.mode == "RGB":
+            cover.load()
+            return cover.copy()
+        cover.draft("RGB", (cell_size, cell_size))
+        return ImageOps.fit(cover.convert("RGB"), (cell_size, cell_size), Image.Resampling.LANCZOS)
+
+
+class ThumbnailCache:
+    """
+    An on-disk cache of covers resized to a cell size, so that repeat renders at the same size
+    don't need to decode and resize the original covers again.
+
+    Thumbnails are keyed by the cover's path, size and modification time along with the cell size.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def thumbnail_path(self, cover_path: Path, cell_size: int) -> Path:
+        stat = cover_path.stat()
+        key = f"{cover_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.directory / str(cell_size) / f"{hashlib.sha1(key.encode()).hexdigest()}.png"
+
+    def load(self, cover_path: Path, cell_size: int) -> Image.Image:
+        thumbnail_path = self.thumbnail_path(cover_path, cell_size)
+        if thumbnail_path.exists():
+            metrics.count("thumbnail_cache_hits")
+            return load_cell(thumbnail_path, cell_size)
+
+        cell = load_cell(cover_path, cell_size)
+        thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=thumbnail_path.parent, suffix=".png")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                cell.save(f, format="PNG")
+            move_into_place(tmp_path, thumbnail_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return cell
+
+
+def iter_bands(
+    cover_paths: Sequence[Path],
+    shape: tuple[int, int],
+    cell_size: int,
+    thumbnails: Optional[ThumbnailCache] = None,
+    executor: Optional[Executor] = None,
+) -> Iterator[Image.Image]:
+    """
+    Yields the collage one row of covers at a time, as images of cell_size pixels high.
+
+    cover_paths holds the cover for each cell in column-major order, i.e. the cover at column x
+    and row y is cover_paths[x * height + y]. Each cover is loaded and resized to the cell size
+    (through thumbnails, if given) as its cell is placed, so at most one row of covers is ever
+    held in memory. If an executor is given, the covers of each row are loaded in parallel.
+    """
+    from PIL import Image
+
+    width, height = shape
+    load = load_cell if thumbnails is None else thumbnails.load
+    for y in range(height):
+        band = Image.new("RGB", (width * cell_size, cell_size), "white")
+        row_paths = [cover_paths[x * height + y] for x in range(width)]
+        cells = (
+            map(load, row_paths, [cell_size] * width)
+            if executor is None
+            else executor.map(load, row_paths, [cell_size] * width)
+        )
+        for x, cell in enumerate(cells):
+            band.paste(cell, (x * cell_size, 0))
+            cell.close()
+        yield band
+
+
+def reband(bands: Iterable[Image.Image], band_height: int) -> Iterator[Image.Image]:
+    """Re-slices a stream of bands of any heights into bands of band_height (except the last)."""
+    from PIL import Image
+
+    buffer: Optional[Image.Image] = None
+    filled = 0
+    for band in bands:
+        top = 0
+        while top < band.height:
+            if buffer is None:
+                buffer = Image.new("RGB", (band.width, band_height), "white")
+                filled = 0
+            rows = min(band_height - filled, band.height - top)
+            buffer.paste(band.crop((0, top, band.width, top + rows)), (0, filled))
+            filled += rows
+            top += rows
+            if filled == band_height:
+                yield buffer
+                buffer = None
+    if buffer is not None:
+        yield buffer.crop((0, 0, buffer.width, filled))
+
+
+def _save_tile(tile: Image.Image, path: Path):
+    tile.save(path)
+    tile.close()
+
+
+def _finish(futures: list[Future]):
+    """Waits for futures in order, raising the exception of the first that failed."""
+    for future in futures:
+        future.result()
+
+
+def write_deep_zoom(
+    output: Path,
+    size: tuple[int, int],
+    bands: Iterable[Image.Image],
+    tile_size: int = DEEP_ZOOM_TILE_SIZE,
+    tile_format: str = "jpg",
+    executor: Optional[Executor] = None,
+):
+    """
+    Writes a Deep Zoom (DZI) image pyramid, with the descriptor at output and the tiles in a
+    sibling <name>_files directory.
+
+    Bands of the full resolution image are re-sliced into rows of tiles. Each level is then built
+    by downsampling pairs of tile rows of the level below, so memory use stays proportional to a
+    single row of tiles rather than the whole image. Tiles are encoded and written in parallel
+    on executor, if given.
+    """
+    from PIL import Image
+
+    width, height = size
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    files_dir = output.with_name(f"{output.stem}_files")
+
+    level_sizes = {}
+    for level in range(max_level, -1, -1):
+        level_sizes[level] = (width, height)
+        (files_dir / str(level)).mkdir(parents=True, exist_ok=True)
+        width, height = math.ceil(width / 2), math.ceil(height / 2)
+
+    rows_written = {level: 0 for level in level_sizes}
+    pending_halves: dict[int, Optional[Image.Image]] = {level: None for level in level_sizes}
+    in_flight: list[Future] = []
+
+    def add_row(level: int, row: Image.Image):
+        # don't let encoding fall more than a couple of rows of tiles behind
+        nonlocal in_flight
+        if len(in_flight) > 2 * math.ceil(row.width / tile_size):
+            _finish(in_flight)
+            in_flight = []
+
+        row_index = rows_written[level]
+        for col, left in enumerate(range(0, row.width, tile_size)):
+            tile = row.crop((left, 0, min(left + tile_size, row.width), row.height))
+            tile_path = files_dir / str(level) / f"{col}_{row_index}.{tile_format}"
+            if executor is None:
+                _save_tile(tile, tile_path)
+            else:
+                in_flight.append(executor.submit(_save_tile, tile, tile_path))
+        rows_written[level] += 1
+        if level == 0:
+            return
+
+        # pair up rows to build the next level down
+        level_rows = math.ceil(level_sizes[level][1] / tile_size)
+        last = rows_written[level] == level_rows
+        half = pending_halves[level]
+        if half is None and not last:
+            pending_halves[level] = row
+            return
+        if half is not None:
+            pair = Image.new("RGB", (row.width, half.height + row.height))
+            pair.paste(half, (0, 0))
+            pair.paste(row, (0, half.height))
+            pending_halves[level] = None
+        else:
+            pair = row
+        add_row(level - 1, pair.reduce(2))
+
+    for row in reband(bands, tile_size):
+        add_row(max_level, row)
+    _finish(in_flight)
+
+    output.write_text(
+        DEEP_ZOOM_DESCRIPTOR.format(
+            tile_size=tile_size, tile_format=tile_format, width=size[0], height=size[1]
+        ),
+        encoding="utf-8",
+    )
+
+
+def render_deep_zoom(
+    output: Path,
+    cover_paths: Sequence[Path],
+    shape: tuple[int, int],
+    cell_size: int,
+    thumbnails: Optional[ThumbnailCache] = None,
+    workers: Optional[int] = None,
+):
+    """Renders a collage straight into a Deep Zoom pyramid, using up to workers threads."""
+    size = (shape[0] * cell_size, shape[1] * cell_size)
+    # Pillow releases the GIL while decoding, resizing and encoding, so threads use every core
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        bands = iter_bands(cover_paths, shape, cell_size, thumbnails=thumbnails, executor=executor)
+        write_deep_zoom(output, size, bands, executor=executor)
+
+
+def assemble(bands: Iterable[Image.Image], size: tuple[int, int]) -> Image.Image:
+    """Pastes bands top to bottom into a single in-memory image."""
+    from PIL import Image
+
+    canvas = Image.new("RGB", size, "white")
+    top = 0
+    for band in bands:
+        canvas.paste(band, (0, top))
+        top += band.height
+    return canvas
+
+
+def _write_png_chunk(f: BinaryIO, chunk_type: bytes, data: bytes):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+
+def write_png(f: BinaryIO, size: tuple[int, int], bands: Iterable[Image.Image]):
+    """
+    Writes an RGB PNG image of the given size to f, encoding it band by band so that the full
+    image never needs to be held in memory.
+    """
+    width, height = size
+    f.write(PNG_SIGNATURE)
+    _write_png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    compressor = zlib.compressobj()
+    pending = b""
+    for band in bands:
+        rows = np.asarray(band.convert("RGB"), dtype=np.uint8).reshape(band.height, width * 3)
+        # each scanline is prefixed by its filter type, 0 (none)
+        scanlines = np.concatenate([np.zeros((band.height, 1), dtype=np.uint8), rows], axis=1)
+        pending += compressor.compress(scanlines.tobytes())
+        if len(pending) >= PNG_IDAT_SIZE:
+            _write_png_chunk(f, b"IDAT", pending)
+            pending = b""
+    pending += compressor.flush()
+    _write_png_chunk(f, b"IDAT", pending)
+    _write_png_chunk(f, b"IEND", b"")
+
+
+def write_image(f: BinaryIO, size: tuple[int, int], bands: Iterable[Image.Image], extension: str):
+    """
+    Writes bands to f as an image in the format of the given file extension (e.g. ".png").
+
+    PNG images are streamed a band at a time, other formats are assembled in memory first.
+    """
+    if extension.lower() == ".png":
+        write_png(f, size, bands)
+    else:
+        from PIL import Image
+
+        image_format: Optional[str] = Image.registered_extensions().get(extension.lower())
+        assemble(bands, size).save(f, format=image_format)
+
+
+def supports_output(output: Path) -> bool:
+    """Returns whether collages can be saved to output, judging by its extension."""
+    from PIL import Image
+
+    extension = output.suffix.lower()
+    if extension in (".png", ".dzi"):
+        return True
+    return Image.registered_extensions().get(extension) in Image.SAVE
+
+
+def save_bands(output: Path, size: tuple[int, int], bands: Iterable[Image.Image]):
+    """
+    Saves bands to output, in the format given by its extension.
+
+    PNG output is streamed, so memory use is bounded by the size of a single band. Other formats
+    are assembled in memory before saving. The image is written to a temporary file first, so an
+    interrupted render never leaves a partial image at output.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=output.parent, prefix=f".{output.name}.", suffix=output.suffix
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_image(f, size, bands, output.suffix)
+        move_into_place(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
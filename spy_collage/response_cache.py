@@ -0,0 +1,226 @@
+import io
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+from spy_collage import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    body BLOB NOT NULL,
+    etag TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# how long responses from each Spotify API endpoint are used without revalidation, in seconds
+ENDPOINT_TTLS = {
+    "albums": 30 * DAY,
+    "albums/{id}": 30 * DAY,
+    "albums/{id}/tracks": 30 * DAY,
+    "tracks": 30 * DAY,
+    "tracks/{id}": 30 * DAY,
+    "artists/{id}/albums": DAY,
+    "playlists/{id}": HOUR,
+    "playlists/{id}/tracks": HOUR,
+}
+DEFAULT_TTL = DAY
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class OfflineCacheMiss(Exception):
+    """Raised in offline mode when a response is not in the cache."""
+
+    def __init__(self, url: str) -> None:
+        super().__init__(f"no cached response for {url}")
+        self.url = url
+
+
+def normalize_url(url: str, params: Optional[dict] = None) -> str:
+    """Merges params into url and sorts its query, so equivalent requests share a cache entry."""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [
+        (k, str(v)) for k, v in (params or {}).items() if v is not None
+    ]
+    return urlunsplit(parts._replace(query=urlencode(sorted(query)), fragment=""))
+
+
+def endpoint(url: str) -> str:
+    """
+    Returns the Spotify API endpoint of a request URL with IDs replaced by {id}, e.g.
+    https://api.spotify.com/v1/albums/4aawyAB9vmqN3uQ7FjRGTy/tracks -> albums/{id}/tracks.
+    """
+    segments = [s for s in urlsplit(url).path.split("/") if s]
+    if segments and segments[0] == "v1":
+        segments = segments[1:]
+    return "/".join("{id}" if i % 2 == 1 else s for i, s in enumerate(segments))
+
+
+class ResponseCache:
+    """
+    A persistent SQLite cache of Spotify API responses, keyed by request URL.
+
+    Responses are fresh for the TTL of their endpoint (see ENDPOINT_TTLS). Stale responses that
+    came with an ETag are revalidated with If-None-Match rather than downloaded again. When the
+    cache grows beyond max_bytes, the least recently used responses are evicted.
+
+    In offline mode, cached responses are used regardless of age and requests for anything else
+    raise OfflineCacheMiss instead of going to the network.
+    """
+
+    commit_interval = 64
+
+    def __init__(
+        self,
+        path: Path,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        offline: bool = False,
+        ttls: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.ttls = ENDPOINT_TTLS if ttls is None else ttls
+        # responses are looked up and stored from the threads that make the requests
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.executescript(SCHEMA)
+        self.__size = self.__conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        self.__pending = 0
+        if self.__size > self.max_bytes:
+            self.__evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ttl(self, url: str) -> float:
+        return self.ttls.get(endpoint(url), DEFAULT_TTL)
+
+    def get(self, url: str) -> Optional[tuple[bytes, Optional[str], bool]]:
+        """Returns the cached body and ETag of url and whether it is still fresh, if cached."""
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT body, etag, fetched_at FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.__write("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+        body, etag, fetched_at = row
+        return body, etag, time.time() - fetched_at < self.ttl(url)
+
+    def put(self, url: str, body: bytes, etag: Optional[str]):
+        now = time.time()
+        with self.__lock:
+            old = self.__conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self.__write(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, endpoint(url), body, etag, now, now, len(body)),
+            )
+            self.__size += len(body) - (old[0] if old else 0)
+            if self.__size > self.max_bytes:
+                self.__evict()
+
+    def refresh(self, url: str):
+        """Marks a cached response as fresh again, after the server confirmed it is unchanged."""
+        with self.__lock:
+            now = time.time()
+            self.__write(
+                "UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                (now, now, url),
+            )
+
+    def __write(self, sql: str, parameters: tuple):
+        self.__conn.execute(sql, parameters)
+        self.__pending += 1
+        if self.__pending >= self.commit_interval:
+            self.__commit()
+
+    def __evict(self):
+        rows = self.__conn.execute("SELECT url, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for url, size in rows:
+            if self.__size <= self.max_bytes:
+                break
+            evicted.append((url,))
+            self.__size -= size
+        self.__conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        self.__commit()
+
+    def __commit(self):
+        self.__conn.commit()
+        self.__pending = 0
+
+    def commit(self):
+        with self.__lock:
+            self.__commit()
+
+    def close(self):
+        with self.__lock:
+            self.__commit()
+            self.__conn.close()
+
+
+def cached_response(request: requests.PreparedRequest, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = "OK"
+    response.url = request.url or ""
+    response.request = request
+    response.encoding = "utf-8"
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    # the body is read from raw the first time the response's content is accessed
+    response.raw = io.BytesIO(body)
+    return response
+
+
+class CachedSession(requests.Session):
+    """A requests session that serves GET requests through a ResponseCache."""
+
+    def __init__(self, cache: ResponseCache) -> None:
+        super().__init__()
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        # requests are intercepted once prepared, so that the URL includes the query parameters
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        key = normalize_url(request.url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            body, etag, fresh = cached
+            if fresh or self.cache.offline:
+                metrics.count("spotify_cache_hits")
+                return cached_response(request, body)
+            if etag is not None:
+                request.headers["If-None-Match"] = etag
+        elif self.cache.offline:
+            raise OfflineCacheMiss(key)
+        metrics.count("spotify_cache_misses")
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            metrics.count("spotify_cache_revalidations")
+            self.cache.refresh(key)
+            return cached_response(request, cached[0])
+        if response.status_code == 200:
+            self.cache.put(key, response.content, response.headers.get("ETag"))
+        return response
@@ -0,0 +1,560 @@
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Optional
+
+import click
+import numpy as np
+import typer
+from PIL import Image
+
+from spy_collage import metrics, render
+from spy_collage.cli import format_error, format_info
+from spy_collage.cli.params import AlbumSource, AlbumSourceParam, CollageSize, CollageSizeParam
+from spy_collage.collage import EXTRACTOR_VERSIONS
+from spy_collage.color_problem import ColorMatrix, ColorSpace, Solver, solve_colors
+from spy_collage.feature_store import FeatureStore
+from spy_collage.main import (
+    FEATURES_CACHE_PATH,
+    SPOTIFY_CACHE_PATH,
+    THUMBNAIL_CACHE_PATH,
+    collect_features,
+)
+from spy_collage.models import AlbumCoverResolution, FeatureExtractor
+from spy_collage.presets import CompiledPreset, PresetError, compile_preset, preset_names
+from spy_collage.response_cache import ResponseCache
+from spy_collage.spotify import get_sp
+
+app = typer.Typer()
+
+# largest request body accepted, in bytes
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+# whether the service can listen on a Unix socket, which isn't possible on e.g. Windows
+UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+# size of the chunks the rendered image is streamed back in
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# fields of the JSON body of a collage request, see CollageJob.from_json
+JOB_FIELDS = {
+    "source",
+    "preset",
+    "dimensions",
+    "format",
+    "solver",
+    "candidate_factor",
+    "cell_size",
+    "discover",
+    "market",
+    "dedupe",
+    "dedupe_threshold",
+    "album_cover_resolution",
+    "extractor",
+}
+
+
+class JobError(Exception):
+    """Raised when a collage job cannot be run, with the HTTP status to respond with."""
+
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class CollageJob:
+    source: AlbumSource
+    preset: CompiledPreset
+    dimensions: CollageSize
+    image_format: str = "png"
+    solver: Solver = Solver.hungarian
+    candidate_factor: Optional[float] = None
+    cell_size: Optional[int] = None
+    discover: bool = False
+    market: str = "US"
+    dedupe: bool = False
+    dedupe_threshold: int = 0
+    album_cover_resolution: AlbumCoverResolution = AlbumCoverResolution.medium
+    extractor: FeatureExtractor = FeatureExtractor.colorgram
+
+    @classmethod
+    def from_json(cls, body: dict[str, Any]) -> "CollageJob":
+        """
+        Reads a job from the JSON body of a request, e.g.
+
+            {"source": "spotify:playlist:...", "preset": "red_vs_blue", "dimensions": "20x20"}
+
+        source is given as on the command line, or as a list of album and playlist URIs or of
+        albums as JSON. The other fields are optional and named after the options of spy-collage,
+        along with format, the image format to respond with (png by default).
+        """
+        unknown = set(body) - JOB_FIELDS
+        if unknown:
+            raise JobError(f"unknown fields: {sorted(unknown)}")
+        try:
+            preset = compile_preset(body["preset"])
+            dimensions = CollageSizeParam().convert(str(body["dimensions"]))
+            job = cls(
+                _read_source(body["source"]),
+                preset,
+                dimensions,
+                image_format=str(body.get("format", "png")).lower().lstrip("."),
+                solver=Solver(body.get("solver", Solver.hungarian)),
+                candidate_factor=_optional(float, body.get("candidate_factor")),
+                cell_size=_optional(int, body.get("cell_size")),
+                discover=bool(body.get("discover", False)),
+                market=str(body.get("market", "US")),
+                dedupe=bool(body.get("dedupe", False)),
+                dedupe_threshold=int(body.get("dedupe_threshold", 0)),
+                album_cover_resolution=AlbumCoverResolution(
+                    body.get("album_cover_resolution", AlbumCoverResolution.medium)
+                ),
+                extractor=FeatureExtractor(body.get("extractor", FeatureExtractor.colorgram)),
+            )
+        except KeyError as e:
+            raise JobError(f"missing field {e}") from None
+        except PresetError as e:
+            raise JobError(str(e)) from None
+        except click.BadParameter as e:
+            raise JobError(e.message) from None
+        except (TypeError, ValueError) as e:
+            raise JobError(f"invalid job: {e}") from None
+
+        if job.dimensions.width < 1 or job.dimensions.height < 1:
+            raise JobError("dimensions must be at least 1x1")
+        if job.cell_size is not None and job.cell_size < 1:
+            raise JobError("cell_size must be at least 1")
+        if f".{job.image_format}" not in Image.registered_extensions():
+            raise JobError(f"unsupported image format {job.image_format}")
+        return job
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.dimensions.width, self.dimensions.height
+
+
+def _optional(convert: Callable[[Any], Any], value: Any) -> Any:
+    return None if value is None else convert(value)
+
+
+def _read_source(source: Any) -> AlbumSource:
+    if isinstance(source, str):
+        return AlbumSourceParam().convert(source)
+    if isinstance(source, list) and source and all(isinstance(s, str) for s in source):
+        return AlbumSource(list(dict.fromkeys(source)))
+    if isinstance(source, list) and source and all(isinstance(s, dict) for s in source):
+        return AlbumSource([album["uri"] for album in source], json_albums=source)
+    raise TypeError("source must be a string, a list of URIs or a list of albums")
+
+
+@dataclass
+class ArrangedCollage:
+    cover_paths: list[Path]
+    shape: tuple[int, int]
+    cost: float
+    albums: int
+    cell_size: Optional[int] = None
+
+
+class CollageService:
+    """
+    Generates collages for a long-running server, keeping the Spotify client, the response and
+    feature caches and compiled presets warm between jobs.
+
+    Jobs are queued for a pool of worker threads. Albums are collected for one job at a time,
+    since the feature store is not safe for concurrent use, while the collages of other jobs are
+    arranged and rendered.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        queue_size: int = 16,
+        spotify_workers: int = 8,
+        download_workers: int = 8,
+        jobs: Optional[int] = None,
+        spotify_cache: bool = True,
+        spotify_cache_size: int = 256,
+        offline: bool = False,
+        api_url: Optional[str] = None,
+    ) -> None:
+        self.workers = workers
+        self.queue_size = queue_size
+        self.spotify_workers = spotify_workers
+        self.download_workers = download_workers
+        self.jobs = jobs
+        self.offline = offline
+        self.response_cache = None
+        if spotify_cache or offline:
+            self.response_cache = ResponseCache(
+                SPOTIFY_CACHE_PATH, max_bytes=spotify_cache_size * 1024 * 1024, offline=offline
+            )
+        self.sp = get_sp(response_cache=self.response_cache, api_url=api_url)
+        self.thumbnails = render.ThumbnailCache(THUMBNAIL_CACHE_PATH)
+        self.__stores: dict[FeatureExtractor, FeatureStore] = {}
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix="collage")
+        self.__collect_lock = threading.Lock()
+        self.__lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def status(self) -> dict[str, Any]:
+        with self.__lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "counters": dict(metrics.metrics.counters),
+            }
+
+    def submit(self, job: CollageJob, respond: Callable[[ArrangedCollage], None]) -> Future:
+        """
+        Queues job, calling respond with the arranged collage from the worker that ran it so the
+        image can be rendered as it is sent. Raises JobError if too many jobs are already queued.
+        """
+        with self.__lock:
+            if self.pending >= self.workers + self.queue_size:
+                raise JobError("too many collages queued", HTTPStatus.SERVICE_UNAVAILABLE)
+            self.pending += 1
+        return self.__executor.submit(self.__run, job, respond)
+
+    def __run(self, job: CollageJob, respond: Callable[[ArrangedCollage], None]):
+        try:
+            respond(self.arrange(job))
+        except BaseException:
+            with self.__lock:
+                self.failed += 1
+            raise
+        else:
+            with self.__lock:
+                self.completed += 1
+        finally:
+            with self.__lock:
+                self.pending -= 1
+
+    def store(self, extractor: FeatureExtractor) -> FeatureStore:
+        store = self.__stores.get(extractor)
+        if store is None:
+            store = FeatureStore(FEATURES_CACHE_PATH, EXTRACTOR_VERSIONS[extractor])
+            store.evict_missing()
+            self.__stores[extractor] = store
+        return store
+
+    def arrange(self, job: CollageJob) -> ArrangedCollage:
+        """Collects the albums of job and arranges them into a collage, ready to render."""
+        with self.__collect_lock:
+            try:
+                _, features = collect_features(
+                    job.source,
+                    discover=job.discover,
+                    market=job.market,
+                    dedupe=job.dedupe,
+                    dedupe_threshold=job.dedupe_threshold,
+                    album_cover_resolution=job.album_cover_resolution,
+                    spotify_workers=self.spotify_workers,
+                    download_workers=self.download_workers,
+                    jobs=self.jobs,
+                    extractor=job.extractor,
+                    offline=self.offline,
+                    sp=self.sp,
+                    store=self.store(job.extractor),
+                )
+            except typer.Abort:
+                raise JobError(
+                    "could not collect the albums, see the server log", HTTPStatus.BAD_GATEWAY
+                ) from None
+
+        cells = job.dimensions.width * job.dimensions.height
+        if len(features) < cells:
+            raise JobError(
+                f"product of width and height dimensions ({job.dimensions.width} x"
+                f" {job.dimensions.height} = {cells}) must be less than or equal to the number of"
+                f" album covers ({len(features)})",
+                HTTPStatus.UNPROCESSABLE_ENTITY,
+            )
+        colors = ColorMatrix(np.asarray([f.features for f in features]), ColorSpace.CIELAB)
+        assignment = solve_colors(
+            job.shape,
+            colors,
+            ColorSpace.CIELAB,
+            job.preset.key_objects(*job.shape),
+            solver=job.solver,
+            candidate_factor=job.candidate_factor,
+            space_distances=job.preset.distance_fields(*job.shape),
+        )
+        cover_paths = [features[i].image_path for i in assignment.colors]
+        return ArrangedCollage(
+            cover_paths, job.shape, assignment.cost, len(features), cell_size=job.cell_size
+        )
+
+    def render(self, collage: ArrangedCollage, f: BinaryIO, image_format: str):
+        """
+        Renders an arranged collage to f as an image of the given format, like
+        collage.render_collage.
+        """
+        width, height = collage.shape
+        cell_size = collage.cell_size or render.cover_size(collage.cover_paths[0])
+        thumbnails = self.thumbnails if collage.cell_size is not None else None
+        bands = render.iter_bands(collage.cover_paths, collage.shape, cell_size, thumbnails)
+        with metrics.phase("render"):
+            render.write_image(
+                f, (width * cell_size, height * cell_size), bands, f".{image_format}"
+            )
+
+    def close(self):
+        self.__executor.shutdown(cancel_futures=True)
+        for store in self.__stores.values():
+            store.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+
+
+class ChunkedWriter(io.RawIOBase):
+    """Writes to a response body with chunked transfer encoding."""
+
+    def __init__(self, wfile: io.BufferedIOBase) -> None:
+        super().__init__()
+        self.wfile = wfile
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        if data:
+            self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def finish(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class CollageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the HTTP API of a CollageService:
+
+        GET /presets   the names of the available presets
+        GET /status    the number of pending, completed and failed jobs, and run counters
+        POST /collage  generates the collage described by the JSON body (see CollageJob) and
+                       streams it back as an image, with its cost in the X-Collage-Cost header
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "CollageServer"
+
+    def address_string(self) -> str:
+        # clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def send_json(self, body: Any, status: HTTPStatus = HTTPStatus.OK):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, message: str, status: HTTPStatus):
+        self.send_json({"error": message}, status)
+
+    def do_GET(self):
+        if self.path == "/presets":
+            self.send_json({"presets": preset_names()})
+        elif self.path == "/status":
+            self.send_json(self.server.service.status())
+        else:
+            self.send_error_json(f"not found: {self.path}", HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        if self.path != "/collage":
+            self.send_error_json(f"not found: {self.path}", HTTPStatus.NOT_FOUND)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self.send_error_json("request too large", HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
+        try:
+            body = json.loads(self.rfile.read(length))
+            if not isinstance(body, dict):
+                raise JobError("request body must be a JSON object")
+            job = CollageJob.from_json(body)
+        except json.JSONDecodeError:
+            self.send_error_json("request body must be JSON", HTTPStatus.BAD_REQUEST)
+            return
+        except JobError as e:
+            self.send_error_json(str(e), e.status)
+            return
+
+        sent_headers = False
+
+        def respond(collage: ArrangedCollage):
+            nonlocal sent_headers
+            content_type = Image.MIME.get(
+                Image.registered_extensions()[f".{job.image_format}"],
+                "application/octet-stream",
+            )
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("X-Collage-Cost", f"{collage.cost:.6g}")
+            self.send_header("X-Collage-Albums", str(collage.albums))
+            self.end_headers()
+            sent_headers = True
+            writer = ChunkedWriter(self.wfile)
+            with io.BufferedWriter(writer, RESPONSE_CHUNK_SIZE) as f:
+                self.server.service.render(collage, f, job.image_format)
+                f.flush()
+                writer.finish()
+
+        try:
+            self.server.service.submit(job, respond).result()
+        except JobError as e:
+            self.send_error_json(str(e), e.status)
+        except Exception as e:  # the client hears about any failure before the image is sent
+            if sent_headers:
+                # a truncated chunked response is the only way left to signal the failure
+                self.close_connection = True
+                raise
+            self.send_error_json(
+                f"could not generate the collage: {e!r}", HTTPStatus.INTERNAL_SERVER_ERROR
+            )
+            raise
+
+
+class CollageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: CollageService) -> None:
+        super().__init__(address, CollageRequestHandler)
+        self.service = service
+
+
+class UnixCollageServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # like socketserver.UnixStreamServer, which only exists where Unix sockets do (e.g. not on
+    # Windows, where --socket is rejected)
+    if UNIX_SOCKETS:
+        address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def __init__(self, path: Path, service: CollageService) -> None:
+        super().__init__(str(path), CollageRequestHandler)  # type: ignore[arg-type]
+        self.service = service
+
+
+@app.command()
+def serve(
+    host: str = typer.Option("127.0.0.1", help="Address to listen for HTTP requests on"),
+    port: int = typer.Option(8765, min=0, max=65535, help="Port to listen for HTTP requests on"),
+    socket_path: Optional[Path] = typer.Option(
+        None,
+        "--socket",
+        dir_okay=False,
+        help="Listen on this Unix socket instead of a TCP port",
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="Number of collages to arrange and render at once (defaults to all CPU cores)",
+    ),
+    queue_size: int = typer.Option(
+        16,
+        min=0,
+        help="Number of collages to queue while the workers are busy before turning requests away",
+    ),
+    spotify_workers: int = typer.Option(
+        8,
+        min=1,
+        help="Maximum number of concurrent requests to the Spotify API when collecting albums",
+    ),
+    download_workers: int = typer.Option(
+        8, min=1, help="Number of album covers to download concurrently"
+    ),
+    jobs: Optional[int] = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        min=1,
+        help="Number of processes to extract album art features with (defaults to all CPU cores)",
+    ),
+    spotify_cache: bool = typer.Option(
+        True, help="Enable/disable caching Spotify API responses across runs"
+    ),
+    spotify_cache_size: int = typer.Option(
+        256,
+        min=1,
+        help="Maximum size of the Spotify API response cache in MB, least recently used first",
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help=(
+            "Run entirely from cached Spotify API responses and previously downloaded album"
+            " covers"
+        ),
+    ),
+    spotify_api_url: Optional[str] = typer.Option(
+        None,
+        help=(
+            "Send Spotify API requests to this URL without credentials instead, e.g. to a local"
+            " mock of the API for testing"
+        ),
+    ),
+):
+    """
+    Runs a local collage service, which keeps the Spotify client, caches and presets warm between
+    collages. POST a JSON job such as {"source": "spotify:playlist:...", "preset": "red_vs_blue",
+    "dimensions": "20x20"} to /collage to receive the collage as a PNG.
+    """
+    if socket_path is not None and not UNIX_SOCKETS:
+        typer.echo(format_error("--socket is not supported on this platform"))
+        raise typer.Abort()
+    service = CollageService(
+        workers=workers or os.cpu_count() or 1,
+        queue_size=queue_size,
+        spotify_workers=spotify_workers,
+        download_workers=download_workers,
+        jobs=jobs,
+        spotify_cache=spotify_cache,
+        spotify_cache_size=spotify_cache_size,
+        offline=offline,
+        api_url=spotify_api_url,
+    )
+    server: socketserver.BaseServer
+    if socket_path is not None:
+        if socket_path.is_socket():
+            socket_path.unlink()
+        server = UnixCollageServer(socket_path, service)
+        address = str(socket_path)
+    else:
+        server = CollageServer((host, port), service)
+        address = f"http://{host}:{server.server_address[1]}"
+
+    typer.echo(format_info(f"serving collages at {address} with {service.workers} workers"))
+    with service, server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if socket_path is not None:
+                socket_path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    app()
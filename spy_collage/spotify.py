@@ -1,17 +1,37 @@
+from __future__ import annotations
+
 import configparser
+import os
+import tempfile
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from functools import cache
 from os import environ
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional
 
-import dateparser
 import requests
 import spotify_uri
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from spy_collage import metrics
+from spy_collage.discovery import DiscoveryIndex, needs_discovery
+from spy_collage.files import move_into_place
 from spy_collage.models import AlbumCoverResolution
+from spy_collage.pipeline import completed, ordered
+from spy_collage.response_cache import CachedSession, ResponseCache
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+
+DOWNLOAD_TIMEOUT = 15
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
-__discovery_cache: dict[str, list[dict]] = {}
+# maximum number of IDs per request to the batch album and track endpoints
+ALBUMS_BATCH_SIZE = 20
+TRACKS_BATCH_SIZE = 50
+# maximum number of concurrent requests to the Spotify API
+MAX_CONCURRENT_REQUESTS = 8
 
 
 def __read_credentials(credentials_path):
@@ -20,129 +40,376 @@ def __read_credentials(credentials_path):
     return config["spotify"]["client_id"], config["spotify"]["client_secret"]
 
 
-def __collect_all_items(sp: Spotify, results) -> list[dict]:
-    items = results["items"]
-    while results["next"]:
-        results = sp.next(results)
-        items.extend(results["items"])
-    return items
+def __remaining_offsets(results) -> list[int]:
+    """Returns the offsets of every page after the given first page of a paging object."""
+    if not results["next"]:
+        return []
+    start = results["offset"] + results["limit"]
+    return list(range(start, results["total"], results["limit"]))
+
+
+def __iter_all_items(
+    fetch_page: Callable[[int, int], dict], results, executor: Optional[Executor] = None
+) -> Iterator[dict]:
+    """
+    Yields the items of every page of a paging object, given its first page and
+    fetch_page(offset, limit), which requests the page at offset.
+
+    The remaining pages are requested by offset rather than by following next links, so if an
+    executor is given they are all fetched concurrently, and each page is yielded as soon as it
+    (and the pages before it) arrive.
+    """
+    yield from results["items"]
+    limit = results["limit"]
+    offsets = __remaining_offsets(results)
+    pages = (
+        map(lambda offset: fetch_page(offset, limit), offsets)
+        if executor is None
+        else executor.map(lambda offset: fetch_page(offset, limit), offsets)
+    )
+    for page in pages:
+        yield from page["items"]
+
+
+def __collect_all_items(
+    fetch_page: Callable[[int, int], dict], results, executor: Optional[Executor] = None
+) -> list[dict]:
+    """Collects the items of every page of a paging object, see __iter_all_items."""
+    return list(__iter_all_items(fetch_page, results, executor))
+
+
+def __artist_albums_page(sp: Spotify, artist_uri: str) -> Callable[[int, int], dict]:
+    return lambda offset, limit: sp.artist_albums(
+        artist_uri, album_type="album", limit=limit, offset=offset
+    )
+
+
+def __album_tracks_page(sp: Spotify, album_uri: str) -> Callable[[int, int], dict]:
+    return lambda offset, limit: sp.album_tracks(album_uri, limit=limit, offset=offset)
+
+
+def __playlist_items_page(sp: Spotify, playlist_uri: str) -> Callable[[int, int], dict]:
+    # like sp.playlist, which returns the first page, only request tracks (not episodes)
+    return lambda offset, limit: sp.playlist_items(
+        playlist_uri, limit=limit, offset=offset, additional_types=("track",)
+    )
+
+
+def __fetch_batched(
+    fetch: Callable[[list[str]], list[dict]],
+    uris: list[str],
+    batch_size: int,
+    executor: Executor,
+) -> list[Future]:
+    """Submits fetch for each batch of uris, returning the futures in order."""
+    return [
+        executor.submit(fetch, uris[i : i + batch_size]) for i in range(0, len(uris), batch_size)
+    ]
 
 
 @cache
-def get_sp(credentials_path="spotify_credentials.ini") -> Spotify:
+def get_sp(
+    credentials_path="spotify_credentials.ini",
+    response_cache: Optional[ResponseCache] = None,
+    api_url: Optional[str] = None,
+) -> Spotify:
+    """
+    Creates a Spotify client, which serves requests through response_cache if given.
+
+    If response_cache is offline, no credentials are needed since nothing is requested from Spotify.
+    If api_url is given, requests are sent there instead of the Spotify Web API without
+    credentials, e.g. to a local mock of the API for testing.
+    """
+    from spotipy import Spotify
+    from spotipy.oauth2 import SpotifyClientCredentials
+
+    session = requests.Session() if response_cache is None else CachedSession(response_cache)
+    # rate limited (429) and server error responses are retried, honoring Retry-After
+    mount_retry_adapter(session, pool_size=MAX_CONCURRENT_REQUESTS)
+    # only responses that came from the network (not the response cache) reach the hook
+    session.hooks["response"].append(lambda *args, **kwargs: metrics.count("spotify_api_requests"))
+    if response_cache is not None and response_cache.offline:
+        return Spotify(auth="offline", requests_session=session)
+    if api_url is not None:
+        spotify = Spotify(auth="local", requests_session=session, requests_timeout=15)
+        spotify.prefix = api_url.rstrip("/") + "/"
+        return spotify
+
     if "SPOTIPY_CLIENT_ID" not in environ or "SPOTIPY_CLIENT_SECRET" not in environ:
         print("Reading Spotify credentials from spotify_credentials.ini...")
         client_id, client_secret = __read_credentials(credentials_path)
         environ["SPOTIPY_CLIENT_ID"] = client_id
         environ["SPOTIPY_CLIENT_SECRET"] = client_secret
-    spotify = Spotify(client_credentials_manager=SpotifyClientCredentials(), requests_timeout=15)
+    spotify = Spotify(
+        client_credentials_manager=SpotifyClientCredentials(),
+        requests_session=session,
+        requests_timeout=15,
+    )
     return spotify
 
 
-def __is_duplicate_track(t1: dict, t2: dict) -> bool:
-    matching_name = t1["name"] == t2["name"]
-    matching_artists = len(t1["artists"]) == len(t2["artists"])
-    for a1, a2 in zip(t1["artists"], t2["artists"]):
-        if a1["uri"] != a2["uri"]:
-            matching_artists = False
-    matching_duration = abs(t1["duration_ms"] - t2["duration_ms"]) < 2000
+def create_discovery_index(sp: Spotify, user_market: str) -> DiscoveryIndex:
+    return DiscoveryIndex(
+        lambda artist_uri: __collect_all_items(
+            __artist_albums_page(sp, artist_uri), sp.artist_albums(artist_uri, album_type="album")
+        ),
+        lambda album_uri: __collect_all_items(
+            __album_tracks_page(sp, album_uri), sp.album_tracks(album_uri)
+        ),
+        user_market,
+    )
 
-    return matching_name and matching_artists and matching_duration
 
-
-def discover_album(sp: Spotify, track: dict, user_market: str) -> tuple[dict, bool]:
+def discover_album(
+    sp: Spotify, track: dict, user_market: str, index: Optional[DiscoveryIndex] = None
+) -> tuple[dict, bool]:
     """
     If the supplied track is a single release, attempts to locate a full album release that
     contains the track.
 
-    If one cannot be found, returns the album of the given track as-is.
+    If one cannot be found, returns the album of the given track as-is. Pass the same index to
+    discover albums for many tracks without fetching any artist's catalog more than once.
     """
-    if track["album"]["album_type"] == "album" and (
-        "album_group" not in track["album"] or track["album"]["album_group"] == "album"
-    ):
-        return track["album"], False
-    track_album_release_date = dateparser.parse(track["album"]["release_date"])
-    assert track_album_release_date is not None
+    if index is None:
+        index = create_discovery_index(sp, user_market)
+    return index.discover(track)
 
-    album_artist_uri = track["album"]["artists"][0]["uri"]
-    if album_artist_uri in __discovery_cache:
-        albums = __discovery_cache[album_artist_uri]
-    else:
-        albums = __collect_all_items(sp, sp.artist_albums(album_artist_uri, album_type="album"))
-        __discovery_cache[album_artist_uri] = albums
 
-    for album in albums:
-        album_release_date = dateparser.parse(album["release_date"])
-        assert album_release_date is not None
-        if album_release_date < track_album_release_date:
-            continue
-        if user_market and user_market not in album["available_markets"]:
+def discover_albums(
+    index: DiscoveryIndex, tracks: list[dict], executor: Executor
+) -> Iterator[tuple[dict, bool]]:
+    """
+    Discovers albums for each of tracks, yielding the same results as calling discover_album on
+    each in order.
+
+    Each artist's singles are resolved in order as one task on executor, which fetches the artist's
+    catalog first, so different artists' catalogs and album tracklists are fetched concurrently
+    while each artist's are still only fetched as needed. The result for each track is yielded as
+    soon as the task of its artist (and of the tracks before it) has finished.
+    """
+    singles_by_artist: dict[str, list[int]] = {}
+    for i, track in enumerate(tracks):
+        if needs_discovery(track):
+            singles_by_artist.setdefault(track["album"]["artists"][0]["uri"], []).append(i)
+
+    new_artists = sum(uri not in index.artists for uri in singles_by_artist)
+    if new_artists:
+        print(f"Fetching albums of {new_artists} artists for discovery...")
+    # the position of each single -> the task of its artist, and its position in the results
+    singles: dict[int, tuple[Future, int]] = {}
+    for positions in singles_by_artist.values():
+        future = executor.submit(lambda ps: [index.discover(tracks[i]) for i in ps], positions)
+        singles.update((i, (future, j)) for j, i in enumerate(positions))
+
+    for i, track in enumerate(tracks):
+        if i not in singles:
+            yield track["album"], False
             continue
-        if len(album["artists"]) > 1:
-            continue  # this is likely a compilation album (e.g. Ophelia Vol 2 by Seven Lions)
+        future, j = singles[i]
+        with metrics.phase("discover"):
+            results = future.result()
+        yield results[j]
 
-        if album["uri"] in __discovery_cache:
-            album_tracks = __discovery_cache[album["uri"]]
-        else:
-            album_tracks = __collect_all_items(sp, sp.album_tracks(album["uri"]))
-            __discovery_cache[album["uri"]] = album_tracks
 
-        for album_track in album_tracks:
-            if __is_duplicate_track(track, album_track):
-                return album, True
+def fetch_inputs(
+    sp: Spotify, uris: list[str], executor: Executor
+) -> tuple[Iterator[dict], Iterator[dict]]:
+    """
+    Fetches the albums and tracks referred to by a list of album, playlist and track URIs, returning
+    iterators over the albums and tracks in input order.
 
-    return track["album"], False
+    Albums and tracks are requested through the batch endpoints, and every batch and the first
+    page of every playlist is requested on executor up front. The iterators yield each batch or
+    page as soon as it (and those before it) arrive, requesting the remaining pages of each
+    playlist concurrently once its first page has.
+    """
+    parsed = [(uri, spotify_uri.parse(uri).type) for uri in uris]
+    album_uris = [uri for uri, uri_type in parsed if uri_type == "album"]
+    track_uris = [uri for uri, uri_type in parsed if uri_type == "track"]
+    playlist_uris = [uri for uri, uri_type in parsed if uri_type == "playlist"]
 
+    album_batches = __fetch_batched(
+        lambda batch: sp.albums(batch)["albums"], album_uris, ALBUMS_BATCH_SIZE, executor
+    )
+    track_batches = __fetch_batched(
+        lambda batch: sp.tracks(batch)["tracks"], track_uris, TRACKS_BATCH_SIZE, executor
+    )
+    first_pages = {uri: executor.submit(sp.playlist, uri) for uri in playlist_uris}
 
-def collect_albums(
-    uris: list[str], discovery_enabled: bool = True, user_market: str = "US"
-) -> list[dict]:
-    sp = get_sp()
-
-    albums = []
-    tracks = []
-    for i, uri in enumerate(uris):
-        print(f"Processing input {i+1}/{len(uris)}", end="\r")
-        parsed = spotify_uri.parse(uri)
-        if parsed.type == "album":
-            albums.append(sp.album(uri))
-        elif parsed.type == "playlist":
-            print(f"Collecting items from playlist {uri}...")
-            playlist_tracks = __collect_all_items(sp, sp.playlist(uri)["tracks"])
-            for t in playlist_tracks:
-                tracks.append(t["track"])
-        elif parsed.type == "track":
-            tracks.append(sp.track(uri))
-    print()
-
-    for i, t in enumerate(tracks):
-        print(f"Processing track {i+1}/{len(tracks)}", end="\r")
-        if discovery_enabled:
-            album, discovered = discover_album(sp, t, user_market=user_market)
+    def iter_tracks() -> Iterator[dict]:
+        fetched_tracks = 0
+        for uri, uri_type in parsed:
+            if uri_type == "track":
+                batch, i = divmod(fetched_tracks, TRACKS_BATCH_SIZE)
+                yield track_batches[batch].result()[i]
+                fetched_tracks += 1
+            elif uri_type == "playlist":
+                print(f"Collecting items from playlist {uri}...")
+                items = __iter_all_items(
+                    __playlist_items_page(sp, uri), first_pages[uri].result()["tracks"], executor
+                )
+                yield from (item["track"] for item in items)
+
+    albums = (album for batch in album_batches for album in batch.result())
+    return albums, iter_tracks()
+
+
+def iter_albums(
+    uris: list[str],
+    discovery_enabled: bool = True,
+    user_market: str = "US",
+    sp: Optional[Spotify] = None,
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+) -> Iterator[dict]:
+    """
+    Yields the albums referred to by a list of album, playlist and track URIs: first the albums,
+    then the album of each track (or the album discovered for it, if discovery is enabled).
+
+    Albums are yielded as the requests for them complete, with at most max_workers requests in
+    flight. Discovery needs every track to group singles by artist, so with discovery enabled the
+    albums of tracks are only yielded once every track has been fetched.
+    """
+    if sp is None:
+        sp = get_sp()
+
+    print(f"Processing {len(uris)} inputs...")
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        albums, tracks = fetch_inputs(sp, uris, executor)
+        yield from albums
+
+        if not discovery_enabled:
+            yield from (t["album"] for t in tracks)
+            return
+        index = create_discovery_index(sp, user_market)
+        fetched_tracks = list(tracks)
+        discovered_albums = discover_albums(index, fetched_tracks, executor)
+        for t, (album, discovered) in zip(fetched_tracks, discovered_albums):
             if discovered:
                 print(
                     f"    * Discovered album {album['name']} for {t['artists'][0]['name']} -"
                     f" {t['album']['name']}"
                 )
-        else:
-            album = t["album"]
-        albums.append(album)
-    if tracks:
-        print()
+            yield album
+    finally:
+        # if iteration stopped early, requests that have not started yet are not sent
+        executor.shutdown(cancel_futures=True)
 
-    return albums
+
+def collect_albums(
+    uris: list[str],
+    discovery_enabled: bool = True,
+    user_market: str = "US",
+    sp: Optional[Spotify] = None,
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+) -> list[dict]:
+    return list(
+        iter_albums(
+            uris,
+            discovery_enabled=discovery_enabled,
+            user_market=user_market,
+            sp=sp,
+            max_workers=max_workers,
+        )
+    )
 
 
-def download_cover(album: dict, path: Path, size: AlbumCoverResolution):
+def cover_url(album: dict, size: AlbumCoverResolution) -> str:
     images = album["images"]
     images.sort(key=lambda i: i["width"])
     if size == AlbumCoverResolution.small:
-        url = images[0]["url"]
+        return images[0]["url"]
     elif size == AlbumCoverResolution.medium:
-        url = images[int(len(images) / 2)]["url"]
+        return images[int(len(images) / 2)]["url"]
     else:
-        url = images[-1]["url"]
+        return images[-1]["url"]
+
+
+def mount_retry_adapter(
+    session: requests.Session, pool_size: int = 10, retries: int = 5
+) -> requests.Session:
+    """
+    Makes session keep up to pool_size connections alive and retry rate-limited (429) and server
+    error responses with exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def create_download_session(pool_size: int = 10, retries: int = 5) -> requests.Session:
+    """Creates a session for downloading covers, see mount_retry_adapter."""
+    return mount_retry_adapter(requests.Session(), pool_size=pool_size, retries=retries)
+
+
+def download_cover(
+    album: dict,
+    path: Path,
+    size: AlbumCoverResolution,
+    session: Optional[requests.Session] = None,
+):
+    """
+    Downloads the album's cover art to path.
+
+    The body is streamed to a temporary file next to path, which is only moved into place once
+    the download completes, so an interrupted download never leaves a truncated file at path.
+    """
+    if session is None:
+        session = create_download_session(pool_size=1)
+    with session.get(cover_url(album, size), stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as of:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    of.write(chunk)
+                    metrics.count("cover_bytes_downloaded", len(chunk))
+            move_into_place(tmp_path, path)
+            metrics.count("covers_downloaded")
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _download_cover(
+    album: dict, path: Path, size: AlbumCoverResolution, session: requests.Session
+) -> Path:
+    download_cover(album, path, size, session)
+    return path
+
+
+def iter_covers(
+    covers: Iterable[tuple[dict, Path]],
+    size: AlbumCoverResolution,
+    workers: int = 8,
+    download: bool = True,
+) -> Iterator[Path]:
+    """
+    Yields the path of each (album, path) pair in order once the album's cover is saved there,
+    downloading missing covers as pairs arrive using up to workers concurrent connections.
+
+    Unless download is set, missing covers raise FileNotFoundError instead.
+    """
+    downloads: dict[Path, Future] = {}
+    with create_download_session(pool_size=workers) as session, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+
+        def saved(album: dict, path: Path) -> Future:
+            if path not in downloads:
+                if path.exists():
+                    return completed(path)
+                if not download:
+                    raise FileNotFoundError(f"album cover {path} has not been downloaded")
+                downloads[path] = executor.submit(_download_cover, album, path, size, session)
+            return downloads[path]
 
-    r = requests.get(url)
-    with open(path, "wb") as of:
-        of.write(r.content)
+        yield from ordered((saved(album, path) for album, path in covers), window=4 * workers)
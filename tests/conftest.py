@@ -0,0 +1,33 @@
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, Union
+
+import pytest
+
+
+def quiet(handler: type[BaseHTTPRequestHandler]) -> type[BaseHTTPRequestHandler]:
+    """Returns handler without its logging of every request to stderr."""
+    return type(handler.__name__, (handler,), {"log_message": lambda self, format, *args: None})
+
+
+@pytest.fixture
+def local_server() -> Iterator[Callable[..., str]]:
+    """
+    Starts servers on a local port in background threads for the duration of a test, given either
+    a request handler to serve with a ThreadingHTTPServer or a server that is already bound.
+    Returns the host:port address of each server. Handlers given are served without logging.
+    """
+    servers: list[socketserver.BaseServer] = []
+
+    def start(server: Union[type[BaseHTTPRequestHandler], socketserver.TCPServer]) -> str:
+        if not isinstance(server, socketserver.BaseServer):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), quiet(server))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
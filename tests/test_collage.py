@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image
+
+from spy_collage.collage import (
+    DuplicateIndex,
+    ImageFeatures,
+    dominant_color_colorgram,
+    dominant_color_numpy,
+)
+
+
+def save(image: Image.Image, path):
+    image.save(path)
+    return path
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_dominant_color_numpy_matches_colorgram(tmp_path, seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (40, 30, 3), dtype=np.uint8)
+    path = save(Image.fromarray(pixels), tmp_path / "cover.png")
+    assert dominant_color_numpy(path, sample_size=None) == tuple(dominant_color_colorgram(path))
+
+
+@pytest.mark.parametrize("order", [[(0, 0, 0), (255, 255, 255)], [(255, 255, 255), (0, 0, 0)]])
+def test_dominant_color_numpy_breaks_ties_like_colorgram(tmp_path, order):
+    image = Image.new("RGB", (2, 1))
+    for x, color in enumerate(order):
+        image.putpixel((x, 0), color)
+    path = save(image, tmp_path / "tie.png")
+    assert dominant_color_numpy(path) == tuple(dominant_color_colorgram(path)) == (0, 0, 0)
+
+
+@pytest.mark.parametrize("mode", ["P", "1", "L"])
+def test_dominant_color_numpy_downsamples_any_mode(tmp_path, mode):
+    path = save(Image.new(mode, (600, 400), 1), tmp_path / "cover.png")
+    assert dominant_color_numpy(path) == tuple(dominant_color_colorgram(path))
+
+
+def random_features(n: int, seed: int) -> list[ImageFeatures]:
+    """
+    Returns features drawn from a few colors, some differing only by the sign of zero, with
+    perceptual hashes drawn from a few bases with a few bits flipped, so duplicates are common.
+    """
+    rng = np.random.default_rng(seed)
+    colors = [np.array([0.0, 50.0, 100.0]), np.array([-0.0, 50.0, 100.0]), np.array([1.0, 2, 3])]
+    bases = rng.integers(0, 2, (3, 8, 8)).astype(bool)
+    features = []
+    for i in range(n):
+        bits = bases[rng.integers(len(bases))].copy()
+        flips = rng.integers(0, 64, rng.integers(0, 4))
+        bits.flat[flips] = ~bits.flat[flips]
+        color = colors[rng.integers(len(colors))]
+        features.append(ImageFeatures(color, Path(f"{i}.jpg"), None, imagehash.ImageHash(bits)))
+    return features
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 3])
+@pytest.mark.parametrize("seed", range(3))
+def test_duplicate_index_matches_pairwise_comparison(threshold, seed):
+    features = random_features(200, seed)
+    expected: list[ImageFeatures] = []
+    for feature in features:
+        if not any(f.is_likely_duplicate(feature, threshold) for f in expected):
+            expected.append(feature)
+    assert len(expected) < len(features)
+
+    index = DuplicateIndex(threshold)
+    kept = [f for f in features if index.add(f)]
+    assert [f.image_path for f in kept] == [f.image_path for f in expected]
@@ -0,0 +1,245 @@
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from spy_collage.color_problem import (
+    Assignment,
+    ColorMatrix,
+    ColorSpace,
+    FactoredCostMatrix,
+    KeyObject,
+    Solver,
+    assignment_cost,
+    convert_space,
+    create_color_distance_matrix,
+    create_coordinate_distance_matrix,
+    create_cost_matrix,
+    select_candidates,
+    solve_assignment,
+    solve_colors,
+    solve_greedy,
+    solve_hungarian,
+)
+from spy_collage.presets import compile_preset
+
+PRESETS_PATH = Path(__file__).parent.parent / "presets.ini"
+PRESETS = ["horizontal_spectrum", "red_vs_blue"]
+SHAPES = [(6, 4), (13, 9)]
+
+
+def key_objects(preset: str, width: int, height: int) -> list[KeyObject]:
+    return compile_preset(preset, PRESETS_PATH).key_objects(width, height)
+
+
+def random_colors(n: int, seed: int = 0) -> ColorMatrix:
+    rgb = np.random.default_rng(seed).random((n, 3))
+    return convert_space(rgb, ColorSpace.RGB, ColorSpace.CIELAB)
+
+
+def baseline_color_distances(
+    colors: ColorMatrix, distance_space: ColorSpace, key_points: list[KeyObject]
+) -> np.ndarray:
+    distances = np.empty([len(colors), len(key_points)])
+    for i in range(len(colors)):
+        for j, kp in enumerate(key_points):
+            distances[i][j] = kp.color_distance_from(colors.matrix[i], colors.space, distance_space)
+    return distances
+
+
+def baseline_coordinate_distances(
+    width: int, height: int, key_points: list[KeyObject]
+) -> np.ndarray:
+    distances = np.empty([width, height, len(key_points)])
+    for i in range(width):
+        for j in range(height):
+            for k, kp in enumerate(key_points):
+                distances[i][j][k] = kp.distanceFrom(i, j)
+    return distances.reshape(width * height, len(key_points))
+
+
+def baseline_cost_matrix(color_distances: np.ndarray, space_distances: np.ndarray) -> np.ndarray:
+    color_distances_squared = color_distances**2
+    space_reciprocals = np.reciprocal(np.maximum(space_distances, 1))
+    return np.transpose(np.dot(color_distances_squared, np.transpose(space_reciprocals)))
+
+
+@pytest.mark.parametrize("preset", PRESETS)
+@pytest.mark.parametrize("distance_space", list(ColorSpace))
+def test_color_distance_matrix_matches_per_pair_distances(preset, distance_space):
+    key_points = key_objects(preset, 10, 10)
+    colors = random_colors(50)
+    np.testing.assert_allclose(
+        create_color_distance_matrix(colors, distance_space, key_points),
+        baseline_color_distances(colors, distance_space, key_points),
+        rtol=1e-12,
+    )
+
+
+@pytest.mark.parametrize("preset", PRESETS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_coordinate_distance_matrix_matches_per_cell_distances(preset, shape):
+    key_points = key_objects(preset, *shape)
+    np.testing.assert_array_equal(
+        create_coordinate_distance_matrix(*shape, key_points),
+        baseline_coordinate_distances(*shape, key_points),
+    )
+
+
+@pytest.mark.parametrize("preset", PRESETS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_cost_matrix_matches_baseline(preset, shape):
+    key_points = key_objects(preset, *shape)
+    colors = random_colors(shape[0] * shape[1] + 5)
+    color_distances = create_color_distance_matrix(colors, ColorSpace.CIELAB, key_points)
+    space_distances = create_coordinate_distance_matrix(*shape, key_points)
+    np.testing.assert_allclose(
+        create_cost_matrix(color_distances, space_distances),
+        baseline_cost_matrix(
+            baseline_color_distances(colors, ColorSpace.CIELAB, key_points),
+            baseline_coordinate_distances(*shape, key_points),
+        ),
+        rtol=1e-12,
+    )
+
+
+def random_cost(n: int, m: int, seed: int = 0) -> FactoredCostMatrix:
+    rng = np.random.default_rng(seed)
+    return FactoredCostMatrix(rng.random((m, 4)) * 100, rng.random((n, 4)) * 20)
+
+
+def assert_valid_assignment(positions: np.ndarray, colors: np.ndarray, n: int, m: int):
+    assert sorted(positions.tolist()) == list(range(n))
+    assert len(set(colors.tolist())) == n
+    assert all(0 <= c < m for c in colors)
+
+
+@pytest.mark.parametrize("n, m", [(9, 9), (12, 12), (6, 15), (10, 40)])
+def test_greedy_returns_a_valid_assignment_no_better_than_hungarian(n, m):
+    cost = random_cost(n, m, seed=n * m)
+    positions, colors = solve_greedy(cost)
+    assert_valid_assignment(positions, colors, n, m)
+
+    exact = assignment_cost(cost, *solve_hungarian(cost))
+    assert assignment_cost(cost, positions, colors) >= exact * (1 - 1e-12)
+
+
+@pytest.mark.parametrize("n, m", [(9, 9), (6, 15)])
+def test_solve_assignment_reports_gap_against_hungarian(n, m):
+    cost = random_cost(n, m, seed=1)
+    exact_cost = assignment_cost(cost, *solve_hungarian(cost))
+
+    greedy = solve_assignment(cost, solver=Solver.greedy, compare_exact=True)
+    assert greedy.exact_cost == pytest.approx(exact_cost)
+    assert greedy.gap == pytest.approx((greedy.cost - exact_cost) / exact_cost)
+    assert greedy.gap >= -1e-12
+
+    assert solve_assignment(cost, solver=Solver.greedy).gap is None
+    hungarian = solve_assignment(cost)
+    assert hungarian.cost == pytest.approx(exact_cost)
+    assert hungarian.gap == 0
+
+
+def test_gap_of_zero_cost_assignments():
+    positions = colors = np.arange(2)
+    assert Assignment(positions, colors, 0.0, exact_cost=0.0).gap == 0
+    assert Assignment(positions, colors, 1.0, exact_cost=0.0).gap == math.inf
+
+
+@pytest.mark.parametrize("factor", [0.5, 1, 1.01, 1.5, 4])
+@pytest.mark.parametrize("n_positions, n_key_objects", [(20, 3), (4, 30), (1, 8)])
+def test_select_candidates_is_always_feasible(factor, n_positions, n_key_objects):
+    rng = np.random.default_rng(n_positions * n_key_objects)
+    # many colors share their nearest key object, so shortlists overlap heavily
+    color_distances = rng.random((60, n_key_objects)) ** 4
+    candidates = select_candidates(color_distances, n_positions, factor)
+
+    assert len(candidates) >= n_positions
+    assert len(candidates) >= min(60, math.ceil(factor * n_positions))
+    assert np.array_equal(candidates, np.unique(candidates))
+
+
+@pytest.mark.parametrize("solver", list(Solver))
+def test_solve_colors_maps_candidates_back_to_colors(solver):
+    shape = (4, 3)
+    key_points = key_objects("horizontal_spectrum", *shape)
+    colors = random_colors(80, seed=3)
+    assignment = solve_colors(
+        shape, colors, ColorSpace.CIELAB, key_points, solver=solver, candidate_factor=1.5
+    )
+
+    color_distances = create_color_distance_matrix(colors, ColorSpace.CIELAB, key_points)
+    full_cost = FactoredCostMatrix(
+        color_distances, create_coordinate_distance_matrix(*shape, key_points)
+    )
+    candidates = select_candidates(color_distances, shape[0] * shape[1], 1.5)
+    assert set(assignment.colors.tolist()) <= set(candidates.tolist())
+    assert len(set(assignment.colors.tolist())) == shape[0] * shape[1]
+    assert assignment_cost(full_cost, assignment.positions, assignment.colors) == pytest.approx(
+        assignment.cost
+    )
+
+
+def test_solve_colors_with_every_candidate_matches_exact_solve():
+    shape = (3, 3)
+    key_points = key_objects("red_vs_blue", *shape)
+    colors = random_colors(20, seed=4)
+    exact = solve_colors(shape, colors, ColorSpace.CIELAB, key_points)
+    pruned = solve_colors(shape, colors, ColorSpace.CIELAB, key_points, candidate_factor=10)
+    assert pruned.cost == pytest.approx(exact.cost)
+
+
+INDICES = [
+    3,
+    (3,),
+    (3, 5),
+    (slice(2, 6),),
+    (slice(None), 4),
+    (3, np.array([0, 4, 9, 1])),
+    (np.array([0, 2, 5]), np.array([7, 1, 3])),
+    (slice(1, 8, 2), slice(3, 12)),
+    (np.array([1, 4]), slice(None)),
+]
+
+
+@pytest.mark.parametrize("key", INDICES, ids=repr)
+def test_factored_cost_matrix_indexing_matches_dense(key):
+    cost = random_cost(8, 14, seed=5)
+    np.testing.assert_allclose(cost[key], cost.to_dense()[key], rtol=1e-12)
+
+
+def test_factored_cost_matrix_select_columns_and_min():
+    cost = random_cost(9, 14, seed=6)
+    columns = np.array([13, 2, 7, 8, 0])
+    np.testing.assert_allclose(
+        cost.select_columns(columns).to_dense(), cost.to_dense()[:, columns], rtol=1e-12
+    )
+
+    # a few rows per block, so that min has to combine several row_blocks
+    cost.block_elements = 3 * 14
+    assert len(list(cost.row_blocks())) == 3
+    np.testing.assert_allclose(cost.min(axis=1), cost.to_dense().min(axis=1), rtol=1e-12)
+    with pytest.raises(ValueError):
+        cost.min(axis=0)
+
+
+def test_float32_cost_matrix_stays_float32():
+    rng = np.random.default_rng(8)
+    cost = FactoredCostMatrix(rng.random((6, 3)), rng.random((4, 3)), dtype=np.float32)
+    assert cost.dtype == np.float32
+    assert cost[1].dtype == cost[np.arange(4), np.arange(4)].dtype == np.float32
+
+
+@pytest.mark.parametrize("solver", list(Solver))
+def test_float32_costs_solve_like_float64(solver):
+    shape = (4, 4)
+    key_points = key_objects("horizontal_spectrum", *shape)
+    colors = random_colors(30, seed=7)
+    single = solve_colors(
+        shape, colors, ColorSpace.CIELAB, key_points, solver=solver, cost_dtype=np.float32
+    )
+    double = solve_colors(shape, colors, ColorSpace.CIELAB, key_points, solver=solver)
+
+    assert len(set(single.colors.tolist())) == shape[0] * shape[1]
+    assert single.cost == pytest.approx(double.cost, rel=1e-4)
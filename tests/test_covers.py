@@ -0,0 +1,88 @@
+import os
+import stat
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from spy_collage.models import AlbumCoverResolution
+from spy_collage.spotify import iter_covers
+
+COVERS = {f"/covers/{i}": f"cover {i}".encode() * 1000 for i in range(6)}
+
+
+class CoverHandler(BaseHTTPRequestHandler):
+    # the number of requests to each path so far
+    counts: dict[str, int] = {}
+    # paths that fail with a server error the first time they are requested
+    flaky = {"/covers/2", "/covers/4"}
+
+    def do_GET(self):
+        count = self.counts[self.path] = self.counts.get(self.path, 0) + 1
+        if self.path not in COVERS:
+            self.send_error(404)
+        elif self.path in self.flaky and count == 1:
+            self.send_error(503)
+        else:
+            body = COVERS[self.path]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def cover_server(local_server):
+    CoverHandler.counts = {}
+    return f"http://{local_server(CoverHandler)}"
+
+
+def album(url: str) -> dict:
+    return {"images": [{"width": 64, "url": url}]}
+
+
+def test_iter_covers_yields_in_order_and_retries(cover_server, tmp_path):
+    covers = [(album(cover_server + key), tmp_path / f"{i}.jpg") for i, key in enumerate(COVERS)]
+    paths = list(iter_covers(covers, AlbumCoverResolution.small, workers=3))
+
+    assert paths == [path for _, path in covers]
+    for key, path in zip(COVERS, paths):
+        assert path.read_bytes() == COVERS[key]
+    assert CoverHandler.counts["/covers/2"] == 2
+    assert CoverHandler.counts["/covers/0"] == 1
+    # only the finished covers are left in the directory, with the usual permissions
+    assert sorted(tmp_path.iterdir()) == sorted(paths)
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(paths[0].stat().st_mode) == 0o666 & ~umask
+
+
+def test_iter_covers_skips_existing_covers(cover_server, tmp_path):
+    existing = tmp_path / "0.jpg"
+    existing.write_bytes(b"already here")
+    covers = [(album(cover_server + "/covers/0"), existing)]
+
+    assert list(iter_covers(covers, AlbumCoverResolution.small)) == [existing]
+    assert existing.read_bytes() == b"already here"
+    assert CoverHandler.counts == {}
+
+
+def test_iter_covers_without_download_raises_for_missing_covers(cover_server, tmp_path):
+    covers = [(album(cover_server + "/covers/0"), tmp_path / "0.jpg")]
+
+    with pytest.raises(FileNotFoundError):
+        list(iter_covers(covers, AlbumCoverResolution.small, download=False))
+
+
+def test_iter_covers_raises_failed_downloads(cover_server, tmp_path):
+    covers = [
+        (album(cover_server + "/covers/0"), tmp_path / "0.jpg"),
+        (album(cover_server + "/missing"), tmp_path / "missing.jpg"),
+    ]
+
+    with pytest.raises(requests.HTTPError):
+        list(iter_covers(covers, AlbumCoverResolution.small, workers=2))
+    assert not (tmp_path / "missing.jpg").exists()
+    # no partial downloads are left behind
+    assert all(not path.name.endswith(".part") for path in tmp_path.iterdir())
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import dateparser
+import pytest
+
+from spy_collage import discovery
+from spy_collage.benchmark import synthetic_catalog
+from spy_collage.discovery import DiscoveryIndex, parse_release_date
+
+
+def discover_album_linear(
+    artist_albums: dict[str, list[dict]],
+    album_tracks: dict[str, list[dict]],
+    track: dict,
+    user_market: str,
+) -> tuple[dict, bool]:
+    """Discovers albums by scanning catalogs in order, as spy-collage did before DiscoveryIndex."""
+    if not discovery.needs_discovery(track):
+        return track["album"], False
+    track_album_release_date = dateparser.parse(track["album"]["release_date"])
+    assert track_album_release_date is not None
+    for album in artist_albums[track["album"]["artists"][0]["uri"]]:
+        album_release_date = dateparser.parse(album["release_date"])
+        assert album_release_date is not None
+        if album_release_date < track_album_release_date:
+            continue
+        if user_market and user_market not in album["available_markets"]:
+            continue
+        if len(album["artists"]) > 1:
+            continue
+        for album_track in album_tracks[album["uri"]]:
+            if discovery.is_duplicate_track(track, album_track):
+                return album, True
+    return track["album"], False
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_discovery_index_matches_linear_scan(seed):
+    artist_albums, album_tracks, single_tracks = synthetic_catalog(10, 8, 8, 60, seed)
+    index = DiscoveryIndex(artist_albums.__getitem__, album_tracks.__getitem__, "US")
+    discovered = [index.discover(t) for t in single_tracks]
+    assert any(d for _, d in discovered) and not all(d for _, d in discovered)
+    assert discovered == [
+        discover_album_linear(artist_albums, album_tracks, t, "US") for t in single_tracks
+    ]
+
+
+@pytest.mark.parametrize(
+    "release_date",
+    # years, months and dates, then dates only dateparser understands
+    ["2001", "2023-02", "2024-02", "2001-03", "2001-03-04", "March 4, 2001", "2001/03/04"],
+)
+@pytest.mark.parametrize("now", [datetime(2024, 1, 31), datetime(2024, 6, 15)])
+def test_parse_release_date_matches_dateparser(release_date, now):
+    expected = dateparser.parse(release_date, settings={"RELATIVE_BASE": now})
+    assert parse_release_date(release_date, now) == expected
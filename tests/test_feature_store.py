@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+
+from spy_collage import feature_store
+from spy_collage.feature_store import FeatureStore
+
+
+def test_get_falls_back_to_content_hash_and_updates_path(tmp_path, monkeypatch):
+    original = tmp_path / "original.jpg"
+    original.write_bytes(b"cover")
+    features = np.array([1.0, 2.0, 3.0])
+    with FeatureStore(tmp_path / "features.sqlite", "test") as store:
+        store.put(original, features)
+
+        moved = tmp_path / "moved.jpg"
+        os.replace(original, moved)
+        np.testing.assert_array_equal(store.get(moved), features)
+
+        # the path now matches, so the next lookup doesn't hash the file
+        hashed = []
+        monkeypatch.setattr(feature_store, "hash_file", lambda path: hashed.append(path))
+        np.testing.assert_array_equal(store.get(moved), features)
+        assert not hashed
+
+
+def test_get_misses_unknown_content(tmp_path):
+    cover = tmp_path / "cover.jpg"
+    cover.write_bytes(b"cover")
+    with FeatureStore(tmp_path / "features.sqlite", "test") as store:
+        store.put(cover, np.zeros(3))
+        cover.write_bytes(b"another cover")
+        assert store.get(cover) is None
+
+
+def counting_hash_file(monkeypatch):
+    hashed = []
+
+    def hash_file(path):
+        hashed.append(path)
+        return original(path)
+
+    original = feature_store.hash_file
+    monkeypatch.setattr(feature_store, "hash_file", hash_file)
+    return hashed
+
+
+def test_miss_then_put_hashes_once(tmp_path, monkeypatch):
+    cover = tmp_path / "cover.jpg"
+    cover.write_bytes(b"cover")
+    hashed = counting_hash_file(monkeypatch)
+    with FeatureStore(tmp_path / "features.sqlite", "test") as store:
+        assert store.get(cover) is None
+        store.put(cover, np.ones(3))
+        np.testing.assert_array_equal(store.get(cover), np.ones(3))
+    assert hashed == [cover]
+
+
+def test_identical_covers_keep_their_own_paths(tmp_path, monkeypatch):
+    first, second = tmp_path / "first.jpg", tmp_path / "second.jpg"
+    first.write_bytes(b"cover")
+    second.write_bytes(b"cover")
+    features = np.array([1.0, 2.0, 3.0])
+    with FeatureStore(tmp_path / "features.sqlite", "test") as store:
+        store.put(first, features)
+        np.testing.assert_array_equal(store.get(second), features)
+
+        # both paths are now recorded, so alternating between them doesn't hash either again
+        hashed = counting_hash_file(monkeypatch)
+        for _ in range(2):
+            np.testing.assert_array_equal(store.get(first), features)
+            np.testing.assert_array_equal(store.get(second), features)
+        assert not hashed
+
+
+def test_evict_missing_keeps_features_still_at_another_path(tmp_path):
+    first, second = tmp_path / "first.jpg", tmp_path / "second.jpg"
+    first.write_bytes(b"cover")
+    second.write_bytes(b"cover")
+    with FeatureStore(tmp_path / "features.sqlite", "test") as store:
+        store.put(first, np.ones(3))
+        store.put(second, np.ones(3))
+        first.unlink()
+        assert store.evict_missing() == 1
+        np.testing.assert_array_equal(store.get(second), np.ones(3))
+
+        second.unlink()
+        assert store.evict_missing() == 1
+        second.write_bytes(b"cover")
+        assert store.get(second) is None
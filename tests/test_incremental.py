@@ -0,0 +1,107 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from spy_collage.color_problem import (
+    ColorMatrix,
+    ColorSpace,
+    KeyObject,
+    convert_space,
+    solve_colors,
+)
+from spy_collage.incremental import IncrementalResult, solve_colors_incremental
+from spy_collage.presets import compile_preset
+
+PRESETS_PATH = Path(__file__).parent.parent / "presets.ini"
+
+
+def key_objects(preset: str, width: int, height: int) -> list[KeyObject]:
+    return compile_preset(preset, PRESETS_PATH).key_objects(width, height)
+
+
+def random_rgb(rng: np.random.Generator, n: int) -> np.ndarray:
+    return rng.random((n, 3))
+
+
+def solve_both(
+    shape: tuple[int, int], rgb: np.ndarray, ids: list[str], preset: str, state_path: Path
+) -> IncrementalResult:
+    """Solves incrementally, checking the solution against solving from scratch."""
+    colors = convert_space(rgb, ColorSpace.RGB, ColorSpace.CIELAB)
+    key_points = key_objects(preset, *shape)
+    result = solve_colors_incremental(shape, colors, ids, ColorSpace.CIELAB, key_points, state_path)
+    expected = solve_colors(shape, colors, ColorSpace.CIELAB, key_points)
+
+    cols = result.assignment.colors
+    assert len(cols) == shape[0] * shape[1]
+    assert len(np.unique(cols)) == len(cols) and cols.min() >= 0 and cols.max() < len(rgb)
+    assert result.assignment.cost == pytest.approx(expected.cost, rel=1e-9)
+    assert result.assignment.gap is not None and result.assignment.gap < 1e-9
+    return result
+
+
+@pytest.mark.parametrize("preset", ["horizontal_spectrum", "red_vs_blue"])
+@pytest.mark.parametrize("square", [False, True])
+@pytest.mark.parametrize("seed", range(3))
+def test_random_changes_match_solving_from_scratch(tmp_path, preset, square, seed):
+    rng = np.random.default_rng(seed)
+    shape = (6, 4)
+    cells = shape[0] * shape[1]
+    n = cells if square else cells + 10
+    rgb = random_rgb(rng, n)
+    ids = [f"album{i}" for i in range(n)]
+    next_id = n
+    state_path = tmp_path / "state.npz"
+
+    assert not solve_both(shape, rgb, ids, preset, state_path).warm
+    for _ in range(8):
+        # recolor some albums, then remove some and add others, keeping enough for every cell
+        recolored = rng.choice(len(ids), rng.integers(0, 4), replace=False)
+        rgb[recolored] = random_rgb(rng, len(recolored))
+        removed = rng.choice(len(ids), rng.integers(0, min(6, len(ids) - cells + 4)), replace=False)
+        keep = np.setdiff1d(np.arange(len(ids)), removed)
+        added = len(removed) if square else rng.integers(max(0, cells - len(keep)), 6)
+        rgb = np.concatenate([rgb[keep], random_rgb(rng, added)])
+        ids = [ids[i] for i in keep] + [f"album{next_id + i}" for i in range(added)]
+        next_id += added
+        # albums are only matched by id, so their order may change too
+        order = rng.permutation(len(ids))
+        rgb, ids = rgb[order], [ids[i] for i in order]
+
+        # a recolored album counts as removed and added again
+        recolored_kept = len(np.setdiff1d(recolored, removed))
+        result = solve_both(shape, rgb, ids, preset, state_path)
+        assert result.warm
+        assert result.removed == len(removed) + recolored_kept
+        assert result.added == added + recolored_kept
+
+
+@pytest.mark.parametrize(
+    "preset, shape", [("red_vs_blue", (6, 4)), ("horizontal_spectrum", (7, 4))]
+)
+def test_state_for_another_problem_is_solved_from_scratch(tmp_path, preset, shape):
+    rgb = random_rgb(np.random.default_rng(0), 40)
+    ids = [f"album{i}" for i in range(40)]
+    state_path = tmp_path / "state.npz"
+    solve_both((6, 4), rgb, ids, "horizontal_spectrum", state_path)
+
+    result = solve_both(shape, rgb, ids, preset, state_path)
+    assert not result.warm and result.augmentations == 0
+    # the new problem's state replaces the old one
+    assert solve_both(shape, rgb, ids, preset, state_path).warm
+
+
+def test_duplicate_ids_are_separate_colors(tmp_path):
+    rng = np.random.default_rng(0)
+    rgb = random_rgb(rng, 30)
+    ids = [f"album{i // 2}" for i in range(30)]
+    state_path = tmp_path / "state.npz"
+    solve_both((6, 4), rgb, ids, "horizontal_spectrum", state_path)
+
+    result = solve_both((6, 4), rgb, ids, "horizontal_spectrum", state_path)
+    assert result.warm and result.added == result.removed == result.augmentations == 0
+
+    # dropping the first of a pair renumbers the second, which then counts as a recolor
+    result = solve_both((6, 4), rgb[1:], ids[1:], "horizontal_spectrum", state_path)
+    assert result.warm and (result.added, result.removed) == (1, 2)
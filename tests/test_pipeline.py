@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+from spy_collage.pipeline import Pipeline
+
+
+def test_stages_yield_everything_in_order():
+    pipeline = Pipeline(buffer_size=2)
+    doubled = pipeline.stage("double", (2 * i for i in pipeline.stage("count", iter(range(50)))))
+
+    assert list(doubled) == [2 * i for i in range(50)]
+    pipeline.close()
+    assert list(pipeline.stats) == ["count", "double"]
+    assert pipeline.stats["count"].items == pipeline.stats["double"].items == 50
+
+
+def test_stage_errors_are_raised_by_the_consumer():
+    def fail():
+        yield 1
+        raise ValueError("stage failed")
+
+    pipeline = Pipeline()
+    with pytest.raises(ValueError, match="stage failed"):
+        list(pipeline.stage("fail", fail()))
+    pipeline.close()
+
+
+def test_close_waits_for_abandoned_stages():
+    pipeline = Pipeline(buffer_size=1)
+    counted = pipeline.stage("count", iter(range(1000)))
+    squared = pipeline.stage("square", (i * i for i in counted))
+    assert next(squared) == 0
+
+    pipeline.close()
+    assert not any(t.name.startswith("pipeline-") and t.is_alive() for t in threading.enumerate())
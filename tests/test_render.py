@@ -0,0 +1,92 @@
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from spy_collage import render
+from spy_collage.render import ThumbnailCache, save_bands, supports_output, write_deep_zoom
+
+
+def bands(width: int, heights: list[int]) -> list[Image.Image]:
+    return [Image.new("RGB", (width, h), (i * 40, 100, 200)) for i, h in enumerate(heights)]
+
+
+@pytest.mark.parametrize("extension", [".png", ".jpg"])
+def test_save_bands_writes_readable_image(tmp_path, extension):
+    output = tmp_path / f"collage{extension}"
+    save_bands(output, (8, 6), bands(8, [2, 4]))
+
+    with Image.open(output) as image:
+        assert image.size == (8, 6)
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(output.stat().st_mode) == 0o666 & ~umask
+    assert list(tmp_path.iterdir()) == [output]
+
+
+@pytest.mark.parametrize(
+    "output, supported",
+    [("a.png", True), ("a.JPG", True), ("a.dzi", True), ("a.txt", False), ("a", False)],
+)
+def test_supports_output(output, supported):
+    assert supports_output(Path(output)) == supported
+
+
+@pytest.mark.parametrize("threads", [False, True])
+def test_write_deep_zoom_writes_every_level(tmp_path, threads):
+    output = tmp_path / "collage.dzi"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        write_deep_zoom(
+            output,
+            (40, 24),
+            bands(40, [12, 12]),
+            tile_size=16,
+            executor=executor if threads else None,
+        )
+
+    assert 'Width="40" Height="24"' in output.read_text(encoding="utf-8")
+    levels = sorted((tmp_path / "collage_files").iterdir(), key=lambda p: int(p.name))
+    assert [p.name for p in levels] == ["0", "1", "2", "3", "4", "5", "6"]
+    assert sorted(p.name for p in levels[-1].iterdir()) == [
+        f"{col}_{row}.jpg" for col in range(3) for row in range(2)
+    ]
+
+
+def test_write_deep_zoom_raises_tile_errors(tmp_path, monkeypatch):
+    def fail(tile, path):
+        raise OSError(f"could not write {path}")
+
+    monkeypatch.setattr(render, "_save_tile", fail)
+    output = tmp_path / "collage.dzi"
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(OSError):
+        write_deep_zoom(output, (40, 24), bands(40, [24]), tile_size=16, executor=executor)
+    assert not output.exists()
+
+
+def test_thumbnail_cache_writes_readable_thumbnail(tmp_path):
+    cover = tmp_path / "cover.png"
+    Image.new("RGB", (40, 40), (10, 20, 30)).save(cover)
+    thumbnails = ThumbnailCache(tmp_path / "thumbnails")
+    assert thumbnails.load(cover, 8).size == (8, 8)
+
+    thumbnail = thumbnails.thumbnail_path(cover, 8)
+    assert list(thumbnail.parent.iterdir()) == [thumbnail]
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(thumbnail.stat().st_mode) == 0o666 & ~umask
+
+
+def test_thumbnail_cache_removes_partial_thumbnail(tmp_path, monkeypatch):
+    def fail(self, fp, format=None, **params):
+        raise OSError("disk full")
+
+    cover = tmp_path / "cover.png"
+    Image.new("RGB", (40, 40)).save(cover)
+    thumbnails = ThumbnailCache(tmp_path / "thumbnails")
+    monkeypatch.setattr(Image.Image, "save", fail)
+    with pytest.raises(OSError):
+        thumbnails.load(cover, 8)
+    assert not list(thumbnails.thumbnail_path(cover, 8).parent.iterdir())
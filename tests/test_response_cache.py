@@ -0,0 +1,67 @@
+import json
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from spy_collage.response_cache import CachedSession, OfflineCacheMiss, ResponseCache
+
+ETAG = '"v1"'
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    # the If-None-Match header of each request so far
+    requests: list = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def api_url(local_server):
+    ApiHandler.requests = []
+    return f"http://{local_server(ApiHandler)}/v1/albums"
+
+
+def test_fresh_responses_are_served_from_the_cache(api_url, tmp_path):
+    with ResponseCache(tmp_path / "cache.sqlite") as cache:
+        session = CachedSession(cache)
+        first = session.get(api_url, params={"ids": "a,b", "market": "US"})
+        second = session.get(api_url, params={"market": "US", "ids": "a,b"})
+
+    assert first.json() == second.json() == {"path": "/v1/albums?ids=a%2Cb&market=US"}
+    assert second.status_code == 200
+    assert ApiHandler.requests == [None]
+
+
+def test_stale_responses_are_revalidated(api_url, tmp_path):
+    with ResponseCache(tmp_path / "cache.sqlite", ttls={"albums": 0}) as cache:
+        session = CachedSession(cache)
+        first = session.get(api_url).json()
+        second = session.get(api_url)
+
+    assert second.status_code == 200
+    assert second.json() == first
+    assert ApiHandler.requests == [None, ETAG]
+
+
+def test_offline_cache_serves_stale_responses_and_raises_on_misses(api_url, tmp_path):
+    with ResponseCache(tmp_path / "cache.sqlite", ttls={"albums": 0}) as cache:
+        expected = CachedSession(cache).get(api_url).json()
+    with ResponseCache(tmp_path / "cache.sqlite", offline=True) as cache:
+        session = CachedSession(cache)
+        assert session.get(api_url).json() == expected
+        with pytest.raises(OfflineCacheMiss):
+            session.get(api_url, params={"ids": "c"})
+    assert ApiHandler.requests == [None]
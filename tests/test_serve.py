@@ -0,0 +1,118 @@
+import io
+import json
+import shutil
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from spy_collage.serve import CollageServer, CollageService
+
+PRESETS_PATH = Path(__file__).parent.parent / "presets.ini"
+
+
+def jpeg(color: tuple[int, int, int]) -> bytes:
+    f = io.BytesIO()
+    Image.new("RGB", (16, 16), color).save(f, format="JPEG")
+    return f.getvalue()
+
+
+COVERS = {f"/covers/{i}": jpeg((i * 20 % 256, i * 50 % 256, 255 - i * 10)) for i in range(20)}
+
+
+class CoverHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = COVERS[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def albums(local_server):
+    address = local_server(CoverHandler)
+    return [
+        {
+            "id": f"album{i}",
+            "uri": f"spotify:album:album{i}",
+            "images": [{"width": 16, "url": f"http://{address}{path}"}],
+        }
+        for i, path in enumerate(COVERS)
+    ]
+
+
+@pytest.fixture
+def collage_server(tmp_path, monkeypatch, local_server):
+    # the service keeps its caches and downloaded covers in the working directory
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(PRESETS_PATH, tmp_path / "presets.ini")
+    service = CollageService(
+        workers=2, queue_size=1, jobs=1, spotify_cache=False, api_url="http://127.0.0.1:9/v1"
+    )
+    yield local_server(CollageServer(("127.0.0.1", 0), service))
+    service.close()
+
+
+def request(address: str, method: str, path: str, body=None):
+    host, port = address.split(":")
+    connection = HTTPConnection(host, int(port), timeout=60)
+    data = None if body is None else json.dumps(body).encode()
+    connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+def test_presets_and_status(collage_server):
+    response, body = request(collage_server, "GET", "/presets")
+    assert response.status == 200
+    assert {"horizontal_spectrum", "red_vs_blue"} <= set(json.loads(body)["presets"])
+
+    response, body = request(collage_server, "GET", "/status")
+    assert response.status == 200
+    assert json.loads(body)["pending"] == 0
+
+    response, _ = request(collage_server, "GET", "/missing")
+    assert response.status == 404
+
+
+def test_collage_is_streamed_back(collage_server, albums):
+    job = {
+        "source": albums,
+        "preset": "horizontal_spectrum",
+        "dimensions": "4x3",
+        "extractor": "numpy",
+    }
+    response, body = request(collage_server, "POST", "/collage", job)
+
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "image/png"
+    assert response.getheader("X-Collage-Albums") == str(len(albums))
+    float(response.getheader("X-Collage-Cost"))
+    with Image.open(io.BytesIO(body)) as image:
+        assert image.size == (4 * 16, 3 * 16)
+
+    response, body = request(collage_server, "GET", "/status")
+    assert json.loads(body)["completed"] == 1
+
+
+@pytest.mark.parametrize(
+    "changes, status",
+    [
+        ({"source": None}, 400),
+        ({"colour": "red"}, 400),
+        ({"preset": "missing"}, 400),
+        ({"format": "txt"}, 400),
+        ({"dimensions": "5x5"}, 422),
+    ],
+)
+def test_invalid_jobs_are_rejected(collage_server, albums, changes, status):
+    job = {"source": albums, "preset": "horizontal_spectrum", "dimensions": "2x2", **changes}
+    job = {field: value for field, value in job.items() if value is not None}
+    response, body = request(collage_server, "POST", "/collage", dict(job, extractor="numpy"))
+
+    assert response.status == status
+    assert "error" in json.loads(body)
@@ -0,0 +1,175 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from spy_collage.spotify import fetch_inputs, iter_albums
+
+ARTIST = {"uri": "spotify:artist:a", "name": "Artist"}
+
+
+def album(i: int, album_type: str = "album") -> dict:
+    return {
+        "uri": f"spotify:album:{i}",
+        "name": f"Album {i}",
+        "album_type": album_type,
+        "release_date": "2021-01-01",
+        "available_markets": ["US"],
+        "artists": [ARTIST],
+    }
+
+
+def track(i: int, album_type: str = "album") -> dict:
+    return {
+        "uri": f"spotify:track:{i}",
+        "name": f"Song {i}",
+        "duration_ms": 200000,
+        "artists": [ARTIST],
+        "album": album(1000 + i, album_type),
+    }
+
+
+def page(items: list, offset: int, limit: int) -> dict:
+    has_next = offset + limit < len(items)
+    return {
+        "items": items[offset : offset + limit],
+        "offset": offset,
+        "limit": limit,
+        "total": len(items),
+        "next": "https://api.spotify.com/v1/next" if has_next else None,
+    }
+
+
+class FakeSpotify:
+    """Serves albums, tracks, playlists and artist catalogs in pages, recording each call."""
+
+    def __init__(
+        self, playlists: dict[str, list[dict]], catalog: list[dict], tracklist: list[dict]
+    ):
+        self.playlists = playlists
+        self.catalog = catalog
+        self.tracklist = tracklist
+        self.calls: list[tuple] = []
+        self.lock = threading.Lock()
+
+    def record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def albums(self, uris):
+        self.record("albums", len(uris))
+        return {"albums": [album(int(uri.split(":")[-1])) for uri in uris]}
+
+    def tracks(self, uris):
+        self.record("tracks", len(uris))
+        return {"tracks": [track(int(uri.split(":")[-1])) for uri in uris]}
+
+    def playlist(self, uri):
+        self.record("playlist", uri)
+        return {"tracks": page(self.playlists[uri], 0, 100)}
+
+    def playlist_items(self, uri, limit=50, offset=0, additional_types=("track", "episode")):
+        self.record("playlist_items", uri, offset, limit, additional_types)
+        return page(self.playlists[uri], offset, limit)
+
+    def artist_albums(self, artist_uri, album_type=None, limit=20, offset=0):
+        self.record("artist_albums", offset, limit, album_type)
+        return page(self.catalog, offset, limit)
+
+    def album_tracks(self, album_uri, limit=50, offset=0):
+        self.record("album_tracks", album_uri, offset, limit)
+        return page(self.tracklist, offset, limit)
+
+    def called(self, name: str) -> list[tuple]:
+        return sorted(call[1:] for call in self.calls if call[0] == name)
+
+
+def test_fetch_inputs_pages_through_everything_in_order():
+    playlist = [{"track": track(500 + i)} for i in range(250)]
+    sp = FakeSpotify({"spotify:playlist:p": playlist}, [], [])
+    album_uris = [f"spotify:album:{i}" for i in range(45)]
+    track_uris = [f"spotify:track:{i}" for i in range(120)]
+    uris = (
+        album_uris[:5] + track_uris[:60] + ["spotify:playlist:p"] + album_uris[5:] + track_uris[60:]
+    )
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        albums, tracks = fetch_inputs(sp, uris, executor)
+        album_uris_fetched = [a["uri"] for a in albums]
+        track_uris_fetched = [t["uri"] for t in tracks]
+
+    assert album_uris_fetched == album_uris
+    assert track_uris_fetched == (
+        track_uris[:60] + [item["track"]["uri"] for item in playlist] + track_uris[60:]
+    )
+    assert sp.called("albums") == [(5,), (20,), (20,)]
+    assert sp.called("tracks") == [(20,), (50,), (50,)]
+    assert sp.called("playlist_items") == [
+        ("spotify:playlist:p", 100, 100, ("track",)),
+        ("spotify:playlist:p", 200, 100, ("track",)),
+    ]
+
+
+def test_iter_albums_discovers_albums_on_later_pages():
+    # the single's recording is the 56th track of the 44th album of its artist's catalog
+    catalog = [album(i) for i in range(45)]
+    single = track(55, "single")
+    tracklist = [dict(track(i), album=None) for i in range(60)]
+    sp = FakeSpotify({}, catalog, tracklist)
+
+    original_album_tracks = sp.album_tracks
+
+    def album_tracks(album_uri, limit=50, offset=0):
+        if album_uri != catalog[43]["uri"]:
+            return page([], offset, limit)
+        return original_album_tracks(album_uri, limit=limit, offset=offset)
+
+    sp.album_tracks = album_tracks
+    sp.tracks = lambda uris: {"tracks": [single]}
+
+    albums = list(iter_albums(["spotify:track:55"], sp=sp, max_workers=4))
+
+    assert albums == [catalog[43]]
+    assert sp.called("artist_albums") == [(0, 20, "album"), (20, 20, "album"), (40, 20, "album")]
+    assert sp.called("album_tracks") == [(catalog[43]["uri"], 0, 50), (catalog[43]["uri"], 50, 50)]
+
+
+def test_iter_albums_yields_batches_as_they_arrive():
+    sp = FakeSpotify({}, [], [])
+    released = threading.Event()
+    original_albums = sp.albums
+
+    def albums(uris):
+        if uris[0] != "spotify:album:0":
+            assert released.wait(5)
+        return original_albums(uris)
+
+    sp.albums = albums
+    uris = [f"spotify:album:{i}" for i in range(40)]
+    collected = iter_albums(uris, discovery_enabled=False, sp=sp, max_workers=4)
+
+    # the first batch is yielded while the second is still being requested
+    assert [next(collected)["uri"] for _ in range(20)] == uris[:20]
+    released.set()
+    assert [a["uri"] for a in collected] == uris[20:]
+
+
+def test_iter_albums_yields_discovered_albums_per_artist():
+    other_artist = {"uri": "spotify:artist:b", "name": "Other Artist"}
+    singles = [track(1, "single"), track(2, "single")]
+    singles[1]["album"]["artists"] = [other_artist]
+    sp = FakeSpotify({}, [], [])
+    released = threading.Event()
+    original_artist_albums = sp.artist_albums
+
+    def artist_albums(artist_uri, album_type=None, limit=20, offset=0):
+        if artist_uri == other_artist["uri"]:
+            assert released.wait(5)
+        return original_artist_albums(artist_uri, album_type, limit, offset)
+
+    sp.artist_albums = artist_albums
+    sp.tracks = lambda uris: {"tracks": singles}
+    collected = iter_albums(["spotify:track:1", "spotify:track:2"], sp=sp, max_workers=4)
+
+    # the first artist's single is yielded while the other artist's catalog is being requested
+    assert next(collected) == singles[0]["album"]
+    released.set()
+    assert list(collected) == [singles[1]["album"]]